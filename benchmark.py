@@ -0,0 +1,396 @@
+"""Micro benchmarks of the model building blocks.
+
+usage: python benchmark.py <command> [options], see python benchmark.py -h for the list of commands.
+"""
+import argparse
+import time
+
+import torch
+
+import runtime
+from runtime import synchronize
+
+
+def time_forward(fn, device, warmup=3, iterations=10, grad=False):
+    """Median wall time of fn() in milliseconds, fn runs under no_grad unless grad is set."""
+    with torch.set_grad_enabled(grad):
+        for _ in range(warmup):
+            fn()
+        times = []
+        for _ in range(iterations):
+            synchronize(device)
+            start = time.perf_counter()
+            fn()
+            synchronize(device)
+            times.append((time.perf_counter() - start) * 1000.0)
+    return sorted(times)[len(times) // 2]
+
+
+def sparse_depth_batch(batch_size, height, width, device, density=0.05):
+    depth = torch.rand(batch_size, 1, height, width, device=device) * 10.0
+    conf = (torch.rand(batch_size, 1, height, width, device=device) < density).float()
+    return depth * conf, conf
+
+
+def legacy_gather_pooled(x, idx):
+    # per (batch, channel) loop that nconv_sd.CNN used before gather_pooled
+    out = torch.zeros(idx.size(), device=x.device)
+    for i in range(out.size(0)):
+        for j in range(out.size(1)):
+            out[i, j, :, :] = x[i, j, :, :].view(-1)[idx[i, j, :, :].view(-1)].view(idx.size()[2:])
+    return out
+
+
+def bench_unguided(args, device):
+    import model_zoo.nconv_sd as nconv_sd
+
+    model = nconv_sd.CNN().to(device).eval()
+    gather = nconv_sd.gather_pooled
+    print('{:>6} {:>12} {:>12} {:>8}'.format('batch', 'loop [ms]', 'gather [ms]', 'speedup'))
+    for batch_size in args.batch_sizes:
+        x0, c0 = sparse_depth_batch(batch_size, args.height, args.width, device)
+        times = []
+        for impl in [legacy_gather_pooled, gather]:
+            nconv_sd.gather_pooled = impl
+            try:
+                times.append(time_forward(lambda: model(x0, c0), device, args.warmup, args.iterations))
+            finally:
+                nconv_sd.gather_pooled = gather
+        print('{:>6} {:>12.2f} {:>12.2f} {:>7.2f}x'.format(batch_size, times[0], times[1], times[0] / times[1]))
+
+
+# (in_channels, out_channels, kernel_size, padding) of the layers of nconv_sd.CNN
+nconv_layers = [(1, 2, 5, 2), (2, 2, 5, 2), (4, 2, 3, 1), (2, 1, 1, 0)]
+
+
+def nconv_parity(layer, data, conf):
+    """Max abs difference of the outputs and input gradients between the fused and the reference NConv2d."""
+    results = []
+    for fused in [True, False]:
+        layer.fused = fused
+        x = data.clone().requires_grad_()
+        c = conf.clone().requires_grad_()
+        nconv, cout = layer(x, c)
+        (nconv.sum() + cout.sum()).backward()
+        results.append([nconv.detach(), cout.detach(), x.grad, c.grad, layer.weight.grad.clone()])
+        layer.weight.grad = None
+        layer.bias.grad = None
+    return max(float((a - b).abs().max()) for a, b in zip(*results))
+
+
+def bench_nconv(args, device):
+    from model_zoo.nconv import NConv2d
+
+    print('{:>16} {:>12} {:>12} {:>8} {:>10}'.format('layer', 'ref [ms]', 'fused [ms]', 'speedup', 'max diff'))
+    for in_channels, out_channels, kernel_size, padding in nconv_layers:
+        layer = NConv2d(in_channels, out_channels, kernel_size, 'softplus', 'p', padding=padding).to(device).eval()
+        data, conf = sparse_depth_batch(args.batch_size, args.height, args.width, device)
+        data, conf = data.repeat(1, in_channels, 1, 1), conf.repeat(1, in_channels, 1, 1)
+        diff = nconv_parity(layer, data, conf)
+        times = []
+        for fused in [False, True]:
+            layer.fused = fused
+            times.append(time_forward(lambda: layer(data, conf), device, args.warmup, args.iterations))
+        name = '{}->{} k{}'.format(in_channels, out_channels, kernel_size)
+        print('{:>16} {:>12.3f} {:>12.3f} {:>7.2f}x {:>10.2e}'.format(name, times[0], times[1], times[0] / times[1],
+                                                                     diff))
+        assert diff < args.tolerance, 'fused NConv2d differs from the reference: {}'.format(diff)
+
+
+def create_framework_model(dcnet_arch, training_mode, confnet_arch, modality='rgbd'):
+    """Randomly initialized ConfidenceDepthFrameworkModel, like main.py builds it for training."""
+    import model_zoo.confidence_depth_framework as mc
+
+    return mc.ConfidenceDepthFrameworkFactory().create_model(modality, training_mode, dcnet_arch, '', confnet_arch,
+                                                             '', 'ged_depthcompnet', '')
+
+
+def bench_onnx(args, device):
+    import os
+    import tempfile
+
+    import export
+    import inference
+
+    print('{:>18} {:>12} {:>12} {:>8} {:>10}'.format('dcnet', 'torch [ms]', 'ort [ms]', 'speedup', 'max diff'))
+    for dcnet_arch in args.dcnet_archs:
+        if args.checkpoint:
+            cdfmodel = export.load_checkpoint_model(args.checkpoint)
+            dcnet_arch = cdfmodel.dc_arch
+        else:
+            cdfmodel = create_framework_model(dcnet_arch, args.training_mode, args.confnet_arch).eval()
+        model = export.create_inference_model(cdfmodel, None if args.checkpoint else args.training_mode)
+
+        fd, filename = tempfile.mkstemp(suffix='.onnx')
+        os.close(fd)
+        try:
+            export.export_onnx(model, filename, args.height, args.width, tolerance=args.tolerance)
+            session = inference.OnnxDepthCompletion(filename, args.threads, args.interop_threads)
+            input = export.example_input(args.batch_size, args.height, args.width)
+            torch_time = time_forward(lambda: model(input), torch.device('cpu'), args.warmup, args.iterations)
+            ort_time = time_forward(lambda: session(input), torch.device('cpu'), args.warmup, args.iterations)
+            with torch.no_grad():
+                diff = export.max_difference([session(input)[name] for name in model.output_names], model(input))
+        finally:
+            os.remove(filename)
+        print('{:>18} {:>12.2f} {:>12.2f} {:>7.2f}x {:>10.2e}'.format(dcnet_arch, torch_time, ort_time,
+                                                                      torch_time / ort_time, diff))
+        assert diff < args.tolerance, 'onnxruntime differs from torch: {}'.format(diff)
+        if args.checkpoint:
+            break
+
+
+def create_dc_model(dcnet_arch, modality='rgbd'):
+    import model_zoo.confidence_depth_framework as mc
+
+    return mc.ConfidenceDepthFrameworkFactory().create_dc_model(dcnet_arch, '', modality, 'd')
+
+
+def bench_fold(args, device):
+    import copy
+
+    import export
+    from model_zoo.inference_optimization import optimize_for_inference
+
+    print('{:>18} {:>12} {:>11} {:>12} {:>12} {:>8} {:>10}'.format('dcnet', 'mode', 'resolution', 'eager [ms]',
+                                                                   'folded [ms]', 'speedup', 'max diff'))
+    for dcnet_arch in args.dcnet_archs:
+        for training_mode in args.training_modes:
+            cdfmodel = create_framework_model(dcnet_arch, training_mode, args.confnet_arch)
+            model = export.InferenceModel(cdfmodel).to(device).eval()
+            optimized = optimize_for_inference(copy.deepcopy(model), channels_last=not args.no_channels_last)
+            for width, height in args.resolutions:
+                x = export.example_input(args.batch_size, height, width).to(device)
+                x_optimized = x if args.no_channels_last else x.contiguous(memory_format=torch.channels_last)
+                with torch.no_grad():
+                    diff = export.max_difference(optimized(x_optimized), model(x))
+                eager_time = time_forward(lambda: model(x), device, args.warmup, args.iterations)
+                folded_time = time_forward(lambda: optimized(x_optimized), device, args.warmup, args.iterations)
+                print('{:>18} {:>12} {:>11} {:>12.2f} {:>12.2f} {:>7.2f}x {:>10.2e}'.format(
+                    dcnet_arch, training_mode, '{}x{}'.format(width, height), eager_time, folded_time,
+                    eager_time / folded_time, diff))
+                assert diff < args.tolerance, 'optimized model differs from the eager one: {}'.format(diff)
+
+
+def saved_activation_bytes(fn):
+    """Bytes of the tensors that autograd keeps for the backward of fn() (parameters excluded) and the result."""
+    storages = {}
+
+    def pack(tensor):
+        if not (tensor.is_leaf and tensor.requires_grad):
+            storage = tensor.untyped_storage()
+            storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        result = fn()
+    return sum(storages.values()), result
+
+
+def bench_modes(args, device):
+    import model_zoo.confidence_depth_framework as mc
+
+    cdf = mc.ConfidenceDepthFrameworkFactory()
+    print('{:>14} {:>16} {:>16} {:>12} {:>12}'.format('mode', 'saved [MB] all', 'saved [MB] frozen', 'step [ms]',
+                                                      'frozen [ms]'))
+    for training_mode in args.training_modes:
+        cdfmodel = create_framework_model(args.dcnet_arch, training_mode, args.confnet_arch)
+        cdfmodel.opt_params()  # requires_grad=False on the frozen sub-nets
+        cdfmodel = cdfmodel.to(device).train()
+        criterion, _ = cdf.create_loss('l2', cdfmodel.use_loss_dc, 0.5 if cdfmodel.train_dc else 1.0)
+        depth, conf = sparse_depth_batch(args.batch_size, args.height, args.width, device)
+        input = torch.cat([torch.rand(args.batch_size, 3, args.height, args.width, device=device), depth, conf], 1)
+        target = torch.rand(args.batch_size, 1, args.height, args.width, device=device) * 10.0 + 1.0
+
+        def loss():
+            prediction = cdfmodel(input)
+            if prediction[2] is not None:
+                return criterion(input, prediction[0], prediction[2], target)
+            return criterion(input, prediction[0], target)
+
+        def step():
+            loss().backward()
+            cdfmodel.zero_grad(set_to_none=True)
+
+        saved, times = [], []
+        for frozen_no_grad in [False, True]:
+            cdfmodel.frozen_no_grad = frozen_no_grad
+            with torch.enable_grad():
+                saved.append(saved_activation_bytes(loss)[0] / 2.0 ** 20)
+            times.append(time_forward(step, device, args.warmup, args.iterations, grad=True))
+        print('{:>14} {:>16.1f} {:>16.1f} {:>12.2f} {:>12.2f}'.format(training_mode, saved[0], saved[1], times[0],
+                                                                      times[1]))
+
+
+def peak_memory_bytes(fn, device):
+    """Peak allocated memory of fn() on cuda, the activations saved for the backward on cpu."""
+    if device.type != 'cuda':
+        return saved_activation_bytes(fn)[0]
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    fn()
+    return torch.cuda.max_memory_allocated(device) - base
+
+
+def bench_checkpoint(args, device):
+    from model_zoo.checkpointing import set_checkpoint_stages
+
+    print('{:>18} {:>6} {:>12} {:>12} {:>12} {:>12}'.format('dcnet', 'batch', 'memory [MB]', 'ckpt [MB]',
+                                                            'step [ms]', 'ckpt [ms]'))
+    for dcnet_arch in args.dcnet_archs:
+        model = create_dc_model(dcnet_arch).to(device).train()
+        for batch_size in args.batch_sizes:
+            depth, _ = sparse_depth_batch(batch_size, args.height, args.width, device)
+            x = torch.cat([torch.rand(batch_size, 3, args.height, args.width, device=device), depth], 1)
+
+            def step():
+                depth1, features = model(x, True)
+                (depth1.sum() + features.sum()).backward()
+                model.zero_grad(set_to_none=True)
+
+            memory, times = [], []
+            for stages in [[], args.stages]:
+                set_checkpoint_stages(model, stages)
+                with torch.enable_grad():
+                    memory.append(peak_memory_bytes(step, device) / 2.0 ** 20)
+                times.append(time_forward(step, device, args.warmup, args.iterations, grad=True))
+            print('{:>18} {:>6} {:>12.1f} {:>12.1f} {:>12.2f} {:>12.2f}'.format(dcnet_arch, batch_size, memory[0],
+                                                                              memory[1], times[0], times[1]))
+
+
+def bench_amp(args, device):
+    import copy
+
+    from metrics import Result
+
+    modes = [amp for amp in runtime.amp_modes if amp == 'none' or amp in args.amp]
+    print('{:>18} {:>6} {:>14} {:>10} {:>12} {:>10}'.format('dcnet', 'amp', 'train [img/s]', 'speedup', 'RMSE vs fp32',
+                                                            'delta1'))
+    for dcnet_arch in args.dcnet_archs:
+        model = create_dc_model(dcnet_arch).to(device)
+        depth, _ = sparse_depth_batch(args.batch_size, args.height, args.width, device)
+        x = torch.cat([torch.rand(args.batch_size, 3, args.height, args.width, device=device), depth], 1)
+        model.eval()
+        with torch.no_grad():
+            reference = model(x, False)[0].float()
+        # the timed train steps update the batch norm statistics, each precision is evaluated with the initial ones
+        state = copy.deepcopy(model.state_dict())
+
+        baseline = None
+        for amp in modes:
+            scaler = runtime.grad_scaler(device, amp)
+
+            def step():
+                with runtime.autocast(device, amp):
+                    depth1, _ = model(x, False)
+                scaler.scale(depth1.float().abs().mean()).backward()
+                model.zero_grad(set_to_none=True)
+
+            model.train()
+            step_time = time_forward(step, device, args.warmup, args.iterations, grad=True)
+            throughput = args.batch_size * 1000.0 / step_time
+            baseline = baseline or throughput
+            model.load_state_dict(state)
+            model.eval()
+            with torch.no_grad(), runtime.autocast(device, amp):
+                output = model(x, False)[0]
+            result = Result()
+            result.evaluate(output.float(), reference)
+            print('{:>18} {:>6} {:>14.2f} {:>9.2f}x {:>12.3e} {:>10.4f}'.format(dcnet_arch, amp, throughput,
+                                                                              throughput / baseline, result.rmse,
+                                                                              result.delta1))
+
+
+def resolution(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Model benchmarks')
+    parser.add_argument('--device', default='auto', type=str,
+                        help='device: ' + ' | '.join(runtime.device_names) + ' | cuda:N (default: auto)')
+    parser.add_argument('--threads', default=0, type=int, help='intra-op CPU threads, 0 keeps the default')
+    parser.add_argument('--interop-threads', default=0, type=int, help='inter-op CPU threads, 0 keeps the default')
+    parser.add_argument('--height', default=240, type=int, help='input height (default: 240)')
+    parser.add_argument('--width', default=320, type=int, help='input width (default: 320)')
+    parser.add_argument('--warmup', default=3, type=int, help='untimed iterations (default: 3)')
+    parser.add_argument('--iterations', default=10, type=int, help='timed iterations (default: 10)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    unguided = subparsers.add_parser('unguided', help='nconv_sd.CNN forward latency: max-pool gather loop vs gather')
+    unguided.add_argument('--batch-sizes', default=[1, 2, 4, 8, 16], type=int, nargs='+',
+                          help='batch sizes to time (default: 1 2 4 8 16)')
+    unguided.set_defaults(func=bench_unguided)
+
+    nconv = subparsers.add_parser('nconv', help='NConv2d fused vs reference: numerical parity and per-layer timing')
+    nconv.add_argument('--batch-size', default=8, type=int, help='batch size (default: 8)')
+    nconv.add_argument('--tolerance', default=1e-3, type=float,
+                       help='largest accepted difference of outputs and gradients (default: 1e-3)')
+    nconv.set_defaults(func=bench_nconv)
+
+    dcnet_archs = ['resnet18', 'udepthcompnet18', 'gudepthcompnet18', 'gms_depthcompnet', 'ged_depthcompnet']
+    onnx = subparsers.add_parser('onnx', help='ONNX export on onnxruntime vs torch on cpu: parity and latency')
+    onnx.add_argument('--checkpoint', default='', type=str, help='checkpoint to export instead of random models')
+    onnx.add_argument('--dcnet-archs', default=dcnet_archs, nargs='+', choices=dcnet_archs,
+                      help='dc nets to export (default: all)')
+    onnx.add_argument('--training-mode', default='dc1-cf1-ln0', type=str,
+                      help='training mode of the random models (default: dc1-cf1-ln0)')
+    onnx.add_argument('--confnet-arch', default='cbr3-c1', type=str, help='confidence head (default: cbr3-c1)')
+    onnx.add_argument('--batch-size', default=1, type=int, help='batch size (default: 1)')
+    onnx.add_argument('--tolerance', default=1e-3, type=float, help='largest accepted difference (default: 1e-3)')
+    onnx.set_defaults(func=bench_onnx)
+
+    fold = subparsers.add_parser('fold', help='optimize_for_inference (folded BN, fixed flag, channels-last) vs eager')
+    fold.add_argument('--dcnet-archs', default=dcnet_archs, nargs='+', choices=dcnet_archs,
+                      help='dc nets to time (default: all)')
+    fold.add_argument('--training-modes', default=['dc1_only', 'dc1-cf1-ln0'], nargs='+',
+                      help='inference graphs: the dc net alone and with the confidence net '
+                           '(default: dc1_only dc1-cf1-ln0)')
+    fold.add_argument('--confnet-arch', default='cbr3-c1', type=str, help='confidence head (default: cbr3-c1)')
+    fold.add_argument('--resolutions', default=[(320, 240), (1216, 352)], type=resolution, nargs='+',
+                      metavar='WxH', help='input resolutions (default: 320x240 1216x352)')
+    fold.add_argument('--batch-size', default=1, type=int, help='batch size (default: 1)')
+    fold.add_argument('--no-channels-last', action='store_true', help='keep the contiguous memory format')
+    fold.add_argument('--tolerance', default=1e-3, type=float, help='largest accepted difference (default: 1e-3)')
+    fold.set_defaults(func=bench_fold)
+
+    checkpoint = subparsers.add_parser('checkpoint', help='training step of the dc nets with and without activation '
+                                                          'checkpointing: peak memory and time vs batch size')
+    checkpoint.add_argument('--dcnet-archs', default=['gms_depthcompnet', 'udepthcompnet18', 'gudepthcompnet18'],
+                            nargs='+', choices=dcnet_archs,
+                            help='dc nets (default: gms_depthcompnet udepthcompnet18 gudepthcompnet18)')
+    checkpoint.add_argument('--batch-sizes', default=[1, 2, 4, 6, 8], type=int, nargs='+',
+                            help='batch sizes (default: 1 2 4 6 8)')
+    checkpoint.add_argument('--stages', default=['all'], nargs='+', help='checkpointed stages (default: all)')
+    checkpoint.set_defaults(func=bench_checkpoint)
+
+    amp = subparsers.add_parser('amp', help='mixed-precision training throughput and output difference to float32')
+    amp.add_argument('--dcnet-archs', default=dcnet_archs, nargs='+', choices=dcnet_archs,
+                     help='dc nets (default: all)')
+    amp.add_argument('--amp', default=['bf16', 'fp16'], nargs='+', choices=runtime.amp_modes[1:],
+                     help='precisions compared with float32 (default: bf16 fp16)')
+    amp.add_argument('--batch-size', default=4, type=int, help='batch size (default: 4)')
+    amp.set_defaults(func=bench_amp)
+
+    training_modes = ['dc1_only', 'dc1-ln0', 'dc1-ln1', 'dc0-cf1-ln0', 'dc1-cf1-ln0', 'dc0-cf1-ln1', 'dc1-cf1-ln1']
+    modes = subparsers.add_parser('modes', help='training step per training mode, frozen sub-nets with and without '
+                                                'autograd: saved activations and step time')
+    modes.add_argument('--training-modes', default=training_modes, nargs='+', choices=training_modes,
+                       help='training modes (default: all)')
+    modes.add_argument('--dcnet-arch', default='gudepthcompnet18', choices=dcnet_archs,
+                       help='dc net, the loss net is ged_depthcompnet (default: gudepthcompnet18)')
+    modes.add_argument('--confnet-arch', default='cbr3-c1', type=str, help='confidence head (default: cbr3-c1)')
+    modes.add_argument('--batch-size', default=2, type=int, help='batch size (default: 2)')
+    modes.set_defaults(func=bench_modes)
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    args.func(args, runtime.setup(args))
+
+
+if __name__ == '__main__':
+    main()
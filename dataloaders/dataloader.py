@@ -1,3 +1,4 @@
+import math
 import os
 import os.path
 import numpy as np
@@ -32,11 +33,54 @@ def make_dataset(dir, class_to_idx):
                     images.append(item)
     return images
 
-def h5_loader(path):
-    h5f = h5py.File(path, "r")
-    rgb = np.array(h5f['rgb'])
+def crop_window(src_size, crop_size, scale=1.0, max_angle=0.0, region=None, margin=2):
+    """Smallest centred window of the source that a transform ending with a centred crop reads from.
+
+    Args:
+        src_size: (h, w) of the source image.
+        crop_size: (h, w) of the final center crop.
+        scale: smallest total resize factor applied before the crop.
+        max_angle: largest rotation (degrees) applied before the crop.
+        region: (i, j, h, w) sub-image the transform starts from (default: the whole source).
+        margin: extra pixels on each side for the interpolation support.
+
+    Returns:
+        tuple: (i, j, h, w) of the window, inside the region and centred on it. The offset to the region border is
+        kept a multiple of 2 pixels, so the rotation centre and the rounding of the center crop do not move.
+    """
+    if region is None:
+        region = (0, 0) + tuple(src_size)
+    ri, rj, rh, rw = region
+    angle = math.radians(abs(max_angle))
+    th, tw = crop_size[0] / scale, crop_size[1] / scale
+    # bounding box of the rotated crop footprint
+    h = th * math.cos(angle) + tw * math.sin(angle)
+    w = tw * math.cos(angle) + th * math.sin(angle)
+    h = int(math.ceil(h)) + 2 * margin
+    w = int(math.ceil(w)) + 2 * margin
+    h = min(rh, h + (rh - h) % 4)
+    w = min(rw, w + (rw - w) % 4)
+    return ri + (rh - h) // 2, rj + (rw - w) // 2, h, w
+
+
+def h5_loader(path, window_fn=None):
+    """Reads rgb (H x W x C) and depth (H x W) from an h5 file.
+
+    window_fn(height, width) may return the (i, j, h, w) window that is needed, in which case only that hyperslab is
+    read and decompressed.
+    """
+    with h5py.File(path, "r") as h5f:
+        window = None
+        if window_fn is not None:
+            window = window_fn(*h5f['depth'].shape)
+        if window is None:
+            rgb = np.array(h5f['rgb'])
+            depth = np.array(h5f['depth'])
+        else:
+            i, j, h, w = window
+            rgb = h5f['rgb'][:, i:i + h, j:j + w]
+            depth = h5f['depth'][i:i + h, j:j + w]
     rgb = np.transpose(rgb, (1, 2, 0))
-    depth = np.array(h5f['depth'])
     return rgb, depth
 
 # def rgb2grayscale(rgb):
@@ -48,7 +92,7 @@ class MyDataloader(data.Dataset):
     modality_names = ['rgb', 'rgb-fd', 'fd'] # , 'g', 'gd'
     color_jitter = transforms.ColorJitter(0.4, 0.4, 0.4)
 
-    def __init__(self, root, type, sparsifier=None, modality='rgb', loader=h5_loader):
+    def __init__(self, root, type, sparsifier=None, modality='rgb', loader=h5_loader, crop_on_read=False):
         classes, class_to_idx = find_classes(root)
         imgs = make_dataset(root, class_to_idx)
         assert len(imgs)>0, "Found 0 images in subfolders of: " + root + "\n"
@@ -64,8 +108,11 @@ class MyDataloader(data.Dataset):
         else:
             raise (RuntimeError("Invalid dataset type: " + type + "\n"
                                 "Supported dataset types are: train, val"))
+        self.type = type
         self.loader = loader
         self.sparsifier = sparsifier
+        # read only the window used by the transform (see read_window), the loader must accept a window_fn
+        self.crop_on_read = crop_on_read
 
 
         assert (modality in self.modality_names), "Invalid modality type: " + modality + "\n" + \
@@ -80,6 +127,10 @@ class MyDataloader(data.Dataset):
     def val_transform(rgb, depth):
         raise (RuntimeError("val_transform() is not implemented."))
 
+    def read_window(self, height, width):
+        """Window (i, j, h, w) of a height x width source that the transform needs, None to read everything."""
+        return None
+
     def create_sparse_depth(self, rgb, depth):
         if self.sparsifier is None:
             return depth
@@ -103,7 +154,10 @@ class MyDataloader(data.Dataset):
             tuple: (rgb, depth) the raw data.
         """
         path, target = self.imgs[index]
-        rgb, depth = self.loader(path)
+        if self.crop_on_read:
+            rgb, depth = self.loader(path, self.read_window)
+        else:
+            rgb, depth = self.loader(path)
         return rgb, depth
 
     def __getitem__(self, index):
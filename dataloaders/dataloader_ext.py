@@ -108,6 +108,23 @@ def rgb2grayscale(rgb):
     return rgb[0,:,:] * 0.2989 + rgb[1,:,:] * 0.587 + rgb[2,:,:] * 0.114
 
 
+# channels of 'dense_image_data' used by each modality token, channel 0 is the ground-truth depth
+dense_image_channels = {'dor': (1,), 'dore': (1, 2), 'd3dwor': (3,), 'dvor': (2,), 'd2dwor': (5,),
+                        'dde': (4,), 'ddee': (4, 2), 'd3dwde': (6,), 'wdde': (4,)}
+
+
+def read_dense_channels(dense_data, channels):
+    """Reads the requested channels of a C x H x W dataset with one hyperslab selection.
+
+    Returns a dict channel -> H x W array. All the channels share one preallocated buffer, so each h5 chunk is
+    read and decompressed only once.
+    """
+    channels = sorted(set(channels))
+    buffer = np.empty((len(channels),) + tuple(dense_data.shape[1:]), dtype=dense_data.dtype)
+    dense_data.read_direct(buffer, np.s_[channels, :, :])
+    return {channel: buffer[i] for i, channel in enumerate(channels)}
+
+
 class Modality:
 
     depth_channels_names = ['fd','kfd', 'kor', 'kde', 'kgt']
@@ -304,6 +321,14 @@ class MyDataloaderExt(data.Dataset):
 
 
 
+    @staticmethod
+    def needed_dense_channels(type):
+        channels = {0}
+        for token, token_channels in dense_image_channels.items():
+            if token in type:
+                channels.update(token_channels)
+        return channels
+
 #pose = none | gt | slam
     def h5_loader_general(self,img_path,extra_path,type,pose='none'):
         result = dict()
@@ -314,9 +339,10 @@ class MyDataloaderExt(data.Dataset):
             h5fextra = h5py.File(extra_path, "r")
 
         #target depth
+        dense_channels = None
         if 'dense_image_data' in h5f:
-            dense_data = h5f['dense_image_data']
-            depth = np.array(dense_data[0, :, :])
+            dense_channels = read_dense_channels(h5f['dense_image_data'], self.needed_dense_channels(type))
+            depth = dense_channels[0]
             mask_array = depth > 10000 # in this software inf distance is zero.
             depth[mask_array] = 0
             result['gt_depth'] = depth
@@ -459,36 +485,37 @@ class MyDataloaderExt(data.Dataset):
             result['kw'] = kw_input
 
 
-        if 'dor' in type:
-            result['dor'] = np.array(dense_data[1, :, :])
+        if dense_channels is not None:
+            if 'dor' in type:
+                result['dor'] = dense_channels[1]
 
-        if 'dore' in type:
-            result['dore'] = np.array(dense_data[1, :, :])
-            dore_mask = result['dore'] < epsilon
-            result['dore'][dore_mask] = np.array(dense_data[2, :, :])[dore_mask]
+            if 'dore' in type:
+                result['dore'] = dense_channels[1].copy()
+                dore_mask = result['dore'] < epsilon
+                result['dore'][dore_mask] = dense_channels[2][dore_mask]
 
-        if 'd3dwor' in type:
-            result['d3dwor'] = np.array(dense_data[3, :, :])
+            if 'd3dwor' in type:
+                result['d3dwor'] = dense_channels[3]
 
-        if 'dvor' in type:
-            result['dvor'] = np.array(dense_data[2, :, :])
+            if 'dvor' in type:
+                result['dvor'] = dense_channels[2]
 
-        if 'd2dwor' in type:
-            result['d2dwor'] = np.array(dense_data[5, :, :])
+            if 'd2dwor' in type:
+                result['d2dwor'] = dense_channels[5]
 
-        if 'dde' in type:
-            result['dde'] = np.array(dense_data[4, :, :])
+            if 'dde' in type:
+                result['dde'] = dense_channels[4]
 
-        if 'ddee' in type:
-            result['ddee'] = np.array(dense_data[4, :, :])
-            dore_mask = result['ddee'] < epsilon
-            result['ddee'][dore_mask] = np.array(dense_data[2, :, :])[dore_mask]
+            if 'ddee' in type:
+                result['ddee'] = dense_channels[4].copy()
+                dore_mask = result['ddee'] < epsilon
+                result['ddee'][dore_mask] = dense_channels[2][dore_mask]
 
-        if 'd3dwde' in type:
-            result['d3dwde'] = np.array(dense_data[6, :, :])
+            if 'd3dwde' in type:
+                result['d3dwde'] = dense_channels[6]
 
-        if 'wdde' in type:
-            result['wdde'] = np.array(dense_data[4, :, :])
+            if 'wdde' in type:
+                result['wdde'] = dense_channels[4]
 
         return result
 
@@ -3,11 +3,14 @@ import torch
 import numpy as np
 from dataloaders.dense_to_sparse import UniformSampling, SimulatedStereo
 
+# data_type values of create_data_loaders
+data_types = ['visim', 'visim_seq', 'kitti', 'nyu', 'kitti_h5', 'dji']
+
 
 def create_data_loaders(data_path, data_type='visim', loader_type='val', arch='', sparsifier_type='uar',
                         num_samples=500,
                         modality='rgb-fd', depth_divisor=1, max_depth=-1, max_gt_depth=-1, batch_size=8, workers=8,
-                        width=320, height=240):
+                        width=320, height=240, cache_dir=None, pin_memory=True, crop_on_read=False):
     # Data loading code
     print("\033[31m=> creating data loaders\033[0m")
     # legacy compatibility with sparse-to-dense data folder
@@ -17,6 +20,9 @@ def create_data_loaders(data_path, data_type='visim', loader_type='val', arch=''
     if not os.path.exists(data_path):
         raise RuntimeError('Data source does not exit:{}'.format(data_path))
 
+    if crop_on_read and data_type not in ['nyu', 'kitti_h5']:
+        raise RuntimeError('crop on read is only supported by the nyu and kitti_h5 data types')
+
     loader = None
     dataset = None
     max_depth = max_depth if max_depth >= 0.0 else np.inf
@@ -31,7 +37,7 @@ def create_data_loaders(data_path, data_type='visim', loader_type='val', arch=''
 
     if data_type == 'kitti':
         from dataloaders.kitti_loader import KittiDepth
-        dataset = KittiDepth(data_path, split=loader_type, depth_divisor=depth_divisor)
+        dataset = KittiDepth(data_path, split=loader_type, depth_divisor=depth_divisor, cache_dir=cache_dir)
     elif data_type == 'visim':
         from dataloaders.visim_dataloader import VISIMDataset
         dataset = VISIMDataset(data_path, type=loader_type, modality=modality, sparsifier=sparsifier,
@@ -40,22 +46,31 @@ def create_data_loaders(data_path, data_type='visim', loader_type='val', arch=''
         from dataloaders.visim_dataloader import VISIMSeqDataset
         dataset = VISIMSeqDataset(data_path, type=loader_type, modality=modality, sparsifier=sparsifier,
                                   depth_divider=depth_divisor, is_resnet=('resnet' in arch), max_gt_depth=max_gt_depth)
+    elif data_type in ['nyu', 'kitti_h5']:
+        # h5 files of the sparse-to-dense layout: data_path/train and data_path/val, rgb and sparse depth inputs
+        from dataloaders.nyu_dataloader import NYUDataset
+        from dataloaders.kitti_dataloader import KITTIDataset
+        dataset_class = NYUDataset if data_type == 'nyu' else KITTIDataset
+        dataset = dataset_class(os.path.join(data_path, loader_type), type=loader_type, sparsifier=sparsifier,
+                                modality='rgb-fd', arch=arch or 'depthcompnet', depth_divider=depth_divisor,
+                                crop_on_read=crop_on_read)
     elif data_type == 'dji':
         from dataloaders.datasets import MVSDataset
         dataset = MVSDataset(data_path, loader_type, "gt", height=height, width=width,
                              tuples_ext='dso_optimization_windows', ignore_pose_scale=True, tuples_default_flag=False,
                              tuples_default_frame_num=3, tuples_default_frame_dist=20, depth_min=100, depth_max=250)
     else:
-        raise RuntimeError('data type not found.' + 'The dataset must be either of kitti, visim or visim_seq.')
+        raise RuntimeError('data type not found.' + 'The dataset must be either of kitti, visim, visim_seq, nyu, '
+                           'kitti_h5 or dji.')
 
     if loader_type == 'val':
         # set batch size to be 1 for validation
         loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers,
-                                             pin_memory=True)
+                                             pin_memory=pin_memory)
         print("=> Val loader:{}".format(len(dataset)))
     elif loader_type == 'train':
         loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=workers,
-                                             pin_memory=True, sampler=None,
+                                             pin_memory=pin_memory, sampler=None,
                                              worker_init_fn=lambda work_id: np.random.seed(work_id))
         print("=> Train loader:{}".format(len(dataset)))
         # worker_init_fn ensures different sampling patterns for each data loading thread
@@ -0,0 +1,132 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+def weights_fingerprint(model):
+    """Cheap checksum of the parameters and buffers of model, detects a cache built by other weights."""
+    with torch.no_grad():
+        return [float(t.double().sum()) for t in model.state_dict().values() if t.is_floating_point()]
+
+
+class FeatureCacheLoader(object):
+    """Replays the batches of a split together with the outputs of a frozen dc net.
+
+    build() runs the dc net once over the wrapped loader and stores, per sample, the (input, target, scale) fields and
+    the dc outputs (depth1 in float32, the build_conf_input features in float16) in .npy shards that are read back with
+    mmap. The iterations then yield (input, target, scale, (depth1, features)) and the framework skips the dc net
+    (ConfidenceDepthFrameworkModel.forward(input, dc_output)). Only valid for a frozen dc net (dc0 training modes) and
+    a deterministic loader: the stored samples freeze one draw of the augmentation and of the sparsifier, so it is
+    meant for the validation split (every train split of dataloader_factory draws new ones at every epoch).
+    depth1 keeps the precision of the uncached run, the reported metrics are computed on it; the float16 features
+    only feed the confidence net.
+
+    Args:
+        loader: the DataLoader of the split.
+        cache_dir: folder of the shards, reused by later runs when it was built by the same weights from the same
+            data (see build).
+        shuffle: shuffles the shard order and the samples inside each shard at every iteration.
+        shard_samples: samples per shard file, rounded down to a multiple of the batch size.
+    """
+
+    fields = ['input', 'target', 'scale', 'depth1', 'features']
+    meta_file = 'meta.json'
+    version = 2  # 1: depth1 stored in float16
+
+    def __init__(self, loader, cache_dir, shuffle=False, shard_samples=256):
+        self.loader = loader
+        self.cache_dir = cache_dir
+        self.shuffle = shuffle
+        # whole batches per shard, only the last shard can end with a smaller batch
+        self.shard_samples = max(1, shard_samples // loader.batch_size) * loader.batch_size
+        self.batch_size = loader.batch_size
+        # the wrapped loader can be another cache (dataloaders.tensor_cache.TensorCacheLoader)
+        self.num_samples = getattr(loader, 'num_samples', None) or len(loader.dataset)
+        self.shards = None
+
+    def __len__(self):
+        full_shards, rest = divmod(self.num_samples, self.shard_samples)
+        return full_shards * (self.shard_samples // self.batch_size) + (rest + self.batch_size - 1) // self.batch_size
+
+    def _shard_filename(self, field, index):
+        return os.path.join(self.cache_dir, '{}_{:04d}.npy'.format(field, index))
+
+    def _load_meta(self):
+        filename = os.path.join(self.cache_dir, self.meta_file)
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            return json.load(f)
+
+    def _open_shards(self, num_shards):
+        self.shards = [[np.load(self._shard_filename(field, k), mmap_mode='r') for field in self.fields]
+                       for k in range(num_shards)]
+
+    def build(self, dc_model, input_size, build_conf_input, device, source=None):
+        """Runs dc_model over the split unless the cache folder already holds its outputs for the same weights.
+
+        source: JSON-serializable description of the data and of the dc net (data path, modality, number of sparse
+        samples, checkpoint...), stored in the meta file; a folder built from another source is rebuilt.
+        """
+        fingerprint = weights_fingerprint(dc_model)
+        source = json.loads(json.dumps(source))  # as read back from the meta file (tuples become lists)
+        meta = self._load_meta()
+        if meta is not None and meta['num_samples'] == self.num_samples and \
+                meta['shard_samples'] == self.shard_samples and meta['fingerprint'] == fingerprint and \
+                meta.get('source') == source and meta.get('version') == self.version:
+            print('=> using the feature cache in {}'.format(self.cache_dir))
+            self._open_shards(meta['num_shards'])
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        was_training = dc_model.training
+        dc_model.eval()
+        shard, shard_index, position, total_bytes = None, 0, 0, 0
+        with torch.no_grad():
+            for input, target, scale in self.loader:
+                depth1, features = dc_model(input.to(device)[:, :input_size, :, :], build_conf_input)
+                if features is None:
+                    raise RuntimeError('the dc net has no features for a confidence net')
+                batch = [input, target, torch.as_tensor(scale), depth1.float().cpu(), features.half().cpu()]
+                for i in range(input.size(0)):
+                    if shard is None:
+                        size = min(self.shard_samples, self.num_samples - shard_index * self.shard_samples)
+                        shard = [np.lib.format.open_memmap(self._shard_filename(field, shard_index), mode='w+',
+                                                           dtype=x[:0].numpy().dtype,
+                                                           shape=(size,) + tuple(x.shape[1:]))
+                                 for field, x in zip(self.fields, batch)]
+                        total_bytes += sum(x.nbytes for x in shard)
+                    for array, x in zip(shard, batch):
+                        array[position] = x[i].numpy()
+                    position += 1
+                    if position == len(shard[0]):
+                        for array in shard:
+                            array.flush()
+                        shard, shard_index, position = None, shard_index + 1, 0
+        dc_model.train(was_training)
+
+        meta = {'num_samples': self.num_samples, 'shard_samples': self.shard_samples, 'num_shards': shard_index,
+                'fingerprint': fingerprint, 'source': source, 'version': self.version}
+        with open(os.path.join(self.cache_dir, self.meta_file), 'w') as f:
+            json.dump(meta, f)
+        print('=> cached the dc outputs of {} samples ({:.1f} MB) in {}'.format(self.num_samples, total_bytes / 2 ** 20,
+                                                                              self.cache_dir))
+        self._open_shards(shard_index)
+
+    def _batch(self, shard, indexes):
+        fields = [torch.from_numpy(np.ascontiguousarray(array[indexes])) for array in shard]
+        input, target, scale, depth1, features = fields
+        return input, target, scale, (depth1.float(), features.float())
+
+    def __iter__(self):
+        assert self.shards is not None, 'build() the feature cache first'
+        order = np.random.permutation(len(self.shards)) if self.shuffle else range(len(self.shards))
+        for k in order:
+            shard = self.shards[k]
+            size = len(shard[0])
+            indexes = np.random.permutation(size) if self.shuffle else np.arange(size)
+            for begin in range(0, size, self.batch_size):
+                # sorted indexes read the mmap in file order
+                yield self._batch(shard, np.sort(indexes[begin:begin + self.batch_size]))
@@ -0,0 +1,83 @@
+"""Rewrites the dataset h5 files with a chunk layout matching the loaders.
+
+MyDataloaderExt reads a subset of the 'dense_image_data' channels (see dataloader_ext.read_dense_channels) and the
+whole rgb image. With one chunk per dense channel each requested channel is decompressed exactly once and the
+unused channels are never touched; the images are stored as a single chunk and the small datasets (poses,
+landmarks) stay contiguous.
+
+usage: python -m dataloaders.h5_layout SRC_FOLDER DST_FOLDER [--compression gzip] [--level 4]
+       python -m dataloaders.h5_layout SRC_FOLDER --in-place
+"""
+import argparse
+import glob
+import os
+
+import h5py
+import numpy as np
+
+per_channel_datasets = ['dense_image_data']
+single_chunk_datasets = ['rgb_image_data', 'rgb', 'depth', 'normal_data']
+
+
+def dataset_chunks(name, shape):
+    if name in per_channel_datasets and len(shape) == 3:
+        return (1,) + tuple(shape[1:])
+    if name in single_chunk_datasets and len(shape) > 0:
+        return tuple(shape)
+    return None
+
+
+def relayout_file(src_path, dst_path, compression='gzip', level=4):
+    with h5py.File(src_path, 'r') as src, h5py.File(dst_path, 'w') as dst:
+        for key, value in src.attrs.items():
+            dst.attrs[key] = value
+        for name, dataset in src.items():
+            if not isinstance(dataset, h5py.Dataset):
+                src.copy(dataset, dst, name=name)
+                continue
+            data = np.array(dataset)
+            chunks = dataset_chunks(name, data.shape)
+            if chunks is None:
+                out = dst.create_dataset(name, data=data)
+            else:
+                out = dst.create_dataset(name, data=data, chunks=chunks, compression=compression,
+                                         compression_opts=level if compression == 'gzip' else None)
+            for key, value in dataset.attrs.items():
+                out.attrs[key] = value
+
+
+def relayout_folder(src_folder, dst_folder=None, compression='gzip', level=4):
+    files = sorted(glob.glob(os.path.join(src_folder, '**', '*.h5'), recursive=True))
+    for i, src_path in enumerate(files):
+        if dst_folder is None:
+            dst_path = src_path + '.tmp'
+        else:
+            dst_path = os.path.join(dst_folder, os.path.relpath(src_path, src_folder))
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        relayout_file(src_path, dst_path, compression, level)
+        if dst_folder is None:
+            os.replace(dst_path, src_path)
+        print('[{}/{}] {}'.format(i + 1, len(files), src_path))
+    return len(files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rewrite h5 dataset files with per-channel chunking')
+    parser.add_argument('src', metavar='SRC_FOLDER', help='folder with the h5 files (searched recursively)')
+    parser.add_argument('dst', metavar='DST_FOLDER', nargs='?', default=None,
+                        help='output folder, the folder structure is kept')
+    parser.add_argument('--in-place', action='store_true', help='replace the source files')
+    parser.add_argument('--compression', default='gzip', choices=['gzip', 'lzf', 'none'],
+                        help='chunk compression filter (default: gzip)')
+    parser.add_argument('--level', default=4, type=int, help='gzip compression level (default: 4)')
+    args = parser.parse_args()
+
+    if (args.dst is None) == (not args.in_place):
+        parser.error('give either DST_FOLDER or --in-place')
+    compression = None if args.compression == 'none' else args.compression
+    num_files = relayout_folder(args.src, args.dst, compression, args.level)
+    print('=> rewrote {} files'.format(num_files))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,15 @@
 import numpy as np
 
 import dataloaders.transforms as transforms
-from dataloaders.dataloader import MyDataloader
+from dataloaders.dataloader import MyDataloader, crop_window
 
 
 class KITTIDataset(MyDataloader):
-    def __init__(self, root, type, sparsifier=None, modality='rgb', arch='resnet18',depth_divider=1.0):
-        super(KITTIDataset, self).__init__(root, type, sparsifier, modality)
+    region = (130, 10, 240, 1200)  # (i, j, h, w) of the raw image that is used
+
+    def __init__(self, root, type, sparsifier=None, modality='rgb', arch='resnet18',depth_divider=1.0,
+                 crop_on_read=False):
+        super(KITTIDataset, self).__init__(root, type, sparsifier, modality, crop_on_read=crop_on_read)
 
         self.depth_divider = depth_divider
         self.arch = arch
@@ -16,6 +19,19 @@ class KITTIDataset(MyDataloader):
         else:
             self.output_size = (240, 960)
 
+    def read_window(self, height, width):
+        # train_transform resizes after the crop, on a window the nearest-neighbour grid and the rounding of the
+        # output size would differ from the full image, so the train split reads everything
+        if self.type == 'train':
+            return None
+        return crop_window((height, width), self.output_size, region=self.region, margin=0)
+
+    def region_crop(self):
+        # with crop on read the loaded val window is already inside the region and centred on it
+        if self.crop_on_read and self.type == 'val':
+            return []
+        return [transforms.Crop(*self.region)]
+
     def train_transform(self, rgb, depth):
         s = np.random.uniform(1.0, 1.5)  # random scaling
         depth_np = depth / (s*self.depth_divider)
@@ -23,8 +39,7 @@ class KITTIDataset(MyDataloader):
         do_flip = np.random.uniform(0.0, 1.0) < 0.5  # random horizontal flip
 
         # perform 1st step of data augmentation
-        transform = transforms.Compose([
-            transforms.Crop(130, 10, 240, 1200),
+        transform = transforms.Compose(self.region_crop() + [
             transforms.Rotate(angle),
             transforms.Resize(s),
             transforms.CenterCrop(self.output_size),
@@ -42,8 +57,7 @@ class KITTIDataset(MyDataloader):
 
     def val_transform(self, rgb, depth):
         depth_np = depth/ (self.depth_divider)
-        transform = transforms.Compose([
-            transforms.Crop(130, 10, 240, 1200),
+        transform = transforms.Compose(self.region_crop() + [
             transforms.CenterCrop(self.output_size),
         ])
         rgb_np = transform(rgb)
@@ -2,10 +2,13 @@
 #license MIT
 
 import glob
+import hashlib
 import os
 import os.path
+import tempfile
 from random import choice
 
+import cv2
 import numpy as np
 import torch
 import torch.utils.data as data
@@ -48,9 +51,18 @@ def get_paths_and_transform(split, args):
 
     if glob_gt is not None:
         glob_gt = os.path.join(root_d,glob_gt)
-        paths_gt = sorted(glob.glob(glob_gt))
-        paths_d = [p.replace(pattern_d[0],pattern_d[1]) for p in paths_gt]
-        paths_rgb = [get_rgb_paths(p) for p in paths_gt]
+        index_dir = args.cache_dir if args.cache_dir is not None else default_index_dir(root_d)
+        index_file = os.path.join(index_dir, 'path_index_{}_{}.npz'.format(split, args.val if split == 'val' else 'all'))
+        dirs = path_index_dirs(glob_gt)
+        paths = load_path_index(index_file, glob_gt, dirs)
+        if paths is None:
+            paths_gt = sorted(glob.glob(glob_gt))
+            paths_d = [p.replace(pattern_d[0],pattern_d[1]) for p in paths_gt]
+            paths_rgb = [get_rgb_paths(p) for p in paths_gt]
+            paths = {"rgb": paths_rgb, "d": paths_d, "gt": paths_gt}
+            paths = {key: encode_paths(value, args.data_folder) for key, value in paths.items()}
+            save_path_index(index_file, glob_gt, dirs, paths)
+        paths_rgb, paths_d, paths_gt = paths["rgb"], paths["d"], paths["gt"]
     else: # test and only has d or rgb
         raise ValueError("Unrecognized glob_gt ")
 
@@ -65,9 +77,72 @@ def get_paths_and_transform(split, args):
     if len(paths_rgb) != len(paths_d) or len(paths_rgb) != len(paths_gt):
         raise(RuntimeError("Produced different sizes for datasets"))
 
-    paths = {"rgb":paths_rgb, "d":paths_d, "gt":paths_gt}
     return paths, transform
 
+# bump when the content of the path index changes
+path_index_version = 2
+
+# path indexes of the runs without --data-cache, the data folder can be read-only or shared
+path_index_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                                    'aerial_depth_completion', 'kitti_path_index')
+
+def default_index_dir(root_d):
+    # one folder per data folder, the index files only carry the split in their name
+    digest = hashlib.sha1(os.path.abspath(root_d).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(path_index_cache_dir, digest)
+
+def path_index_dirs(glob_gt):
+    """Directories whose mtime changes when a file matching glob_gt is added or removed.
+
+    These are all the directories the glob lists: the last literal directory of the pattern and every match of each
+    deeper directory level (e.g. train, */, */proj_depth, */proj_depth/groundtruth and the image folders).
+    """
+    parts = os.path.dirname(glob_gt).split(os.sep)
+    first = next((i for i, part in enumerate(parts) if any(c in part for c in '*?[')), len(parts))
+    dirs = []
+    for end in range(first, len(parts) + 1):
+        dirs += glob.glob(os.sep.join(parts[:end]))
+    return sorted(set(dirs))
+
+def encode_paths(paths, root):
+    """Paths relative to root as a compact numpy bytes array."""
+    return np.array([os.path.relpath(p, root).encode('utf-8') for p in paths], dtype=np.bytes_)
+
+def decode_path(path, root):
+    return os.path.join(root, path.decode('utf-8'))
+
+def load_path_index(index_file, glob_gt, dirs):
+    """Returns the cached paths, or None when the index is missing or any of the dirs was modified."""
+    if not os.path.exists(index_file):
+        return None
+    try:
+        with np.load(index_file) as index:
+            if int(index['version']) != path_index_version or str(index['pattern']) != glob_gt:
+                return None
+            if index['dirs'].tolist() != [d.encode('utf-8') for d in dirs]:
+                return None
+            if index['mtimes'].tolist() != [os.stat(d).st_mtime_ns for d in dirs]:
+                return None
+            paths = {key: index[key] for key in ['rgb', 'd', 'gt']}
+    except (OSError, ValueError, KeyError) as e:
+        print('=> ignoring path index {}: {}'.format(index_file, e))
+        return None
+    print('=> loaded path index {}'.format(index_file))
+    return paths
+
+def save_path_index(index_file, glob_gt, dirs, paths):
+    # the index is only an accelerator, an unwritable cache folder just means scanning again next time
+    try:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(index_file))
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, version=path_index_version, pattern=glob_gt,
+                     dirs=np.array([d.encode('utf-8') for d in dirs], dtype=np.bytes_),
+                     mtimes=np.array([os.stat(d).st_mtime_ns for d in dirs], dtype=np.int64), **paths)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        print('=> cannot write path index {}: {}'.format(index_file, e))
+
 def rgb_read(filename):
     assert os.path.exists(filename), "file not found: {}".format(filename)
     img_file = Image.open(filename)
@@ -76,21 +151,41 @@ def rgb_read(filename):
     img_file.close()
     return rgb_png
 
-def depth_read(filename):
-    # loads depth map D from png file
-    # and returns it as a numpy array,
-    # for details see readme.txt
-    assert os.path.exists(filename), "file not found: {}".format(filename)
-    img_file = Image.open(filename)
-    depth_png = np.array(img_file, dtype=int)
-    img_file.close()
+def depth_read_uint16(filename):
+    """Loads a 16 bit depth png as H x W x 1 uint16, in 1/256 m units (0 means no measurement)."""
+    depth_png = cv2.imread(filename, cv2.IMREAD_ANYDEPTH)
+    assert depth_png is not None, "file not found: {}".format(filename)
     # make sure we have a proper 16bit depth map here.. not 8bit!
-    assert np.max(depth_png) > 255, \
-        "np.max(depth_png)={}, path={}".format(np.max(depth_png),filename)
+    assert depth_png.dtype == np.uint16, "dtype={}, path={}".format(depth_png.dtype, filename)
+    return depth_png[:, :, None]
+
 
-    depth = depth_png.astype(np.float) / 256.
-    # depth[depth_png == 0] = -1.
-    depth = np.expand_dims(depth,-1)
+def sparse_depth_read(filename, cache_dir=None, data_folder=None):
+    """depth_read_uint16 for sparse maps, optionally through a cache of (u, v, depth) point lists.
+
+    The cache file of a png is cache_dir/<path relative to data_folder>.npz. It only stores the valid pixels
+    (about 5% of a velodyne frame) and is written on the first read.
+    """
+    if cache_dir is None:
+        return depth_read_uint16(filename)
+    cache_file = os.path.join(cache_dir, os.path.relpath(filename, data_folder)) + '.npz'
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as points:
+            depth = np.zeros(tuple(points['shape']), dtype=np.uint16)
+            u, v = points['uv']
+            depth[v, u, 0] = points['depth']
+        return depth
+
+    depth = depth_read_uint16(filename)
+    v, u = np.nonzero(depth[:, :, 0])
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, uv=np.stack([u, v]).astype(np.uint16), depth=depth[v, u, 0], shape=np.array(depth.shape))
+        os.replace(tmp_file, cache_file)  # atomic, other workers never see a partial file
+    except OSError as e:
+        print('=> cannot write point cache {}: {}'.format(cache_file, e))
     return depth
 
 oheight, owidth = 352, 1216
@@ -193,8 +288,9 @@ def get_rgb_near(path, args):
 class KittiDepth(data.Dataset):
     """A data loader for the Kitti dataset
     """
-    def __init__(self,data_path, split,depth_divisor):
+    def __init__(self,data_path, split,depth_divisor, cache_dir=None):
         self.data_folder = data_path
+        self.cache_dir = cache_dir # sparse point cache, None to always decode the velodyne png
         self.use_rgb = True
         self.use_g = False
         self.use_d = True
@@ -209,56 +305,44 @@ class KittiDepth(data.Dataset):
         self.K = None
         self.threshold_translation = 0.1
 
+    def get_path(self, key, index):
+        return decode_path(self.paths[key][index], self.data_folder)
+
     def __getraw__(self, index):
-        rgb = rgb_read(self.paths['rgb'][index]) if \
-            (self.paths['rgb'][index] is not None and (self.use_rgb or self.use_g)) else None
-        sparse = depth_read(self.paths['d'][index]) if \
-            (self.paths['d'][index] is not None and self.use_d) else None
-        target = depth_read(self.paths['gt'][index]) if \
-            self.paths['gt'][index] is not None else None
+        rgb = rgb_read(self.get_path('rgb', index)) if (self.use_rgb or self.use_g) else None
+        # depths stay uint16 (1/256 m) until the final float32 scaling in __getitem__
+        sparse = sparse_depth_read(self.get_path('d', index), self.cache_dir, self.data_folder) if \
+            self.use_d else None
+        target = depth_read_uint16(self.get_path('gt', index))
         # rgb_near = get_rgb_near(self.paths['rgb'][index], self.args) if \
         #     self.split == 'train' and self.args.use_pose else None
         return rgb, sparse, target, None
 
-    def append_tensor3d(self,input_np,value):
-        if not isinstance(input_np, np.ndarray):  # first element
-            if value.ndim == 2:
-                input_np = np.expand_dims(value, axis=0)
-            elif value.ndim == 3:
-                input_np = value
-        else:  # 2nd ,3rd ...
-            if value.ndim == 2:
-                input_np = np.append(input_np, np.expand_dims(value, axis=0), axis=0)
-            elif value.ndim == 3:
-                input_np = np.append(input_np, value, axis=0)
-            else:
-                raise RuntimeError('value should be ndarray with 2 or 3 dimensions. Got {}'.format(value.ndim))
-        return input_np
-
     def __getitem__(self, index):
         rgb, sparse, target, rgb_near = self.__getraw__(index)
         rgb, sparse, target, rgb_near = self.transform(rgb,sparse, target, rgb_near, self)
 
         if self.depth_divisor == 0:
-            max_depth = max(sparse.max(),1.0)
+            max_depth = max(sparse.max() / 256.0,1.0)
             scale = 10.0 / max_depth  # 10 is arbitrary. the network only converge in a especific range
         else:
             assert self.depth_divisor > 0 , 'divisor is negative'
             scale = 1.0 / self.depth_divisor
+        depth_scale = np.float32(scale / 256.0)
 
+        # rgb, scaled sparse depth and its confidence
+        input_np = np.empty((5,) + sparse.shape[:2], dtype=np.float32)
+        input_np[0:3] = rgb.transpose((2, 0, 1))
+        input_np[0:3] *= np.float32(1 / 255.0)
+        input_np[3] = sparse[:, :, 0]
+        input_np[3] *= depth_scale
+        input_np[4] = sparse[:, :, 0] > 0
 
-        input_np = np.append(rgb/255.0, sparse*scale, axis=2)  # 3
-        input_np = input_np.transpose((2, 0, 1))
-
-        confidence = np.zeros_like(input_np[0, :, :])
-        valid_mask = ((input_np[3, :, :] > 0))
-        confidence[valid_mask] = 1.0
-
-        input_np = self.append_tensor3d(input_np, confidence)
-        target_np = target.transpose((2, 0, 1))*scale
+        target_np = target.transpose((2, 0, 1)).astype(np.float32)
+        target_np *= depth_scale
 
-        input_ts = torch.from_numpy(input_np.copy()).float()
-        target_ts = torch.from_numpy(target_np.copy()).float()
+        input_ts = torch.from_numpy(input_np)
+        target_ts = torch.from_numpy(target_np)
         iscale = 1/scale
 
         return input_ts, target_ts, iscale
@@ -1,12 +1,13 @@
 import numpy as np
 import dataloaders.transforms as transforms
-from dataloaders.dataloader import MyDataloader
+from dataloaders.dataloader import MyDataloader, crop_window
 
 iheight, iwidth = 480, 640 # raw image size
 
 class NYUDataset(MyDataloader):
-    def __init__(self, root, type, sparsifier=None, modality='rgb', arch='resnet18',depth_divider=1.0):
-        super(NYUDataset, self).__init__(root, type, sparsifier, modality)
+    def __init__(self, root, type, sparsifier=None, modality='rgb', arch='resnet18',depth_divider=1.0,
+                 crop_on_read=False):
+        super(NYUDataset, self).__init__(root, type, sparsifier, modality, crop_on_read=crop_on_read)
 
         self.depth_divider = depth_divider
         self.arch = arch
@@ -18,6 +19,13 @@ class NYUDataset(MyDataloader):
         else:
             raise (RuntimeError("{} is an unknown arch - visim-dataloader".format(self.arch)))
 
+    def read_window(self, height, width):
+        # the random scale and rotation of train_transform sample the resized window on another grid than the full
+        # image, only the fixed 1/2 resize of val_transform keeps it (the window offsets are even)
+        if self.type == 'train':
+            return None
+        return crop_window((height, width), self.output_size, scale=240.0 / iheight)
+
     def train_transform(self, rgb, depth):
         s = np.random.uniform(1.0, 1.5) # random scaling
         depth_np = depth / (s*self.depth_divider)
@@ -0,0 +1,110 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+
+def available_memory():
+    """Physical memory currently available to the process, in bytes (None if unknown)."""
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class TensorCacheLoader(object):
+    """Replays a deterministic loader from memory after the first pass.
+
+    The first iteration runs the wrapped DataLoader and copies every finished (input, target, scale) batch into one
+    contiguous tensor per field. Once a full pass has been stored, the following iterations read from those tensors
+    and never start the DataLoader workers again. It is only valid for loaders without augmentation or random
+    sparsification per epoch, e.g. the validation split.
+
+    Args:
+        loader: the DataLoader to cache (shuffle must be off).
+        mode: 'ram' keeps the tensors in shared memory, 'disk' backs them with a mmap file and 'auto' picks 'ram' when
+            the split fits into the available memory (with a safety margin) and 'disk' otherwise.
+        cache_dir: folder of the mmap file (default: system temp folder).
+    """
+
+    modes = ['ram', 'disk', 'auto']
+
+    def __init__(self, loader, mode='auto', cache_dir=None, memory_fraction=0.5):
+        assert mode in self.modes, 'invalid cache mode: {}'.format(mode)
+        self.loader = loader
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.memory_fraction = memory_fraction
+        self.batch_size = loader.batch_size
+        self.dataset = loader.dataset
+        self.num_samples = len(loader.dataset)
+        self.storage = None
+        self.complete = False
+        self.mmap_filename = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _allocate(self, batch):
+        fields = [torch.as_tensor(x) for x in batch]
+        sample_bytes = sum(x[0].numel() * x.element_size() for x in fields)
+        total_bytes = sample_bytes * self.num_samples
+
+        mode = self.mode
+        if mode == 'auto':
+            free = available_memory()
+            mode = 'ram' if (free is None or total_bytes < self.memory_fraction * free) else 'disk'
+
+        if mode == 'ram':
+            self.storage = [torch.empty((self.num_samples,) + tuple(x.shape[1:]), dtype=x.dtype).share_memory_()
+                            for x in fields]
+        else:
+            fd, self.mmap_filename = tempfile.mkstemp(prefix='val_cache_', suffix='.bin', dir=self.cache_dir)
+            os.close(fd)
+            with open(self.mmap_filename, 'wb') as f:
+                f.truncate(total_bytes)
+            self.storage = []
+            offset = 0
+            for x in fields:
+                shape = (self.num_samples,) + tuple(x.shape[1:])
+                np_dtype = x[:0].numpy().dtype
+                field = np.memmap(self.mmap_filename, dtype=np_dtype, mode='r+', offset=offset, shape=shape)
+                self.storage.append(torch.from_numpy(field))
+                offset += int(np.prod(shape)) * x.element_size()
+        print("=> caching {} samples ({:.1f} MB) in {}".format(self.num_samples, total_bytes / 2 ** 20,
+                                                              ('shared memory' if mode == 'ram' else
+                                                               self.mmap_filename)))
+
+    def _fill(self):
+        position = 0
+        for batch in self.loader:
+            if self.storage is None:
+                self._allocate(batch)
+            n = len(batch[0])
+            for field, x in zip(self.storage, batch):
+                field[position:position + n].copy_(torch.as_tensor(x))
+            position += n
+            yield batch
+        self.complete = position == self.num_samples
+
+    def _replay(self):
+        for start in range(0, self.num_samples, self.batch_size):
+            end = min(start + self.batch_size, self.num_samples)
+            # consumers still edit batches in place, so the cache only hands out copies
+            yield tuple(field[start:end].clone() for field in self.storage)
+
+    def __iter__(self):
+        if self.complete:
+            return self._replay()
+        return self._fill()
+
+    def close(self):
+        self.storage = None
+        self.complete = False
+        if self.mmap_filename is not None and os.path.exists(self.mmap_filename):
+            os.remove(self.mmap_filename)
+        self.mmap_filename = None
+
+    def __del__(self):
+        self.close()
@@ -22,6 +22,27 @@ import scipy.ndimage.interpolation as itpl
 import scipy.misc as misc
 
 
+def _pil_imresize(arr, size, interp='bilinear', mode=None):
+    """scipy.misc.imresize on PIL, for the uint8 images and the float ('F') depth maps of the loaders.
+
+    size: scale factor (float), percentage (int) or (h, w), as in scipy.
+    """
+    resample = {'nearest': Image.NEAREST, 'lanczos': Image.LANCZOS, 'bilinear': Image.BILINEAR,
+                'bicubic': Image.BICUBIC, 'cubic': Image.BICUBIC}[interp]
+    im = Image.fromarray(arr.astype(np.float32), mode='F') if mode == 'F' else Image.fromarray(arr)
+    if isinstance(size, numbers.Integral):
+        size = tuple((np.array(im.size) * (size / 100.0)).astype(int))
+    elif isinstance(size, numbers.Real):
+        size = tuple((np.array(im.size) * size).astype(int))
+    else:
+        size = (size[1], size[0])
+    return np.array(im.resize(size, resample=resample))
+
+
+# scipy.misc.imresize was removed in scipy 1.3
+imresize = getattr(misc, 'imresize', _pil_imresize)
+
+
 def _is_numpy_image(img):
     return isinstance(img, np.ndarray) and (img.ndim in {2, 3})
 
@@ -337,9 +358,9 @@ class Resize(object):
             PIL Image: Rescaled image.
         """
         if img.ndim == 3:
-            return misc.imresize(img, self.size, self.interpolation)
+            return imresize(img, self.size, self.interpolation)
         elif img.ndim == 2:
-            return misc.imresize(img, self.size, self.interpolation, 'F')
+            return imresize(img, self.size, self.interpolation, 'F')
         else:
             RuntimeError('img should be ndarray with 2 or 3 dimensions. Got {}'.format(img.ndim))
 
@@ -0,0 +1,208 @@
+"""Exports a checkpoint of main.py to a frozen TorchScript inference graph or to ONNX.
+
+usage: python export.py CHECKPOINT OUTPUT [--format torchscript|onnx] [--training-mode MODE] [--height H --width W]
+
+The artifacts are loaded by inference.py, which only needs torch (TorchScript) or onnxruntime (ONNX).
+"""
+import argparse
+import inspect
+import json
+import os
+
+import torch
+import torch.nn as nn
+
+import model_zoo.confidence_depth_framework as mc
+from model_zoo.inference_optimization import fold_batch_norm
+from model_zoo.nconv import bake_positive_weights
+
+# written into the artifact as 'metadata.json', read back by inference.py
+metadata_file = 'metadata.json'
+
+
+class InferenceModel(nn.Module):
+    """ConfidenceDepthFrameworkModel.forward with the sub-nets of one training mode fixed at construction.
+
+    Returns only the tensors that exist for the mode: (depth1,), (depth1, conf1) or (depth1, conf1, depth2).
+    """
+
+    def __init__(self, cdfmodel, training_mode=None):
+        super(InferenceModel, self).__init__()
+        if training_mode is None:
+            training_mode = cdfmodel.overall_arch
+        use_conf = 'cf' in training_mode
+        use_loss_dc = 'ln' in training_mode
+        if use_conf and cdfmodel.conf_model is None:
+            raise RuntimeError('training mode {} needs a confidence net, the checkpoint has none'.format(training_mode))
+        if use_loss_dc and cdfmodel.loss_dc_model is None:
+            raise RuntimeError('training mode {} needs a loss net, the checkpoint has none'.format(training_mode))
+
+        self.training_mode = training_mode
+        self.input_size = cdfmodel.input_size
+        self.dc_model = cdfmodel.dc_model
+        self.conf_model = cdfmodel.conf_model if use_conf else None
+        self.loss_dc_model = cdfmodel.loss_dc_model if use_loss_dc else None
+        # the dc net either outputs the confidence itself (out_channels == 2) or features for the confidence net
+        self.has_conf = use_conf or self.dc_model.out_channels == 2
+        self.build_conf_input = self.has_conf or use_loss_dc
+        if use_loss_dc and not self.has_conf:
+            raise RuntimeError('the loss net needs the confidence of the dc net')
+
+        self.output_names = ['depth1'] + (['conf1'] if self.has_conf else []) + (['depth2'] if use_loss_dc else [])
+
+    def forward(self, input):
+        depth1, conf_x = self.dc_model(input[:, :self.input_size, :, :], self.build_conf_input)
+        if not self.has_conf:
+            return (depth1,)
+
+        conf1 = self.conf_model(conf_x) if self.conf_model is not None else conf_x
+        if self.loss_dc_model is None:
+            return depth1, conf1
+
+        depth2, _ = self.loss_dc_model(torch.cat([input[:, :3, :, :], depth1, conf1], dim=1), False)
+        return depth1, conf1, depth2
+
+
+def load_checkpoint_model(filename):
+    """ConfidenceDepthFrameworkModel of a checkpoint written by trainer.save_checkpoint, in eval mode on cpu."""
+    checkpoint = torch.load(filename, map_location='cpu')
+    cdfmodel = mc.ConfidenceDepthFrameworkFactory().create_model_from_state(checkpoint['model_state'])
+    cdfmodel.eval()
+    return cdfmodel
+
+
+def create_inference_model(cdfmodel, training_mode=None):
+    """Eval-mode InferenceModel with the NConv2d weights baked and the batch norms folded into the convolutions."""
+    model = InferenceModel(cdfmodel, training_mode).eval()
+    bake_positive_weights(model)
+    fold_batch_norm(model)
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
+
+
+def example_input(batch_size=1, height=240, width=320, density=0.05):
+    """Random rgbdc batch laid out like the dataloaders output."""
+    rgb = torch.rand(batch_size, 3, height, width)
+    conf = (torch.rand(batch_size, 1, height, width) < density).float()
+    depth = torch.rand(batch_size, 1, height, width) * 10.0 * conf
+    return torch.cat([rgb, depth, conf], 1)
+
+
+def max_difference(outputs, reference):
+    """Largest absolute difference of each output, relative to the largest value of the reference output when it is
+    above 1 (float32 rounding grows with the depth values)."""
+    return max(float((a - b).abs().max() / b.abs().max().clamp(min=1.0)) for a, b in zip(outputs, reference))
+
+
+def _check_size(size):
+    # another size for the parity check, off by 32 so that it keeps the divisibility of the U-Nets (/32)
+    return size - 32 if size > 64 else size + 32
+
+
+def check_difference(diff, tolerance, check, backend):
+    print('=> max difference of {} to the eager model on a {}x{} batch: {:.3e}'.format(backend, check.shape[2],
+                                                                                       check.shape[3], diff))
+    if not diff <= tolerance:
+        raise RuntimeError('the {} graph differs from the eager model by {:.3e} (tolerance {:.1e}) on a {}x{} batch '
+                           'of {}, it is not saved'.format(backend, diff, tolerance, check.shape[2], check.shape[3],
+                                                          check.shape[0]))
+
+
+def export_torchscript(model, filename, height=240, width=320, tolerance=1e-3):
+    """Traces model, freezes the graph (constant parameters and folded branches) and saves it with its metadata.
+
+    Raises RuntimeError, before saving, when the graph differs from the eager model by more than tolerance on another
+    batch size and resolution (e.g. a trace specialized to the example shape).
+    """
+    example = example_input(1, height, width)
+    with torch.no_grad():
+        scripted = torch.jit.trace(model, example)
+        if hasattr(torch.jit, 'freeze'):
+            scripted = torch.jit.freeze(scripted)
+
+        # the graph must not depend on the traced resolution or batch size
+        check = example_input(2, _check_size(height), _check_size(width))
+        diff = max_difference(scripted(check), model(check))
+    check_difference(diff, tolerance, check, 'TorchScript')
+
+    metadata = {'training_mode': model.training_mode, 'input_channels': 5, 'outputs': model.output_names}
+    torch.jit.save(scripted, filename, _extra_files={metadata_file: json.dumps(metadata)})
+    print('=> saved {} ({})'.format(filename, ', '.join(model.output_names)))
+    return scripted
+
+
+def _legacy_onnx_exporter():
+    # torch >= 2.9 exports through dynamo by default, which takes dynamic_shapes instead of dynamic_axes and opset
+    # 18 and up; the TorchScript-based exporter keeps the dynamic axes and the requested opset
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        return {'dynamo': False}
+    return {}
+
+
+def export_onnx(model, filename, height=240, width=320, opset=11, tolerance=1e-3, check=True):
+    """Exports model to ONNX with dynamic batch and spatial dimensions on the input and all the outputs.
+
+    With check, the graph is run through onnxruntime on another batch size and resolution and the file is removed
+    (RuntimeError) when it differs from the eager model by more than tolerance. The check needs onnxruntime, pass
+    check=False to export without it.
+    """
+    if check:
+        try:
+            import onnxruntime
+        except ImportError:
+            raise RuntimeError('the ONNX export is checked with onnxruntime, install it or disable the check')
+
+    dynamic_axes = {name: {0: 'batch', 2: 'height', 3: 'width'} for name in ['input'] + model.output_names}
+    with torch.no_grad():
+        torch.onnx.export(model, example_input(1, height, width), filename, input_names=['input'],
+                          output_names=model.output_names, dynamic_axes=dynamic_axes, opset_version=opset,
+                          do_constant_folding=True, **_legacy_onnx_exporter())
+    if not check:
+        print('=> saved {} ({}), not checked'.format(filename, ', '.join(model.output_names)))
+        return
+
+    session = onnxruntime.InferenceSession(filename, providers=['CPUExecutionProvider'])
+    check_input = example_input(2, _check_size(height), _check_size(width))
+    outputs = session.run(model.output_names, {'input': check_input.numpy()})
+    with torch.no_grad():
+        diff = max_difference([torch.from_numpy(x) for x in outputs], model(check_input))
+    try:
+        check_difference(diff, tolerance, check_input, 'ONNX')
+    except RuntimeError:
+        os.remove(filename)
+        raise
+    print('=> saved {} ({})'.format(filename, ', '.join(model.output_names)))
+
+
+def create_parser():
+    training_mode = ['dc1_only', 'dc1-ln0', 'dc1-ln1', 'dc0-cf1-ln0', 'dc1-cf1-ln0', 'dc0-cf1-ln1', 'dc1-cf1-ln1']
+    parser = argparse.ArgumentParser(description='Export a checkpoint for inference')
+    parser.add_argument('checkpoint', metavar='CHECKPOINT', help='checkpoint written by main.py')
+    parser.add_argument('output', metavar='OUTPUT', help='output file')
+    parser.add_argument('--training-mode', metavar='MODE', default=None, choices=training_mode,
+                        help='sub-nets to keep: ' + ' | '.join(training_mode) + ' (default: mode of the checkpoint)')
+    parser.add_argument('--format', default='torchscript', choices=['torchscript', 'onnx'],
+                        help='artifact format: torchscript | onnx (default: torchscript)')
+    parser.add_argument('--opset', default=11, type=int, help='ONNX opset version, at least 11 (default: 11)')
+    parser.add_argument('--height', default=240, type=int, help='height of the example input (default: 240)')
+    parser.add_argument('--width', default=320, type=int, help='width of the example input (default: 320)')
+    parser.add_argument('--tolerance', default=1e-3, type=float,
+                        help='largest accepted difference to the eager model, relative to the output magnitude above 1, '
+                             'checked before saving (default: 1e-3)')
+    parser.add_argument('--no-check', dest='check', action='store_false',
+                        help='save the ONNX graph without the onnxruntime comparison (default: checked)')
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    model = create_inference_model(load_checkpoint_model(args.checkpoint), args.training_mode)
+    if args.format == 'onnx':
+        export_onnx(model, args.output, args.height, args.width, args.opset, args.tolerance, args.check)
+    else:
+        export_torchscript(model, args.output, args.height, args.width, args.tolerance)
+
+
+if __name__ == '__main__':
+    main()
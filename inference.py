@@ -0,0 +1,119 @@
+"""Runs a model exported by export.py without the training code.
+
+TorchScript artifacts only need torch, .onnx artifacts run on onnxruntime.
+
+usage: python inference.py MODEL [--height H --width W --batch-size N --threads N]   (times random inputs)
+
+    model = load_model('model.pt')   # or 'model.onnx'
+    outputs = model(input)   # input: B x 5 x H x W rgbdc tensor as produced by the dataloaders
+    depth1 = outputs['depth1']
+"""
+import argparse
+import json
+import time
+
+import torch
+
+
+class DepthCompletion(object):
+    """TorchScript artifact of export.py.
+
+    Args:
+        filename: exported model.
+        device: torch device to run on.
+        threads: intra-op CPU threads, 0 keeps the torch default.
+    """
+
+    def __init__(self, filename, device='cpu', threads=0):
+        if threads > 0:
+            torch.set_num_threads(threads)
+        self.device = torch.device(device)
+        extra_files = {'metadata.json': ''}
+        self.module = torch.jit.load(filename, map_location=self.device, _extra_files=extra_files)
+        self.metadata = json.loads(extra_files['metadata.json'])
+        self.output_names = self.metadata['outputs']
+
+    def __call__(self, input):
+        """dict output name -> B x 1 x H x W tensor for a B x 5 x H x W input."""
+        with torch.no_grad():
+            outputs = self.module(input.to(self.device))
+        return dict(zip(self.output_names, outputs))
+
+
+class OnnxDepthCompletion(object):
+    """ONNX artifact of export.py on the onnxruntime CPU provider.
+
+    Args:
+        filename: exported model.
+        threads: intra-op threads, 0 lets onnxruntime decide.
+        interop_threads: inter-op threads, 0 lets onnxruntime decide.
+    """
+
+    def __init__(self, filename, threads=0, interop_threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = interop_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(filename, options, providers=['CPUExecutionProvider'])
+        self.device = torch.device('cpu')
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+    def __call__(self, input):
+        """dict output name -> B x 1 x H x W tensor for a B x 5 x H x W input."""
+        input = input.detach().cpu().float().numpy()
+        outputs = self.session.run(self.output_names, {self.input_name: input})
+        return {name: torch.from_numpy(output) for name, output in zip(self.output_names, outputs)}
+
+
+def load_model(filename, device='cpu', threads=0, interop_threads=0):
+    """OnnxDepthCompletion for .onnx files, DepthCompletion otherwise."""
+    if filename.endswith('.onnx'):
+        return OnnxDepthCompletion(filename, threads, interop_threads)
+    if interop_threads > 0:
+        torch.set_num_interop_threads(interop_threads)
+    return DepthCompletion(filename, device, threads)
+
+
+def random_input(batch_size, height, width, density=0.05):
+    rgb = torch.rand(batch_size, 3, height, width)
+    conf = (torch.rand(batch_size, 1, height, width) < density).float()
+    return torch.cat([rgb, torch.rand(batch_size, 1, height, width) * 10.0 * conf, conf], 1)
+
+
+def time_model(model, input, warmup=3, iterations=20):
+    """Median latency in milliseconds."""
+    times = []
+    for i in range(warmup + iterations):
+        start = time.perf_counter()
+        outputs = model(input)
+        if input.is_cuda or model.device.type == 'cuda':
+            torch.cuda.synchronize()
+        if i >= warmup:
+            times.append((time.perf_counter() - start) * 1000.0)
+    return sorted(times)[len(times) // 2], outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Depth completion inference')
+    parser.add_argument('model', metavar='MODEL', help='file written by export.py')
+    parser.add_argument('--device', default='cpu', type=str, help='torch device (default: cpu)')
+    parser.add_argument('--threads', default=0, type=int, help='intra-op CPU threads, 0 keeps the default')
+    parser.add_argument('--interop-threads', default=0, type=int, help='inter-op CPU threads, 0 keeps the default')
+    parser.add_argument('--batch-size', default=1, type=int, help='batch size (default: 1)')
+    parser.add_argument('--height', default=240, type=int, help='input height (default: 240)')
+    parser.add_argument('--width', default=320, type=int, help='input width (default: 320)')
+    parser.add_argument('--iterations', default=20, type=int, help='timed iterations (default: 20)')
+    args = parser.parse_args()
+
+    model = load_model(args.model, args.device, args.threads, args.interop_threads)
+    latency, outputs = time_model(model, random_input(args.batch_size, args.height, args.width),
+                                  iterations=args.iterations)
+    print('=> {} ({}): {:.2f} ms per {}x{}x{} batch'.format(args.model, ', '.join(outputs), latency, args.batch_size,
+                                                            args.height, args.width))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 import sys
 import trainer
+import runtime
+import export
+import quantize
 import dataloaders.dataloader_factory as df
+from dataloaders.tensor_cache import TensorCacheLoader
+from dataloaders.feature_cache import FeatureCacheLoader
 import model_zoo.confidence_depth_framework as mc
+from model_zoo.checkpointing import set_checkpoint_stages
 import torch
 import os
 import math
@@ -53,7 +59,30 @@ def save_arguments(args, output_folder):
             paramsfile.write("{}: {}\n".format(arg, value))
 
 
+def framework_of(cdfmodel):
+    # the ConfidenceDepthFrameworkModel inside a DataParallel wrapper
+    return cdfmodel.module if isinstance(cdfmodel, torch.nn.DataParallel) else cdfmodel
+
+
+def create_feature_cache(args, cdfmodel, val_loader, device):
+    # only the validation split: every train split draws new augmentations and sparse samples at every epoch, a
+    # cached draw would train the confidence net on one fixed draw
+    framework = framework_of(cdfmodel)
+    if framework.train_dc:
+        raise RuntimeError('--feature-cache needs a frozen dc net (dc0 training modes)')
+    build_conf_input = framework.loss_dc_model is not None
+    source = {'data_path': os.path.abspath(args.data_path), 'data_type': args.data_type,
+              'modality': args.data_modality, 'num_samples': args.num_samples, 'divider': args.divider,
+              'max_depth': args.max_depth, 'max_gt_depth': args.max_gt_depth, 'dcnet_arch': framework.dc_arch,
+              'dcnet_modality': framework.input_type,
+              'checkpoint': str(args.resume or args.qat or args.dcnet_pretrained)}
+    cache = FeatureCacheLoader(val_loader, os.path.join(args.feature_cache, 'val'))
+    cache.build(framework.dc_model, framework.input_size, build_conf_input, device, source=source)
+    return cache
+
+
 def main_func(args):
+    device = runtime.setup(args)
     cdf = mc.ConfidenceDepthFrameworkFactory()
     # df: dataloader factory
     val_loader, _ = df.create_data_loaders(args.data_path
@@ -65,7 +94,12 @@ def main_func(args):
                                            , max_depth=args.max_depth
                                            , max_gt_depth=args.max_gt_depth
                                            , workers=args.workers
+                                           , cache_dir=args.data_cache
+                                           , crop_on_read=args.crop_on_read
+                                           , pin_memory=runtime.use_pin_memory(device)
                                            , batch_size=1)
+    if args.val_cache != 'none':
+        val_loader = TensorCacheLoader(val_loader, mode=args.val_cache, cache_dir=args.val_cache_dir)
     if not args.evaluate:
         train_loader, _ = df.create_data_loaders(args.data_path
                                                  , loader_type='train'
@@ -76,18 +110,23 @@ def main_func(args):
                                                  , max_depth=args.max_depth
                                                  , max_gt_depth=args.max_gt_depth
                                                  , workers=args.workers
+                                                 , cache_dir=args.data_cache
+                                                 , crop_on_read=args.crop_on_read
+                                                 , pin_memory=runtime.use_pin_memory(device)
                                                  , batch_size=args.batch_size)
 
     # only evaluation mode
     if args.evaluate:
-        cdfmodel, loss, epoch = trainer.resume(args.evaluate, cdf, True)
+        cdfmodel, loss, epoch = trainer.resume(args.evaluate, cdf, True, device)
+        if args.compile:
+            runtime.compile_model(cdfmodel, loss, args.compile_backend)
         output_directory = create_eval_output_folder(args)
         os.makedirs(output_directory)
         print("\033[31m=> val output directory: {0}\033[0m".format(output_directory))
         save_arguments(args, output_directory)
         trainer.validate(val_loader, cdfmodel, loss, epoch, print_frequency=args.print_freq,
                          num_image_samples=args.val_images, output_folder=output_directory, conf_recall=args.pr,
-                         conf_threshold=args.thrs)
+                         conf_threshold=args.thrs, amp=args.amp, pr_bins=args.pr_bins, pr_top=args.pr_top)
         return
 
     # train and evaluation mode
@@ -98,22 +137,45 @@ def main_func(args):
     save_arguments(args, output_directory)  # 保存参数
 
     # model
+    qat_subnets = None
+    if args.resume and args.qat:
+        raise RuntimeError('quantization-aware training cannot be resumed, start it again from the float checkpoint')
     if args.resume:  # optionally resume from a checkpoint
         print("\033[31m=> resume\033[0m")
         cdfmodel, loss, loss_definition, best_result_error, optimizer, scheduler = trainer.resume(args.resume, cdf,
-                                                                                                  False)
+                                                                                                  False, device)
+    elif args.qat:  # fine-tune a float checkpoint with fake quantization
+        print("\033[31m=> quantization-aware training\033[0m")
+        checkpoint = torch.load(args.qat, map_location='cpu')
+        cdfmodel = cdf.create_model_from_state(checkpoint['model_state'])
+        example_input, _, _ = next(iter(val_loader))
+        qat_subnets = quantize.prepare_qat_model(cdfmodel, example_input, args.qat_backend)
+        cdfmodel, opt_parameters = cdf.to_device(cdfmodel, device)
+        optimizer, scheduler = trainer.create_optimizer(args.optimizer, opt_parameters, args.momentum,
+                                                        args.weight_decay, args.lr, args.lrs, args.lrm)
+        loss, loss_definition = cdf.create_loss(args.criterion, framework_of(cdfmodel).use_loss_dc,
+                                                (0.5 if framework_of(cdfmodel).train_dc else 1.0))
+        best_result_error = math.inf
     else:  # create new model
         print("\033[31m=> new model\033[0m")
         cdfmodel = cdf.create_model(args.dcnet_modality, args.training_mode, args.dcnet_arch, args.dcnet_pretrained,
                                     args.confnet_arch, args.confnet_pretrained, args.lossnet_arch,
                                     args.lossnet_pretrained)
-        cdfmodel, opt_parameters = cdf.to_device(cdfmodel)
+        cdfmodel, opt_parameters = cdf.to_device(cdfmodel, device)
         optimizer, scheduler = trainer.create_optimizer(args.optimizer, opt_parameters, args.momentum,
                                                         args.weight_decay, args.lr, args.lrs, args.lrm)
-        loss, loss_definition = cdf.create_loss(args.criterion, ('ln' in args.training_mode),
-                                                (0.5 if 'dc1' in args.training_mode else 1.0))
+        loss, loss_definition = cdf.create_loss(args.criterion, framework_of(cdfmodel).use_loss_dc,
+                                                (0.5 if framework_of(cdfmodel).train_dc else 1.0))
         best_result_error = math.inf
 
+    if args.checkpoint_stages:
+        enabled = set_checkpoint_stages(cdfmodel, args.checkpoint_stages)
+        print("=> activation checkpointing: {}".format(', '.join(sorted(enabled)) if enabled else 'no matching stage'))
+    if args.compile:
+        runtime.compile_model(cdfmodel, loss, args.compile_backend)
+    if args.feature_cache:
+        val_loader = create_feature_cache(args, cdfmodel, val_loader, device)
+
     # write
     summary_write_path = Path("/media/yzdad/datasets/数据包/DJI无人机/zzz/log")
     if not summary_write_path.exists():
@@ -121,11 +183,13 @@ def main_func(args):
     writer = SummaryWriter(log_dir=str(summary_write_path))
 
     # train
+    scaler = runtime.grad_scaler(device, args.amp)
     for epoch in range(0, args.epochs):
-        trainer.train(train_loader, cdfmodel, loss, optimizer, output_directory, epoch, writer=writer)
+        trainer.train(train_loader, cdfmodel, loss, optimizer, output_directory, epoch, writer=writer, amp=args.amp,
+                      scaler=scaler, print_frequency=args.print_freq)
         epoch_result = trainer.validate(val_loader, cdfmodel, loss, epoch=epoch, print_frequency=args.print_freq,
                                         num_image_samples=args.val_images, output_folder=output_directory,
-                                        writer=writer)
+                                        writer=writer, amp=args.amp)
         scheduler.step()  # 调整学习率
 
         is_best = epoch_result.rmse < best_result_error
@@ -136,6 +200,13 @@ def main_func(args):
             #     img_filename = output_directory + '/comparison_best.png'
             #     utils.save_image(img_merge, img_filename)
 
+        if qat_subnets is not None:
+            # the fake-quantized sub-nets cannot be rebuilt by the factory, only the int8 model is saved
+            if is_best:
+                export.export_torchscript(quantize.convert_qat_model(cdfmodel, qat_subnets),
+                                          os.path.join(output_directory, 'model_best_int8.pt'))
+            continue
+
         trainer.save_checkpoint(cdf, cdfmodel, loss_definition, optimizer, scheduler, best_result_error, is_best, epoch,
                                 output_directory)
 
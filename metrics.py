@@ -9,6 +9,68 @@ def log10(x):
     return torch.log(x) / math.log(10)
 
 
+# statistics of Result.evaluate_tensor, in order
+result_fields = ['irmse', 'imae', 'mse', 'rmse', 'mae', 'absrel', 'lg10', 'delta1', 'delta2', 'delta3']
+
+# per-sample sums of masked_statistics, in order
+statistic_fields = ['count', 'sq', 'abs', 'absrel', 'lg10', 'delta1', 'delta2', 'delta3', 'inv_sq', 'inv_abs']
+
+# power of the depth scale in each statistic, the others are scale invariant
+statistic_scale_powers = {'sq': 2, 'abs': 1, 'inv_sq': -2, 'inv_abs': -1}
+
+# error maps of the statistics a loss can be differentiated through (see masked_statistics)
+loss_error_maps = {
+    'sq': lambda output, target: (output - target) ** 2,
+    'abs': lambda output, target: (output - target).abs(),
+    'absrel': lambda output, target: (output - target).abs() / target,
+    'inv_abs': lambda output, target: (1 / output - 1 / target).abs(),
+}
+
+
+def masked_statistics(output, target, valid_mask, grad_field=None):
+    """Per-sample sums over the pixels of valid_mask of the errors of output against target, a [batch, 10] tensor
+    with the columns of statistic_fields. The losses and Result.evaluate_tensor share this single pass: no boolean
+    indexing, the invalid pixels are set to 1 in output and target and the error maps are multiplied by the mask, so
+    the shapes never depend on the data and nothing waits for the device.
+
+    Only the grad_field column (a key of loss_error_maps) is differentiable, the others use output.detach(): an output
+    of 0 would otherwise send 0 * inf gradients back through log10 and 1 / output.
+    """
+    ones = torch.ones_like(target)
+    valid = valid_mask.to(target.dtype)
+    target = torch.where(valid_mask, target, ones)
+    detached = torch.where(valid_mask, output.detach(), ones)
+
+    diff = detached - target
+    inv_diff = 1 / detached - 1 / target
+    max_ratio = torch.max(detached / target, target / detached)
+    maps = {'count': ones, 'sq': diff ** 2, 'abs': diff.abs(), 'absrel': diff.abs() / target,
+            'lg10': (log10(detached) - log10(target)).abs(),
+            'delta1': (max_ratio < 1.25).to(target.dtype),
+            'delta2': (max_ratio < 1.25 ** 2).to(target.dtype),
+            'delta3': (max_ratio < 1.25 ** 3).to(target.dtype),
+            'inv_sq': inv_diff ** 2, 'inv_abs': inv_diff.abs()}
+    if grad_field is not None:
+        maps[grad_field] = loss_error_maps[grad_field](torch.where(valid_mask, output, ones), target)
+
+    dims = tuple(range(1, target.dim()))
+    return torch.stack([(maps[field] * valid).sum(dim=dims) for field in statistic_fields], dim=1)
+
+
+def result_statistics(statistics, scale=None):
+    """Statistics of Result.evaluate_tensor (result_fields order) of a batch from the per-sample sums of
+    masked_statistics. scale holds a depth scale per sample: the sums of normalized depths are converted to metric
+    units on the [batch, 10] tensor, without another pass over the pixels (valid masks must not depend on scale).
+    """
+    if scale is not None:
+        scale = scale.reshape(-1, 1).to(statistics.dtype)
+        statistics = statistics * torch.cat([scale ** statistic_scale_powers.get(field, 0)
+                                             for field in statistic_fields], dim=1)
+    totals = statistics.sum(dim=0)
+    mse, mae, absrel, lg10, delta1, delta2, delta3, inv_mse, imae = totals[1:] / totals[0]
+    return torch.stack([inv_mse.sqrt(), imae, mse, mse.sqrt(), mae, absrel, lg10, delta1, delta2, delta3])
+
+
 class Result(object):
     """
 
@@ -67,109 +129,136 @@ class Result(object):
         self.loss0, self.loss1, self.loss2 = loss0, loss1, loss2
 
     def evaluate(self, output, target, confidence=None):
+        self.update_statistics(self.evaluate_tensor(output, target, confidence).tolist())
+        self.data_time = 0
+        self.gpu_time = 0
 
+    def evaluate_tensor(self, output, target, confidence=None):
+        """Statistics of evaluate as one tensor on the device of output (in the order of result_fields), nan without
+        valid pixel. Computed by masked_statistics, so nothing waits for the device: accumulate them with
+        DeviceAverageMeter."""
         if confidence is None:
             valid_mask = target > 0
         else:
             valid_mask = (target > 0) & (confidence > self.threshold)
-        output = output[valid_mask]
-        target = target[valid_mask]
+        # float32 also for mixed-precision predictions, log10 and the inverse errors are not accurate in 16 bits
+        return result_statistics(masked_statistics(output.float(), target.float(), valid_mask))
 
-        abs_diff = (output - target).abs()  # 误差
+    def update_statistics(self, statistics):
+        """Sets the fields of result_fields from a sequence of values in that order."""
+        for name, value in zip(result_fields, statistics):
+            setattr(self, name, value)
 
-        self.mse = float((torch.pow(abs_diff, 2)).mean())
-        self.rmse = math.sqrt(self.mse)
-        self.mae = float(abs_diff.mean())
-        self.lg10 = float((log10(output) - log10(target)).abs().mean())
-        self.absrel = float((abs_diff / target).mean())
-
-        maxRatio = torch.max(output / target, target / output)
-        self.delta1 = float((maxRatio < 1.25).float().mean())
-        self.delta2 = float((maxRatio < 1.25 ** 2).float().mean())
-        self.delta3 = float((maxRatio < 1.25 ** 3).float().mean())
-        self.data_time = 0
-        self.gpu_time = 0
 
-        inv_output = 1 / output
-        inv_target = 1 / target
-        abs_inv_diff = (inv_output - inv_target).abs()
-        self.irmse = math.sqrt((torch.pow(abs_inv_diff, 2)).mean())
-        self.imae = float(abs_inv_diff.mean())
+class ConfidencePixelwiseAverageMeter(object):
+    """Calibration curve: mean absrel of the valid pixels per confidence bin (num_bins bins evenly spaced in [0, 1]).
 
+    evaluate() accumulates a histogram of the pixels and of their absrel with index_add_ (torch.bincount would read
+    its output size back from the device), on the device of the inputs and in float64, so it can run on every
+    validation batch. An optional per-pixel weight turns the counts and sums into weighted ones.
+    """
 
-class ConfidencePixelwiseAverageMeter(object):
     def __init__(self, num_bins=1000):
         self.num_bins = num_bins
         self.reset()
 
     def reset(self):
-        self.count = np.zeros([self.num_bins], np.uint64)
-        self.absrel = np.zeros([self.num_bins], np.uint64)
+        self.count = None
+        self.absrel = None
 
     def hash_index(self, confidence):  # confidence is a matrix between 0 and 1
-        indexs = np.floor((confidence - 10e-15) * self.num_bins)
-        return indexs.astype(int)
+        indexs = torch.floor((confidence - 10e-15) * self.num_bins)
+        return indexs.long().clamp(0, self.num_bins - 1)
 
-    def evaluate(self, depth, confidence, target):
+    def evaluate(self, depth, confidence, target, weight=None):
         valid_mask = target > 0
-        depth = depth[valid_mask]
-        target = target[valid_mask]
-        confidence = confidence[valid_mask]
-        indexes = self.hash_index(confidence.cpu().numpy())
+        target = torch.where(valid_mask, target, torch.ones_like(target)).double()
+        absrel = torch.where(valid_mask, (depth.double() - target).abs() / target, torch.zeros_like(target))
+        weight = valid_mask.double() if weight is None else valid_mask.double() * weight.double()
+        indexes = self.hash_index(confidence.double()).flatten()
 
-        abs_diff = (depth - target).abs()
-        absrel = ((abs_diff / target) * 1000).cpu().numpy()
-
-        for img_index, conf_index in np.ndenumerate(indexes):
-            self.count[conf_index] += 1
-            self.absrel[conf_index] += absrel[img_index]
+        if self.count is None:
+            self.count = torch.zeros(self.num_bins, dtype=torch.float64, device=target.device)
+            self.absrel = torch.zeros_like(self.count)
+        self.count.index_add_(0, indexes, weight.flatten())
+        self.absrel.index_add_(0, indexes, (weight * absrel).flatten())
 
     def result(self):
         res = [None] * self.num_bins
-        for pos, conf_index in np.ndenumerate(self.count):
-            if self.count[pos] > 0:
-                res[pos[0]] = self.absrel[pos] / self.count[pos]
+        if self.count is None:
+            return res
+        count, absrel = self.count.cpu().numpy(), self.absrel.cpu().numpy()
+        for pos in np.flatnonzero(count > 0):
+            res[pos] = absrel[pos] / count[pos]
         return res
 
+    def print(self, filename):
+        with open(filename, 'w') as csvfile:
+            for pos, absrel in enumerate(self.result()):
+                if absrel is not None:
+                    csvfile.write('{},{}\n'.format((pos + 0.5) / self.num_bins, absrel))
+
 
 class ConfidencePixelwiseThrAverageMeter(object):
-    def __init__(self, num_bins=500, top=1.0):  # 200, top 0.7
-        self.num_bins = num_bins
-        self.thresholds = np.linspace(0, top, num_bins, endpoint=True)
+    """Mean absrel and recall (fraction of the valid pixels kept) of the pixels whose confidence is above each
+    threshold, averaged over the evaluate() calls.
+
+    The confidences are sorted once per call and the absrel summed cumulatively, so every threshold is answered by one
+    searchsorted: O(N log N) per call instead of a pass per threshold. The sums stay on the device of the inputs, in
+    float64, until result().
+
+    Args:
+        num_bins: number of thresholds, evenly spaced in [0, top].
+        top: largest threshold.
+        thresholds: increasing threshold grid, replaces num_bins and top.
+    """
+
+    def __init__(self, num_bins=500, top=1.0, thresholds=None):  # 200, top 0.7
+        if thresholds is None:
+            thresholds = np.linspace(0, top, num_bins, endpoint=True)
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.num_bins = len(self.thresholds)
         self.reset()
 
     def reset(self):
-        self.count = np.zeros([self.num_bins], np.uint64)
-        self.absrel = np.zeros([self.num_bins], np.uint64)
-        self.recall = np.zeros([self.num_bins], np.uint64)
+        self.count = None
+        self.absrel = None
+        self.recall = None
+        self.device_thresholds = None
 
     def evaluate(self, depth, confidence, target):
         valid_mask = target > 0
-        depth = depth[valid_mask]
-        target = target[valid_mask]
-        confidence = confidence[valid_mask]
-
-        abs_diff = (depth - target).abs()
-        absrel = ((abs_diff / target) * 1000.0)  # .cpu().numpy()
-
-        num_valids = valid_mask.sum() / 1000.0
-
-        for img_index, curr_conf in np.ndenumerate(self.thresholds):
-            mask = confidence > curr_conf
-            absrel_medio = absrel[mask].float().mean()
-            valids = mask.sum() / num_valids
-            if (math.isfinite(absrel_medio) and math.isfinite(valids)):
-                self.count[img_index] += 1
-                self.absrel[img_index] += int(absrel_medio)
-                self.recall[img_index] += int(valids)
+        target = torch.where(valid_mask, target, torch.ones_like(target)).double()
+        absrel = torch.where(valid_mask, (depth.double() - target).abs() / target, torch.zeros_like(target))
+        # the invalid pixels are kept (static shapes) with a confidence below every threshold
+        confidence = torch.where(valid_mask, confidence.double(), torch.full_like(target, -math.inf))
+
+        confidence, order = confidence.flatten().sort()
+        cumulative = torch.cat([absrel.new_zeros(1), absrel.flatten()[order].cumsum(0)])
+        if self.count is None:
+            self.device_thresholds = torch.from_numpy(self.thresholds).to(confidence.device)
+            self.count = torch.zeros_like(self.device_thresholds)
+            self.absrel = torch.zeros_like(self.device_thresholds)
+            self.recall = torch.zeros_like(self.device_thresholds)
+
+        # pixels with confidence > threshold are the ones after the searchsorted position
+        below = torch.searchsorted(confidence, self.device_thresholds, right=True)
+        num_above = (confidence.numel() - below).double()
+        absrel_mean = (cumulative[-1] - cumulative[below]) / num_above
+        recall = num_above / valid_mask.sum()
+
+        finite = torch.isfinite(absrel_mean) & torch.isfinite(recall)
+        self.count += finite.double()
+        self.absrel += torch.where(finite, absrel_mean, torch.zeros_like(absrel_mean))
+        self.recall += torch.where(finite, recall, torch.zeros_like(recall))
 
     def result(self):
         res = [(None, None, None)] * self.num_bins
-        for pos, conf_index in np.ndenumerate(self.count):
-            if self.count[pos] > 0:
-                res[pos[0]] = (
-                self.absrel[pos] / self.count[pos], self.recall[pos] / self.count[pos], self.thresholds[pos])
-
+        if self.count is None:
+            return res
+        count, absrel, recall = [x.cpu().numpy() for x in (self.count, self.absrel, self.recall)]
+        for pos in np.flatnonzero(count > 0):
+            res[pos] = (absrel[pos] / count[pos], recall[pos] / count[pos], self.thresholds[pos])
         return res
 
     def print(self, filename):
@@ -177,7 +266,7 @@ class ConfidencePixelwiseThrAverageMeter(object):
         with open(filename, 'w') as csvfile:
             for absrel, recall, thr in lines:
                 if recall is not None:
-                    csvfile.write('{},{},{}\n'.format(thr, recall / 1000.0, absrel / 1000.0))
+                    csvfile.write('{},{},{}\n'.format(thr, recall, absrel))
 
 
 class AverageMeter(object):
@@ -232,3 +321,65 @@ class AverageMeter(object):
             self.sum_gpu_time / self.count, self.sum_data_time / self.count, self.sum_loss0 / self.count,
             self.sum_loss1 / self.count, self.sum_loss2 / self.count)
         return avg
+
+
+class DeviceAverageMeter(object):
+    """AverageMeter of the statistics of Result.evaluate_tensor and of tensor losses.
+
+    The weighted sums stay on the device of the statistics (in float64) and are only transferred by average(), so
+    update() never waits for the device: call average() at the print steps and at the end of the epoch. Each field
+    is averaged over the batches where it is finite (the check runs on the device too), so e.g. the nan lg10 of a
+    negative prediction does not hide the rmse of the batch; skipped() counts the samples without any valid pixel.
+    The times are host floats.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sums = None  # n * (result_fields, loss0, loss1, loss2)
+        self.count = None  # samples per field
+        self.num_skipped = None
+        self.time_count = 0
+        self.sum_data_time, self.sum_gpu_time = 0, 0
+
+    def update(self, statistics, gpu_time, data_time, loss, n=1):
+        """
+
+        :param statistics: tensor of Result.evaluate_tensor
+        :param gpu_time:
+        :param data_time:
+        :param loss: the three losses of the criterion, tensors or numbers
+        :param n: Batch size
+        :return:
+        """
+        # new_full fills on the device, torch.tensor(number, device=...) would be a synchronous copy
+        losses = [x.detach().reshape(1) if torch.is_tensor(x) else statistics.new_full((1,), x) for x in loss]
+        values = torch.cat([statistics.detach().reshape(-1)] + losses).double()
+        finite = torch.isfinite(values)
+        if self.sums is None:
+            self.sums = torch.zeros_like(values)
+            self.count = torch.zeros_like(values)
+            self.num_skipped = torch.zeros_like(values[0])
+        self.sums += torch.where(finite, values * n, torch.zeros_like(values))
+        self.count += finite.double() * n
+        # the mse is nan only without valid pixel
+        self.num_skipped += (~finite[result_fields.index('mse')]).double() * n
+
+        self.time_count += n
+        self.sum_data_time += n * data_time
+        self.sum_gpu_time += n * gpu_time
+
+    def skipped(self):
+        return 0 if self.num_skipped is None else int(self.num_skipped.item())
+
+    def average(self):
+        avg = Result()
+        if self.sums is None:
+            return avg
+        values = (self.sums / self.count).tolist()  # the only transfer (nan for a field never finite)
+        avg.update_statistics(values)
+        avg.loss0, avg.loss1, avg.loss2 = values[len(result_fields):]
+        avg.gpu_time = self.sum_gpu_time / self.time_count
+        avg.data_time = self.sum_data_time / self.time_count
+        return avg
@@ -0,0 +1,85 @@
+from collections import deque
+
+import torch
+
+
+def _detach(x, device):
+    if torch.is_tensor(x):
+        # a copy, so in-place ops after the hook (e.g. ReLU(inplace=True)) do not change the record
+        return x.detach() if device is None else x.detach().to(device, copy=True)
+    if isinstance(x, (tuple, list)):
+        return type(x)(_detach(y, device) for y in x)
+    return x
+
+
+class ActivationCapture(object):
+    """Debug capture of intermediate activations through forward hooks, replaces the tensors GMSNet and NconvMS
+    used to keep as attributes (xout_d, cout_d, xout_rgb, ...).
+
+    Nothing is recorded unless a capture is attached: the networks themselves keep no activation after forward.
+    The records are detached copies (on cpu by default) in a bounded buffer, so they hold no autograd graph and the
+    memory stays limited to max_records forward calls per module. Leaving the with block detaches the hooks and keeps
+    the records readable, remove() also releases them.
+
+        with ActivationCapture(model.dc_model, ['d_net', 'd', 'rgb', 'fuse']) as capture:
+            model(input)
+        xout_d = capture.outputs('d')[-1]       # GMSNet.xout_d
+        cout_d = capture.outputs('d_net')[-1][1]  # GMSNet.cout_d
+
+    Args:
+        model: module to observe.
+        names: names of sub-modules (as in model.named_modules()), None for the direct children.
+        max_records: records kept per module, the oldest ones are dropped.
+        inputs: also record the inputs of the modules.
+        device: device of the records, None keeps the device of the activations.
+    """
+
+    def __init__(self, model, names=None, max_records=1, inputs=False, device='cpu'):
+        modules = dict(model.named_modules())
+        if names is None:
+            names = [name for name, _ in model.named_children()]
+        missing = [name for name in names if name not in modules]
+        if missing:
+            raise ValueError('no sub-module named {}'.format(', '.join(missing)))
+        self.device = device
+        self.records = {name: deque(maxlen=max_records) for name in names}
+        self.handles = [modules[name].register_forward_hook(self._hook(name, inputs)) for name in names]
+
+    def _hook(self, name, inputs):
+        def hook(module, args, output):
+            record = {'output': _detach(output, self.device)}
+            if inputs:
+                record['inputs'] = _detach(args, self.device)
+            self.records[name].append(record)
+
+        return hook
+
+    def outputs(self, name):
+        """Recorded outputs of the module name, oldest first."""
+        return [record['output'] for record in self.records[name]]
+
+    def inputs(self, name):
+        """Recorded input tuples of the module name, oldest first (needs inputs=True)."""
+        return [record['inputs'] for record in self.records[name]]
+
+    def clear(self):
+        for records in self.records.values():
+            records.clear()
+
+    def detach(self):
+        """Detaches the hooks, the records stay readable."""
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def remove(self):
+        """Detaches the hooks and releases the records."""
+        self.detach()
+        self.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.detach()
+
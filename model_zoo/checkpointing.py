@@ -0,0 +1,57 @@
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+# stage name accepted by set_checkpoint_stages for every stage of a model
+all_stages = 'all'
+
+
+@contextmanager
+def frozen_batch_norm_statistics(module):
+    """Keeps the running statistics of the batch norms in module unchanged (momentum 0) inside the block."""
+    saved = []
+    for m in module.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training and m.track_running_stats:
+            saved.append((m, m.momentum, m.num_batches_tracked.clone()))
+            m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, momentum, num_batches_tracked in saved:
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def run_stage(owner, name, module, *inputs):
+    """module(*inputs) for the stage name of owner.
+
+    When the stage is in owner.checkpoint_stages (and owner trains) only the inputs are kept for the backward and the
+    stage is recomputed there. The recomputation does not update the batch norm statistics a second time.
+    """
+    if name not in owner.checkpoint_stages or not owner.training or not torch.is_grad_enabled():
+        return module(*inputs)
+
+    calls = [0]
+
+    def run(*args):
+        calls[0] += 1
+        if calls[0] == 1:
+            return module(*args)
+        with frozen_batch_norm_statistics(module):
+            return module(*args)
+
+    return checkpoint(run, *inputs, use_reentrant=False)
+
+
+def set_checkpoint_stages(model, stages):
+    """Enables activation checkpointing of the named stages in every sub-module of model that declares
+    checkpoint_stage_names ('all' selects all of them). Returns the stages that were enabled somewhere."""
+    enabled = set()
+    for module in model.modules():
+        names = getattr(module, 'checkpoint_stage_names', None)
+        if names is not None:
+            module.checkpoint_stages = set(names) if all_stages in stages else set(stages) & set(names)
+            enabled |= module.checkpoint_stages
+    return enabled
@@ -3,6 +3,9 @@ from collections import OrderedDict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import runtime
+from metrics import masked_statistics, statistic_fields
+from model_zoo.checkpointing import run_stage
 from model_zoo.nconv_sd import CNN as unguided_net
 from model_zoo.s2d_resnet import S2DResNet
 from model_zoo.s2d_u_resnet import S2DUResNet
@@ -34,9 +37,9 @@ class ConfidenceDepthFrameworkFactory():
 
         else:
             if model_arch == 'gms_depthcompnet':
-                model = GMSNet(out_channels=len(output_type))
+                model = GMSNet(out_channels=len(output_type), in_channels=len(input_type))
             elif model_arch == 'ged_depthcompnet':
-                model = GEDNet(out_channels=len(output_type))
+                model = GEDNet(out_channels=len(output_type), in_channels=len(input_type))
             else:
                 raise RuntimeError('Model: {} not found.'.format(model_arch))
 
@@ -101,10 +104,12 @@ class ConfidenceDepthFrameworkFactory():
             if len(parts) != 2 or not os.path.exists(parts[0]):
                 return
             file, key = parts
-            checkpoint = torch.load(file)
+            checkpoint = torch.load(file, map_location='cpu')
             weights = checkpoint['model_state'][key]
 
         model_dict = model.state_dict()
+        # the version metadata of the loaded modules lets them convert legacy weights (e.g. NConv2d)
+        model_dict._metadata.update(getattr(weights, '_metadata', {}))
         # overwrite entries in the existing state dict
         used = 0
         ignored = 0
@@ -134,31 +139,27 @@ class ConfidenceDepthFrameworkFactory():
         :return:
         """
 
-        cdfmodel = ConfidenceDepthFrameworkModel()
+        cdfmodel = ConfidenceDepthFrameworkModel(overall_arch)
 
-        cdfmodel.dc_model = None
         cdfmodel.dc_arch = dc_arch
-        cdfmodel.conf_model = None
         cdfmodel.conf_arch = conf_arch
-        cdfmodel.loss_dc_model = None
         cdfmodel.loss_dc_arch = lossdc_arch
-        cdfmodel.overall_arch = overall_arch
         cdfmodel.input_type = input_type
 
         if 'dc' in overall_arch:
 
-            if 'only' in overall_arch or 'cf' in overall_arch:
+            if 'only' in overall_arch or cdfmodel.use_conf:
                 output_type = 'd'
             else:
                 output_type = 'dc'
 
             cdfmodel.dc_model = self.create_dc_model(dc_arch, dc_weights, input_type, output_type)
 
-        if 'cf' in overall_arch:
+        if cdfmodel.use_conf:
             cdfmodel.conf_model = self.create_conf_model(model_arch=conf_arch, pretrained_args=conf_weights,
                                                          dc_model=cdfmodel.dc_model)
 
-        if 'ln' in overall_arch:
+        if cdfmodel.use_loss_dc:
             cdfmodel.loss_dc_model = self.create_dc_model(model_arch=lossdc_arch, pretrained_args=lossdc_weights,
                                                           input_type='rgbdc',
                                                           output_type='d')
@@ -166,16 +167,14 @@ class ConfidenceDepthFrameworkFactory():
         cdfmodel.input_size = len(input_type)
         return cdfmodel
 
-    def to_device(self, cdfmodel):
-        gpu_count = torch.cuda.device_count()
+    def to_device(self, cdfmodel, device=None):
+        if device is None:
+            device = runtime.select_device('auto')
         opt_parameters = None
-        if gpu_count > 0:
-            cdfmodel.cuda()
-            if gpu_count > 1:
-                cdfmodel = torch.nn.DataParallel(cdfmodel)
-                opt_parameters = cdfmodel.module.opt_params()
-        else:
-            cdfmodel.cpu()
+        cdfmodel.to(device)
+        if device.type == 'cuda' and device.index is None and torch.cuda.device_count() > 1:
+            cdfmodel = torch.nn.DataParallel(cdfmodel)
+            opt_parameters = cdfmodel.module.opt_params()
 
         if opt_parameters is None:
             opt_parameters = cdfmodel.opt_params()
@@ -228,56 +227,80 @@ def init_weights(m):
 
 class ConfidenceDepthFrameworkModel(torch.nn.Module):
 
-    def __init__(self):
+    def __init__(self, overall_arch=''):
         super(ConfidenceDepthFrameworkModel, self).__init__()
 
         self.dc_model = None
         self.conf_model = None
         self.loss_dc_model = None
-        self.overall_arch = ''
+        self.overall_arch = overall_arch
         self.input_size = 0  # acceptable inputs are 3:rgb, 4:rgbd, 5:rgbdc
+        self.frozen_no_grad = True  # see forward, False keeps the autograd graph of the frozen sub-nets
+
+    @property
+    def overall_arch(self):
+        return self._overall_arch
+
+    @overall_arch.setter
+    def overall_arch(self, overall_arch):
+        # training mode (dc1_only, dc0-cf1-ln1, ...) parsed once: sub-nets used and sub-nets updated
+        self._overall_arch = overall_arch
+        self.use_conf = 'cf' in overall_arch
+        self.use_loss_dc = 'ln' in overall_arch
+        self.train_dc = 'dc1' in overall_arch
+        self.train_conf = 'cf1' in overall_arch
+        self.train_loss_dc = 'ln1' in overall_arch
+
+    def forward(self, input, dc_output=None):  # input rgbdc
+        # dc_output: (depth1, conf_x) of the frozen dc net computed beforehand (dataloaders.feature_cache)
+        # a frozen sub-net whose inputs do not depend on a trained one runs without autograd, so its activations are
+        # not kept for the backward (the frozen loss net still propagates the gradients of the dc and conf nets)
+        grad = torch.is_grad_enabled()
+        trainable = self.trainable_subnets() if self.frozen_no_grad else ['dc_model', 'conf_model', 'loss_dc_model']
+        track_dc = grad and 'dc_model' in trainable
+        track_conf = track_dc or (grad and 'conf_model' in trainable)
+        track_loss_dc = track_conf or (grad and 'loss_dc_model' in trainable)
 
-    def forward(self, input):  # input rgbdc
         dc_x = input[:, :self.input_size, :, :]
-        depth1, conf_x = self.dc_model(dc_x, (self.loss_dc_model is not None))
-
-        if self.conf_model is not None:
-            assert (conf_x is not None), 'dc_model does not support extern confidence net'
-            conf1 = self.conf_model(conf_x)
-        elif conf_x is not None:
-            conf1 = conf_x
+        if dc_output is not None:
+            assert not track_dc, 'cached dc outputs need a frozen dc net'
+            depth1, conf_x = dc_output
         else:
-            conf1 = None
+            with torch.set_grad_enabled(track_dc):
+                depth1, conf_x = self.dc_model(dc_x, (self.loss_dc_model is not None))
+
+        with torch.set_grad_enabled(track_conf):
+            if self.conf_model is not None:
+                assert (conf_x is not None), 'dc_model does not support extern confidence net'
+                conf1 = self.conf_model(conf_x)
+            elif conf_x is not None:
+                conf1 = conf_x
+            else:
+                conf1 = None
 
-        if self.loss_dc_model is not None:
-            rgbd1c1 = torch.cat([input[:, :3, :, :], depth1, conf1], dim=1)
-            depth2, _ = self.loss_dc_model(rgbd1c1, False)
-        else:
-            depth2 = None
+        with torch.set_grad_enabled(track_loss_dc):
+            if self.loss_dc_model is not None:
+                rgbd1c1 = torch.cat([input[:, :3, :, :], depth1, conf1], dim=1)
+                depth2, _ = self.loss_dc_model(rgbd1c1, False)
+            else:
+                depth2 = None
 
         return depth1, conf1, depth2
 
-    def train(self, mode=True):
-        print(mode)
+    def trainable_subnets(self):
+        """Names of the sub-nets updated by the training mode (dc1, cf1, ln1)."""
+        return [name for name, trained in [('dc_model', self.train_dc), ('conf_model', self.train_conf),
+                                           ('loss_dc_model', self.train_loss_dc)]
+                if trained and getattr(self, name) is not None]
 
+    def train(self, mode=True):
+        # the frozen sub-nets always run in eval mode, so their batch norms use the running statistics
         self.training = mode
-
-        if 'dc1' in self.overall_arch:
-            self.dc_model.train(mode)
-        else:
-            self.dc_model.train(False)
-
-        if self.conf_model is not None:
-            if 'cf1' in self.overall_arch:
-                self.conf_model.train(mode)
-            else:
-                self.conf_model.train(False)
-
-        if self.loss_dc_model is not None:
-            if 'ln1' in self.overall_arch:
-                self.loss_dc_model.train(mode)
-            else:
-                self.loss_dc_model.train(False)
+        trainable = self.trainable_subnets()
+        for name in ['dc_model', 'conf_model', 'loss_dc_model']:
+            net = getattr(self, name)
+            if net is not None:
+                net.train(mode and name in trainable)
 
         return self
 
@@ -288,29 +311,14 @@ class ConfidenceDepthFrameworkModel(torch.nn.Module):
 
         opt_parameters = []
 
-        if 'dc1' in self.overall_arch:
-            assert self.dc_model is not None
-            opt_parameters += self.dc_model.parameters()
-
-        if 'dc0' in self.overall_arch:
-            assert self.dc_model is not None
-            all_no_grad(self.dc_model)
-
-        if 'cf1' in self.overall_arch:
-            assert self.conf_model is not None
-            opt_parameters += self.conf_model.parameters()
-
-        if 'cf0' in self.overall_arch:
-            assert self.conf_model is not None
-            all_no_grad(self.conf_model)
-
-        if 'ln1' in self.overall_arch:
-            assert self.loss_dc_model is not None
-            opt_parameters += self.loss_dc_model.parameters()
-
-        if 'ln0' in self.overall_arch:
-            assert self.loss_dc_model is not None
-            all_no_grad(self.loss_dc_model)
+        for name, trained in [('dc_model', self.train_dc), ('conf_model', self.train_conf),
+                              ('loss_dc_model', self.train_loss_dc)]:
+            net = getattr(self, name)
+            if trained:
+                assert net is not None
+                opt_parameters += net.parameters()
+            elif net is not None:
+                all_no_grad(net)
 
         return opt_parameters
 
@@ -449,9 +457,10 @@ class ForwardConfidence(nn.Module):
 
 class GEDNet(nn.Module):
 
-    def __init__(self, pos_fn='SoftPlus', pretrained=None, out_channels=1):
+    def __init__(self, pos_fn='SoftPlus', pretrained=None, out_channels=1, in_channels=4):
         super(GEDNet, self).__init__()
 
+        self.in_channels = in_channels  # 4: rgbd, 5: rgbdc
         self.out_channels = out_channels
 
         if out_channels == 2:
@@ -487,7 +496,7 @@ class GEDNet(nn.Module):
         x0_rgb = x0[:, :3, :, :]
         x0_d = x0[:, 3:4, :, :]
 
-        if x0.shape[1] == 4:
+        if self.in_channels == 4:
             c0 = (x0_d > 0).float()
         else:
             c0 = x0[:, 4:5, :, :]
@@ -537,10 +546,14 @@ class GEDNet(nn.Module):
 
 
 class GMSNet(nn.Module):
+    # stages that can be recomputed in the backward, see model_zoo.checkpointing
+    checkpoint_stage_names = ['d', 'rgb', 'fuse']
 
-    def __init__(self, pos_fn='SoftPlus', out_channels=1):
+    def __init__(self, pos_fn='SoftPlus', out_channels=1, in_channels=4):
         super(GMSNet, self).__init__()
 
+        self.checkpoint_stages = set()
+        self.in_channels = in_channels  # 4: rgbd, 5: rgbdc
         self.out_channels = out_channels
 
         if out_channels == 2:
@@ -635,23 +648,14 @@ class GMSNet(nn.Module):
         nn.init.xavier_normal_(self.last_layer.weight)
         nn.init.constant_(self.last_layer.bias, 0.01)
 
-        self.x0_d = []
-        self.xout_d = []
-        self.x0_rgb = []
-        self.xout_rgb = []
-        self.xf = []
-
-        self.c0 = []
-        self.cout_d = []
-
     def forward(self, x0, build_conf_input):
 
-        assert x0.shape[1] > 3, "The input is not RGB-D or rgb-dc"
+        assert self.in_channels > 3, "The input is not RGB-D or rgb-dc"
 
         x0_rgb = x0[:, :3, :, :]
         x0_d = x0[:, 3:4, :, :]
 
-        if x0.shape[1] == 4:
+        if self.in_channels == 4:
             c0 = (x0_d > 0).float()
         else:
             c0 = x0[:, 4:5, :, :]
@@ -659,17 +663,13 @@ class GMSNet(nn.Module):
         # Depth Network
         xout_d, cout_d = self.d_net(x0_d, c0)
 
-        xout_d = self.d(xout_d)
-
-        self.xout_d = xout_d
-        self.cout_d = cout_d
+        xout_d = run_stage(self, 'd', self.d, xout_d)
 
         # RGB network
-        xout_rgb = self.rgb(torch.cat((x0_rgb, cout_d), 1))
-        self.xout_rgb = xout_rgb
+        xout_rgb = run_stage(self, 'rgb', self.rgb, torch.cat((x0_rgb, cout_d), 1))
 
         # Fusion Network
-        last_layer_input = self.fuse(torch.cat((xout_rgb, xout_d), 1))
+        last_layer_input = run_stage(self, 'fuse', self.fuse, torch.cat((xout_rgb, xout_d), 1))
 
         xout = self.last_layer(last_layer_input)
 
@@ -775,15 +775,6 @@ class NconvMS(nn.Module):
                         nn.init.xavier_normal_(p.weight)
                         nn.init.constant_(p.bias, 0.01)
 
-        self.x0_d = []
-        self.xout_d = []
-        self.x0_rgb = []
-        self.xout_rgb = []
-        self.xf = []
-
-        self.c0 = []
-        self.cout_d = []
-
     def forward(self, x0, build_conf_input):
 
         assert x0.shape[1] > 3, "The input is not RGB-D or rgb-dc"
@@ -795,28 +786,17 @@ class NconvMS(nn.Module):
         else:
             c0 = x0[:, 4:5, :, :]
 
-        self.x0_d = x0_d
-        self.x0_rgb = x0_rgb
-        self.c0 = c0
-
         # Depth Network
         xout_d, cout_d = self.d_net(x0_d, c0)
 
         xout_d = self.d(xout_d)
 
-        self.xout_d = xout_d
-        self.cout_d = cout_d
-
         # RGB network
         xout_rgb = self.rgb(torch.cat((x0_rgb, cout_d), 1))
-        self.xout_rgb = xout_rgb
 
         # Fusion Network
         xout = self.fuse(torch.cat((xout_rgb, xout_d), 1))
 
-        self.xf = xout
-        self.cf = cout_d
-
         return xout, cout_d
 
 
@@ -834,95 +814,89 @@ class DualLoss(nn.Module):
     def forward(self, input, depth_a, depth_b, target_depth, epoch=None):
         error_a = self.net_a(input, depth_a, target_depth, epoch)
         self.loss = self.net_a.loss
+        # read before net_b runs, net_a and net_b can be the same module
+        self.statistics = [self.net_a.statistics[0], None]
 
         if self.weight_b > 0:
             error_b = self.net_b(input, depth_b, target_depth, epoch)
             self.loss[1] = self.net_b.loss[0]
+            self.statistics[1] = self.net_b.statistics[0]
 
             return (self.weight_b * error_b) + ((1.0 - self.weight_b) * error_a)
 
         return error_a
 
 
-class MaskedMSELoss(nn.Module):
-    def __init__(self):
-        super(MaskedMSELoss, self).__init__()
+def masked_error(field, prediction, target, valid_mask):
+    """(loss, statistics): mean over the valid pixels of the metrics.masked_statistics field and the per-sample
+    statistics of the same pass (detached), which the trainer turns into the Result of the batch."""
+    statistics = masked_statistics(prediction, target, valid_mask, grad_field=field)
+    loss = statistics[:, statistic_fields.index(field)].sum() / statistics[:, 0].sum().clamp(min=1)
+    return loss, statistics.detach()
 
-    def forward(self, depth_input, depth_prediction, depth_target, epoch=None):
-        assert depth_prediction.dim() == depth_target.dim(), "inconsistent dimensions"
-        valid_mask = ((depth_target > 0).detach())
-        num_valids = valid_mask.sum()
-        assert (num_valids > 100), 'training image has less than 100 valid pixels'
 
-        diff = depth_target - depth_prediction
-        diff = diff[valid_mask]
+def masked_mse(prediction, target, valid_mask):
+    return masked_error('sq', prediction, target, valid_mask)
 
-        final_loss = (diff ** 2).mean()
 
-        self.loss = [final_loss.item(), 0, 0]
+def masked_l1(prediction, target, valid_mask):
+    return masked_error('abs', prediction, target, valid_mask)
 
-        return final_loss
 
+def inverted_masked_l1(prediction, target, valid_mask):
+    # the invalid pixels are replaced by ones before the reciprocal, so they cannot produce inf/nan gradients
+    return masked_error('inv_abs', prediction, target, valid_mask)
 
-class InvertedMaskedL1Loss(nn.Module):
-    def __init__(self):
-        super(InvertedMaskedL1Loss, self).__init__()
 
-    def forward(self, depth_input, depth_prediction, depth_target, epoch=None):
-        assert depth_prediction.dim() == depth_target.dim(), "inconsistent dimensions"
-        valid_mask = ((depth_target > 0).detach())
-
-        num_valids = valid_mask.sum()
-        assert (num_valids > 100), 'training image has less than 100 valid pixels'
+def masked_absrel(prediction, target, valid_mask):
+    return masked_error('absrel', prediction, target, valid_mask)
 
-        diff = ((1.0 / (depth_target[valid_mask])) - (1.0 / (depth_prediction[valid_mask]))).abs()
-        final_loss = diff.mean()
 
-        self.loss = [final_loss.item(), 0, 0]
-
-        return final_loss
+class MaskedLoss(nn.Module):
+    """Loss over the pixels with a valid ground truth. error is a pure tensor function returning the loss and the
+    per-sample statistics of metrics.masked_statistics (see runtime.compile_model).
 
+    Nothing is read back to the host: self.loss holds the detached loss tensors for metrics.DeviceAverageMeter,
+    self.statistics the statistics of the prediction (for metrics.result_statistics) and a batch with min_valids valid
+    pixels or less has a nan loss instead of failing an assert, so the trainer skips it like a non-finite batch.
+    """
 
-class MaskedAbsRelLoss(nn.Module):
-    def __init__(self):
-        super(MaskedAbsRelLoss, self).__init__()
+    def __init__(self, error, min_valids=100):
+        super(MaskedLoss, self).__init__()
+        self.error = error
+        self.min_valids = min_valids
+        self.loss = -1
+        self.statistics = [None, None]
 
     def forward(self, depth_input, depth_prediction, depth_target, epoch=None):
         assert depth_prediction.dim() == depth_target.dim(), "inconsistent dimensions"
+        valid_mask = (depth_target > 0).detach()
 
-        valid_mask = ((depth_target > 0).detach())
-
-        num_valids = valid_mask.sum()
-        assert (num_valids > 100), 'training image has less than 100 valid pixels'
-
-        diff = depth_target - depth_prediction
-        diff = diff[valid_mask]
-
-        abs_rel_diff = (diff / depth_target[valid_mask]).abs()
-
-        final_loss = abs_rel_diff.mean()
-
-        self.loss = [final_loss.item(), 0, 0]
+        # float32 also for mixed-precision predictions (reciprocals of InvertedMaskedL1Loss)
+        final_loss, statistics = self.error(depth_prediction.float(), depth_target.float(), valid_mask)
+        num_valids = statistics[:, 0].sum()
+        final_loss = torch.where(num_valids > self.min_valids, final_loss, torch.full_like(final_loss, float('nan')))
+        self.loss = [final_loss.detach(), 0, 0]
+        self.statistics = [statistics, None]
 
         return final_loss
 
 
-class MaskedL1Loss(nn.Module):
+class MaskedMSELoss(MaskedLoss):
     def __init__(self):
-        super(MaskedL1Loss, self).__init__()
-        self.loss = -1
+        super(MaskedMSELoss, self).__init__(masked_mse)
 
-    def forward(self, depth_input, depth_prediction, depth_target, epoch=None):
-        assert depth_prediction.dim() == depth_target.dim(), "inconsistent dimensions"
-        valid_mask = (depth_target > 0).detach()
 
-        num_valids = valid_mask.sum()
-        assert (num_valids > 100), 'training image has less than 100 valid pixels'
+class InvertedMaskedL1Loss(MaskedLoss):
+    def __init__(self):
+        super(InvertedMaskedL1Loss, self).__init__(inverted_masked_l1)
 
-        diff = depth_target - depth_prediction
-        diff = diff[valid_mask]
 
-        final_loss = diff.abs().mean()
-        self.loss = [final_loss.item(), 0, 0]
+class MaskedAbsRelLoss(MaskedLoss):
+    def __init__(self):
+        super(MaskedAbsRelLoss, self).__init__(masked_absrel)
 
-        return final_loss
+
+class MaskedL1Loss(MaskedLoss):
+    def __init__(self):
+        super(MaskedL1Loss, self).__init__(masked_l1)
@@ -0,0 +1,99 @@
+import torch
+import torch.nn as nn
+from torchvision.models.resnet import BasicBlock, Bottleneck
+
+from model_zoo.s2d_resnet import S2DResNet
+
+# (conv, bn) attributes where the bn directly follows the conv in forward, for modules that are not nn.Sequential
+bn_pairs = {S2DResNet: [('conv1', 'bn1'), ('conv2', 'bn2')],
+            BasicBlock: [('conv1', 'bn1'), ('conv2', 'bn2')],
+            Bottleneck: [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')]}
+
+
+class FixedConfInput(nn.Module):
+    """dc net with the build_conf_input argument fixed, so traced/compiled graphs only contain one branch."""
+
+    def __init__(self, model, build_conf_input):
+        super(FixedConfInput, self).__init__()
+        self.model = model
+        self.build_conf_input = build_conf_input
+        for name in ['in_channels', 'out_channels', 'out_feature_channels']:
+            if hasattr(model, name):
+                setattr(self, name, getattr(model, name))
+
+    def forward(self, x, build_conf_input=None):
+        return self.model(x, self.build_conf_input)
+
+
+def fold_conv_bn(conv, bn):
+    """Folds the eval-mode bn into the weight and bias of conv (Conv2d or ConvTranspose2d), in place."""
+    if conv.groups != 1 and isinstance(conv, nn.ConvTranspose2d):
+        raise RuntimeError('grouped transposed convolutions are not supported')
+    with torch.no_grad():
+        scale = bn.running_var.add(bn.eps).rsqrt()
+        if bn.affine:
+            scale = scale * bn.weight
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        bias = (bias - bn.running_mean) * scale
+        if bn.affine:
+            bias = bias + bn.bias
+
+        # the output channels are dim 0 of a Conv2d weight and dim 1 of a ConvTranspose2d weight
+        if isinstance(conv, nn.ConvTranspose2d):
+            conv.weight.mul_(scale.view(1, -1, 1, 1))
+        else:
+            conv.weight.mul_(scale.view(-1, 1, 1, 1))
+        if conv.bias is None:
+            conv.bias = nn.Parameter(bias, requires_grad=conv.weight.requires_grad)
+        else:
+            conv.bias.copy_(bias)
+    return conv
+
+
+def _foldable(conv, bn, conv_types=(nn.Conv2d, nn.ConvTranspose2d)):
+    return isinstance(conv, conv_types) and isinstance(bn, nn.BatchNorm2d) and \
+           bn.track_running_stats and conv.out_channels == bn.num_features
+
+
+def fold_batch_norm(model, conv_types=(nn.Conv2d, nn.ConvTranspose2d)):
+    """Folds every BatchNorm2d that directly follows a convolution of conv_types in model into the convolution and
+    replaces it by nn.Identity (in place). Only for inference: the model has to stay in eval mode afterwards.
+
+    Handles the conv -> bn -> relu blocks in nn.Sequential (conv_bn_relu, convt_bn_relu, the decoders of S2DResNet,
+    resnet downsample) and the conv/bn attribute pairs listed in bn_pairs. Returns the number of folded layers.
+    """
+    folded = 0
+    for module in model.modules():
+        if isinstance(module, nn.Sequential):
+            names = list(module._modules.keys())
+            for conv_name, bn_name in zip(names[:-1], names[1:]):
+                conv, bn = module._modules[conv_name], module._modules[bn_name]
+                if _foldable(conv, bn, conv_types):
+                    fold_conv_bn(conv, bn)
+                    module._modules[bn_name] = nn.Identity()
+                    folded += 1
+        for module_class, pairs in bn_pairs.items():
+            if type(module) is module_class:
+                for conv_name, bn_name in pairs:
+                    conv, bn = getattr(module, conv_name, None), getattr(module, bn_name, None)
+                    if _foldable(conv, bn, conv_types):
+                        fold_conv_bn(conv, bn)
+                        setattr(module, bn_name, nn.Identity())
+                        folded += 1
+    return folded
+
+
+def optimize_for_inference(model, build_conf_input=None, channels_last=True):
+    """Puts model in eval mode, folds its batch norms, optionally fixes the build_conf_input flag of a dc net (False
+    drops the feature concat when no confidence head uses it) and converts the weights to channels_last.
+
+    Works in place on the layers, but returns a new module when build_conf_input is set. Channels-last only pays off
+    when the inputs are converted as well: x.contiguous(memory_format=torch.channels_last).
+    """
+    model.eval()
+    fold_batch_norm(model)
+    if build_conf_input is not None:
+        model = FixedConfInput(model, build_conf_input).eval()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return model
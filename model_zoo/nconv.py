@@ -38,8 +38,20 @@ _triple = _ntuple(3)
 _quadruple = _ntuple(4)
 
 
+def _autocast_enabled(device):
+    if device.type == 'cuda':
+        return torch.is_autocast_enabled()
+    if device.type == 'cpu' and hasattr(torch, 'is_autocast_cpu_enabled'):
+        return torch.is_autocast_cpu_enabled()
+    return False
+
+
 # The proposed Normalized Convolution Layer
 class NConv2d(_ConvNd):
+    # version 2: with a pos_fn the weight parameter is unconstrained and the layer uses pos_fn(weight).
+    # Older checkpoints (and baked ones, see bake_positive_weights) store the positive weights themselves.
+    _version = 2
+
     def __init__(self, in_channels,
                  out_channels,
                  kernel_size,
@@ -50,7 +62,8 @@ class NConv2d(_ConvNd):
                  dilation=1,
                  groups=1,
                  bias=True,
-                 padding_mode='zeros'):
+                 padding_mode='zeros',
+                 fused=True):
 
         # Call _ConvNd constructor
         kernel_size = _pair(kernel_size)
@@ -64,7 +77,7 @@ class NConv2d(_ConvNd):
                                       padding,
                                       dilation,
                                       False,
-                                      0,
+                                      _pair(0),
                                       groups,
                                       bias,
                                       padding_mode)
@@ -72,19 +85,90 @@ class NConv2d(_ConvNd):
         self.eps = 1e-20
         self.pos_fn = pos_fn
         self.init_method = init_method
+        self.fused = fused  # one grouped convolution for nomin and denom, see forward_fused
 
         # Initialize weights and bias
         self.init_parameters()
 
-        if self.pos_fn is not None:
-            EnforcePos.apply(self, 'weight', pos_fn)
+        # (key, pos_fn(weight)) reused until the weight changes, see positive_weight
+        self._pos_cache = None
+
+    def positive_weight(self):
+        """pos_fn(weight), computed once per weight update.
+
+        The nconv layers of the unguided net are called several times per forward, so the cached tensor is shared
+        by all the calls. It is dropped once its gradient has been computed, a new graph is built for the next
+        step. Without grad (inference) it is reused until the optimizer or a checkpoint changes the weight.
+        """
+        if self.pos_fn is None:
+            return self.weight
+        weight = self.weight
+        key = (weight._version, weight.data_ptr(), weight.device, torch.is_grad_enabled())
+        if self._pos_cache is None or self._pos_cache[0] != key:
+            positive = EnforcePos.pos(weight, self.pos_fn)
+            if positive.requires_grad:
+                positive.register_hook(self._clear_pos_cache)
+            self._pos_cache = (key, positive)
+        return self._pos_cache[1]
+
+    def _clear_pos_cache(self, grad=None):
+        self._pos_cache = None
+
+    def __getstate__(self):
+        # the cached tensor may be part of a graph, it cannot be copied or pickled
+        state = self.__dict__.copy()
+        state['_pos_cache'] = None
+        return state
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        version = local_metadata.get('version', None)
+        key = prefix + 'weight'
+        if self.pos_fn is not None and (version is None or version < 2) and key in state_dict:
+            # the checkpoint holds positive weights, store their preimage
+            state_dict[key] = EnforcePos.inverse(state_dict[key], self.pos_fn)
+        self._clear_pos_cache()
+        super(NConv2d, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys,
+                                                   unexpected_keys, error_msgs)
 
     def forward(self, data, conf):
+        if _autocast_enabled(data.device):
+            # the normalization divides by denom + eps (eps = 1e-20), it always runs in float32
+            with torch.autocast(device_type=data.device.type, enabled=False):
+                return self.forward(data.float(), conf.float())
+        if self.fused:
+            return self.forward_fused(data, conf)
+        return self.forward_reference(data, conf)
+
+    def forward_fused(self, data, conf):
+        # (data*conf, conf) stacked on the channels and convolved by the same weights as 2*groups groups
+        weight = self.positive_weight()
+        out = F.conv2d(torch.cat((data * conf, conf), 1), torch.cat((weight, weight), 0), None, self.stride,
+                       self.padding, self.dilation, 2 * self.groups)
+        nomin, denom = out.split(self.out_channels, 1)
+
+        # Propagate confidence, the per-filter weight sums are computed once
+        s = weight.flatten(1).sum(1)
+        cout = denom / s.view(1, -1, 1, 1)
+
+        # Normalized Convolution and bias
+        bias = self.bias.view(1, -1, 1, 1)
+        if out.requires_grad:
+            nconv = nomin / (denom + self.eps)
+            nconv += bias
+        else:
+            # nothing is saved for backward, reuse the convolution output
+            nconv = nomin.div_(denom + self.eps).add_(bias)
+
+        return nconv, cout
+
+    def forward_reference(self, data, conf):
+        weight = self.positive_weight()
 
         # Normalized Convolution
-        denom = F.conv2d(conf, self.weight, None, self.stride,
+        denom = F.conv2d(conf, weight, None, self.stride,
                          self.padding, self.dilation, self.groups)
-        nomin = F.conv2d(data * conf, self.weight, None, self.stride,
+        nomin = F.conv2d(data * conf, weight, None, self.stride,
                          self.padding, self.dilation, self.groups)
         nconv = nomin / (denom + self.eps)
 
@@ -100,7 +184,7 @@ class NConv2d(_ConvNd):
         sz = cout.size()
         cout = cout.view(sz[0], sz[1], -1)
 
-        k = self.weight
+        k = weight
         k_sz = k.size()
         k = k.view(k_sz[0], -1)
         s = torch.sum(k, dim=-1, keepdim=True)
@@ -139,29 +223,13 @@ class NConv2d(_ConvNd):
         self.bias = torch.nn.Parameter(torch.zeros(self.out_channels) + 0.01)
 
 
-# Non-negativity enforcement class        
+# Non-negativity enforcement
 class EnforcePos(object):
-    def __init__(self, pos_fn, name):
-        self.name = name
-        self.pos_fn = pos_fn
+    """Positive functions used to reparametrize the NConv2d weights, with their inverses."""
 
     @staticmethod
-    def apply(module, name, pos_fn):
-        fn = EnforcePos(pos_fn, name)
-
-        module.register_forward_pre_hook(fn)
-
-        return fn
-
-    def __call__(self, module, inputs):
-        if module.training:
-            weight = getattr(module, self.name)
-            weight.data = self._pos(weight).data
-        else:
-            pass
-
-    def _pos(self, p):
-        pos_fn = self.pos_fn.lower()
+    def pos(p, pos_fn):
+        pos_fn = pos_fn.lower()
         if pos_fn == 'softmax':
             p_sz = p.size()
             p = p.view(p_sz[0], p_sz[1], -1)
@@ -172,7 +240,39 @@ class EnforcePos(object):
         elif pos_fn == 'softplus':
             return F.softplus(p, beta=10)
         elif pos_fn == 'sigmoid':
-            return F.sigmoid(p)
+            return torch.sigmoid(p)
         else:
-            print('Undefined positive function!')
-            return
+            raise ValueError('Undefined positive function: {}'.format(pos_fn))
+
+    @staticmethod
+    def inverse(w, pos_fn, eps=1e-6):
+        """A p with pos(p) == w; w is clamped to the range of pos first."""
+        pos_fn = pos_fn.lower()
+        w = w.clamp(min=eps)
+        if pos_fn == 'softmax' or pos_fn == 'exp':
+            # softmax is invariant to a constant offset, log is one preimage
+            return torch.log(w)
+        elif pos_fn == 'softplus':
+            beta = 10
+            return w + torch.log(-torch.expm1(-beta * w)) / beta
+        elif pos_fn == 'sigmoid':
+            w = w.clamp(max=1 - eps)
+            return torch.log(w) - torch.log1p(-w)
+        else:
+            raise ValueError('Undefined positive function: {}'.format(pos_fn))
+
+
+def bake_positive_weights(model):
+    """Stores pos_fn(weight) in the weight of every NConv2d of model and turns the reparametrization off.
+
+    For deployment: the forward no longer evaluates pos_fn and the state dict holds the effective weights. The baked
+    layers keep the legacy state dict version, so loading a baked checkpoint into a training model still works.
+    """
+    for module in model.modules():
+        if isinstance(module, NConv2d) and module.pos_fn is not None:
+            with torch.no_grad():
+                module.weight.copy_(EnforcePos.pos(module.weight, module.pos_fn))
+            module.pos_fn = None
+            module._version = 1
+            module._clear_pos_cache()
+    return model
@@ -15,6 +15,11 @@ import numpy as np
 from model_zoo.nconv import NConv2d
 
 
+def gather_pooled(x, idx):
+    """Picks the values of x (B x C x H x W) at the flat spatial indices returned by max_pool2d(return_indices=True)."""
+    return x.flatten(2).gather(2, idx.flatten(2)).view_as(idx)
+
+
 class CNN(nn.Module):
 
     def __init__(self, pos_fn='SoftPlus', num_channels=2):
@@ -41,10 +46,7 @@ class CNN(nn.Module):
         # Downsample 1
         ds = 2
         c1_ds, idx = F.max_pool2d(c1, ds, ds, return_indices=True)
-        x1_ds = torch.zeros(c1_ds.size()).cuda()
-        for i in range(x1_ds.size(0)):
-            for j in range(x1_ds.size(1)):
-                x1_ds[i, j, :, :] = x1[i, j, :, :].view(-1)[idx[i, j, :, :].view(-1)].view(idx.size()[2:])
+        x1_ds = gather_pooled(x1, idx)
         c1_ds /= 4
 
         x2_ds, c2_ds = self.nconv2(x1_ds, c1_ds)
@@ -53,11 +55,7 @@ class CNN(nn.Module):
         # Downsample 2
         ds = 2
         c2_dss, idx = F.max_pool2d(c2_ds, ds, ds, return_indices=True)
-
-        x2_dss = torch.zeros(c2_dss.size()).cuda()
-        for i in range(x2_dss.size(0)):
-            for j in range(x2_dss.size(1)):
-                x2_dss[i, j, :, :] = x2_ds[i, j, :, :].view(-1)[idx[i, j, :, :].view(-1)].view(idx.size()[2:])
+        x2_dss = gather_pooled(x2_ds, idx)
         c2_dss /= 4
 
         x3_ds, c3_ds = self.nconv2(x2_dss, c2_dss)
@@ -66,10 +64,7 @@ class CNN(nn.Module):
         ds = 2
         c3_dss, idx = F.max_pool2d(c3_ds, ds, ds, return_indices=True)
 
-        x3_dss = torch.zeros(c3_dss.size()).cuda()
-        for i in range(x3_dss.size(0)):
-            for j in range(x3_dss.size(1)):
-                x3_dss[i, j, :, :] = x3_ds[i, j, :, :].view(-1)[idx[i, j, :, :].view(-1)].view(idx.size()[2:])
+        x3_dss = gather_pooled(x3_ds, idx)
         c3_dss /= 4
         x4_ds, c4_ds = self.nconv2(x3_dss, c3_dss)
 
@@ -17,10 +17,10 @@ class Unpool(nn.Module):
         self.num_channels = num_channels
         self.stride = stride
 
-        # create kernel [1, 0; 0, 0]
-        self.weights = torch.zeros(
-            [num_channels, 1, stride, stride]).cuda()  # currently not compatible with running on CPU
-        self.weights[:, :, 0, 0] = 1
+        # create kernel [1, 0; 0, 0], a constant that follows the module device and is not saved
+        weights = torch.zeros([num_channels, 1, stride, stride])
+        weights[:, :, 0, 0] = 1
+        self.register_buffer('weights', weights, persistent=False)
 
     def forward(self, x):
         return F.conv_transpose2d(x, self.weights, stride=self.stride, groups=self.num_channels)
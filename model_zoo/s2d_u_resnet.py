@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torchvision.models import resnet
 
+from model_zoo.checkpointing import run_stage
 from model_zoo.nconv_sd import CNN as unguided_net
 
 
@@ -62,6 +63,9 @@ def convt_bn_relu(in_channels, out_channels, kernel_size, \
 
 
 class S2DUResNet(nn.Module):
+    # stages that can be recomputed in the backward, see model_zoo.checkpointing
+    checkpoint_stage_names = ['conv2', 'conv3', 'conv4', 'conv5', 'conv6', 'convt5', 'convt4', 'convt3', 'convt2',
+                              'convt1']
 
     def __init__(self, layers=18, in_channels=3, out_channels=1, pretrained=True,unguided=False):
 
@@ -78,6 +82,7 @@ class S2DUResNet(nn.Module):
         assert (layers in [18, 34, 50, 101,
                            152]), 'Only layers 18, 34, 50, 101, and 152 are defined, but got {}'.format(layers)
         super(S2DUResNet, self).__init__()
+        self.checkpoint_stages = set()
         used_channels = 0
 
         # Import the unguided network
@@ -150,26 +155,26 @@ class S2DUResNet(nn.Module):
                 conv1_d = self.conv1_d(x[:, 3:5, :, :])
             conv1 = torch.cat((conv1_d, conv1_img), 1)
 
-        conv2 = self.conv2(conv1)
-        conv3 = self.conv3(conv2)  # batchsize * ? * 176 * 608
-        conv4 = self.conv4(conv3)  # batchsize * ? * 88 * 304
-        conv5 = self.conv5(conv4)  # batchsize * ? * 44 * 152
-        conv6 = self.conv6(conv5)  # batchsize * ? * 22 * 76
+        conv2 = run_stage(self, 'conv2', self.conv2, conv1)
+        conv3 = run_stage(self, 'conv3', self.conv3, conv2)  # batchsize * ? * 176 * 608
+        conv4 = run_stage(self, 'conv4', self.conv4, conv3)  # batchsize * ? * 88 * 304
+        conv5 = run_stage(self, 'conv5', self.conv5, conv4)  # batchsize * ? * 44 * 152
+        conv6 = run_stage(self, 'conv6', self.conv6, conv5)  # batchsize * ? * 22 * 76
 
         # decoder
-        convt5 = self.convt5(conv6)
+        convt5 = run_stage(self, 'convt5', self.convt5, conv6)
         y = torch.cat((convt5, conv5), 1)
 
-        convt4 = self.convt4(y)
+        convt4 = run_stage(self, 'convt4', self.convt4, y)
         y = torch.cat((convt4, conv4), 1)
 
-        convt3 = self.convt3(y)
+        convt3 = run_stage(self, 'convt3', self.convt3, y)
         y = torch.cat((convt3, conv3), 1)
 
-        convt2 = self.convt2(y)
+        convt2 = run_stage(self, 'convt2', self.convt2, y)
         y = torch.cat((convt2, conv2), 1)
 
-        convt1 = self.convt1(y)
+        convt1 = run_stage(self, 'convt1', self.convt1, y)
         last_layer_input = torch.cat((convt1, conv1), 1)
 
         y = self.convtf(last_layer_input)
@@ -0,0 +1,245 @@
+"""Static int8 quantization (FX graph mode) of the depth-completion networks for CPU inference.
+
+usage: python quantize.py CHECKPOINT OUTPUT --data-path PATH [--data-type dji] [--calibration-batches 200]
+
+The checkpoint is exported as in export.py, calibrated on validation batches of create_data_loaders and converted to
+int8. The batch norms are folded by export.create_inference_model and the conv(+ReLU) blocks are fused by the FX pass
+(conv_bn_relu/convt_bn_relu of S2DUResNet, the GEDNet U-Net, ...). The unguided NConv2d network and the final depth
+regression layer stay in float. The int8 and float models are compared on held-out batches (RMSE, MAE, delta1 in
+metric units and CPU latency) and the int8 model is saved as a TorchScript artifact for inference.py.
+"""
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+import dataloaders.dataloader_factory as df
+import export
+from metrics import AverageMeter, Result
+from model_zoo.confidence_depth_framework import GEDNet, GMSNet
+from model_zoo.inference_optimization import FixedConfInput, fold_batch_norm
+from model_zoo.nconv_sd import CNN as unguided_net
+from model_zoo.s2d_resnet import S2DResNet, Unpool
+from model_zoo.s2d_u_resnet import S2DUResNet
+
+# final depth regression of each dc net, kept in float
+float_layers = {S2DUResNet: ['convtf'], GEDNet: ['conv10'], GMSNet: ['last_layer'], S2DResNet: ['conv3']}
+
+# sub-nets of ConfidenceDepthFrameworkModel/export.InferenceModel that can be quantized
+subnet_names = ['dc_model', 'conf_model', 'loss_dc_model']
+
+
+def _copy_attributes(src, dst):
+    # the framework reads these from the sub-nets, a GraphModule does not keep them
+    for name in ['in_channels', 'out_channels', 'out_feature_channels']:
+        if hasattr(src, name):
+            setattr(dst, name, getattr(src, name))
+    return dst
+
+
+def _qconfig_mapping(backend, net):
+    """qconfig for everything but the unguided network and the regression layer of net."""
+    from torch.ao.quantization import QConfig, QConfigMapping, default_weight_observer, get_default_qconfig
+
+    qconfig = get_default_qconfig(backend)
+    mapping = QConfigMapping().set_global(qconfig)
+    # per-channel weights are not supported by the quantized transposed convolutions
+    mapping.set_object_type(nn.ConvTranspose2d, QConfig(activation=qconfig.activation, weight=default_weight_observer))
+    mapping.set_object_type(unguided_net, None)
+    mapping.set_object_type(Unpool, None)
+    for net_class, names in float_layers.items():
+        if isinstance(net, net_class):
+            for name in names:
+                mapping.set_module_name('model.' + name, None)
+    return mapping
+
+
+def _qat_qconfig_mapping(backend, net):
+    from torch.ao.quantization import get_default_qat_qconfig
+
+    mapping = _qconfig_mapping(backend, net)
+    qat_qconfig = get_default_qat_qconfig(backend)
+    mapping.set_global(qat_qconfig)
+    return mapping
+
+
+def prepare_subnets(model, example_input, dc_build_conf_input, backend='fbgemm', qat=False, names=None):
+    """Replaces the sub-nets of model (ConfidenceDepthFrameworkModel or export.InferenceModel) by FX GraphModules
+    with observers (or fake quantization when qat is set). Returns the names of the prepared sub-nets.
+
+    example_input is an rgbdc batch, the inputs of the conf and loss nets are computed from it.
+    """
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, prepare_qat_fx
+
+    torch.backends.quantized.engine = backend
+    with torch.no_grad():
+        depth1, features = model.dc_model(example_input[:, :model.input_size, :, :], dc_build_conf_input)
+        conf1 = model.conf_model(features) if model.conf_model is not None else features
+        inputs = {'dc_model': example_input[:, :model.input_size, :, :], 'conf_model': features}
+        if conf1 is not None:
+            inputs['loss_dc_model'] = torch.cat([example_input[:, :3, :, :], depth1, conf1], dim=1)
+    build_conf_input = {'dc_model': dc_build_conf_input, 'loss_dc_model': False}
+
+    custom_config = PrepareCustomConfig().set_non_traceable_module_classes([unguided_net])
+    prepared = []
+    for name in (names if names is not None else subnet_names):
+        net = getattr(model, name, None)
+        if net is None:
+            continue
+        traced = FixedConfInput(net, build_conf_input[name]) if name in build_conf_input else net
+        if qat:
+            # the QAT fusion has no ConvTranspose+BatchNorm pattern, these batch norms are folded with their
+            # current statistics (convt_bn_relu of S2DUResNet)
+            fold_batch_norm(traced.eval(), conv_types=(nn.ConvTranspose2d,))
+            mapping = _qat_qconfig_mapping(backend, net)
+            graph = prepare_qat_fx(traced.train(), mapping, (inputs[name],), prepare_custom_config=custom_config)
+        else:
+            mapping = _qconfig_mapping(backend, net)
+            graph = prepare_fx(traced.eval(), mapping, (inputs[name],), prepare_custom_config=custom_config)
+        setattr(model, name, _copy_attributes(net, graph))
+        prepared.append(name)
+    return prepared
+
+
+def convert_subnets(model, names):
+    """Converts the prepared sub-nets to int8 (in place)."""
+    from torch.ao.quantization.quantize_fx import convert_fx
+
+    for name in names:
+        graph = getattr(model, name)
+        setattr(model, name, _copy_attributes(graph, convert_fx(graph.eval())))
+    return model
+
+
+def prepare_qat_model(cdfmodel, example_input, backend='fbgemm'):
+    """Inserts fake quantization in every sub-net of a ConfidenceDepthFrameworkModel (in place, before to_device and
+    the optimizer). Returns the names of the prepared sub-nets for convert_qat_model.
+
+    The frozen sub-nets of the training mode are prepared too, their observers still follow the data. The batch norms
+    that follow a transposed convolution are folded into it with their current statistics (see prepare_subnets).
+    """
+    cdfmodel.eval()
+    build_conf_input = cdfmodel.conf_model is not None or cdfmodel.loss_dc_model is not None
+    names = prepare_subnets(cdfmodel, example_input, build_conf_input, backend, qat=True)
+    cdfmodel.train()
+    return names
+
+
+def convert_qat_model(cdfmodel, names):
+    """int8 export.InferenceModel of a model prepared by prepare_qat_model, cdfmodel itself keeps training."""
+    if isinstance(cdfmodel, nn.DataParallel):
+        cdfmodel = cdfmodel.module
+    model = copy.deepcopy(cdfmodel).cpu()
+    model.eval()
+    # deepcopy rebuilds the GraphModules without the attributes of prepare_subnets
+    for name in names:
+        _copy_attributes(getattr(cdfmodel, name), getattr(model, name))
+    return export.create_inference_model(convert_subnets(model, names))
+
+
+def quantize_inference_model(model, calibration_loader, num_batches, backend='fbgemm'):
+    """int8 copy of an export.InferenceModel, calibrated on up to num_batches batches."""
+    qmodel = copy.deepcopy(model).eval()
+    batches = iter(calibration_loader)
+    example, _, _ = next(batches)
+    names = prepare_subnets(qmodel, example, qmodel.build_conf_input, backend)
+    with torch.no_grad():
+        qmodel(example)
+        for i, (input, _, _) in enumerate(batches, 1):
+            if i >= num_batches:
+                break
+            qmodel(input)
+    return convert_subnets(qmodel, names)
+
+
+def evaluate(model, loader, num_batches, reference=None):
+    """Average Result of depth1 against the ground truth (or against the depth1 of reference), in metric units.
+
+    The gpu_time field holds the mean latency per batch in seconds.
+    """
+    meter = AverageMeter()
+    with torch.no_grad():
+        for i, (input, target, scale) in enumerate(loader):
+            if i >= num_batches:
+                break
+            start = time.perf_counter()
+            depth = model(input)[0]
+            latency = time.perf_counter() - start
+            scale = torch.as_tensor(scale).float().view(-1, 1, 1, 1)
+            target = reference(input)[0] if reference is not None else target[:, 0:1, :, :]
+            result = Result()
+            result.evaluate(depth * scale, target * scale)
+            meter.update(result, latency, 0, [0, 0, 0], input.size(0))
+    return meter.average()
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization')
+    parser.add_argument('checkpoint', metavar='CHECKPOINT', help='checkpoint written by main.py')
+    parser.add_argument('output', metavar='OUTPUT', help='int8 TorchScript artifact')
+    parser.add_argument('--training-mode', metavar='MODE', default=None,
+                        help='sub-nets to keep, see export.py (default: mode of the checkpoint)')
+    parser.add_argument('--data-path', required=True, type=str, metavar='PATH', help='path to data folder')
+    parser.add_argument('--data-type', default='dji', choices=df.data_types,
+                        help='dataset: ' + ' | '.join(df.data_types) + ' (default: dji)')
+    parser.add_argument('--data-modality', default='rgb-fd-bin', type=str, help='modality (default: rgb-fd-bin)')
+    parser.add_argument('--divider', default=0, type=float, help='normalization factor (default: 0)')
+    parser.add_argument('--max-depth', default=250, type=float, help='cut-off depth of sparsifier (default: 250)')
+    parser.add_argument('--max-gt-depth', default=250.0, type=float, help='cut-off of ground truth (default: 250)')
+    parser.add_argument('-s', '--num-samples', default=500, type=int, help='sparse depth samples (default: 500)')
+    parser.add_argument('-j', '--workers', default=4, type=int, help='data loading workers (default: 4)')
+    parser.add_argument('--calibration-batches', default=200, type=int,
+                        help='validation batches used to calibrate the observers (default: 200)')
+    parser.add_argument('--eval-batches', default=100, type=int,
+                        help='batches after the calibration ones used to compare int8 and float (default: 100)')
+    parser.add_argument('--backend', default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                        help='quantized engine: fbgemm (x86) | qnnpack (arm) (default: fbgemm)')
+    parser.add_argument('--threads', default=0, type=int, help='intra-op CPU threads, 0 keeps the default')
+    return parser
+
+
+class _Skip(object):
+    """Iterates a loader from the batch number start (the evaluation does not reuse calibration batches)."""
+
+    def __init__(self, loader, start):
+        self.loader = loader
+        self.start = start
+
+    def __iter__(self):
+        for i, batch in enumerate(self.loader):
+            if i >= self.start:
+                yield batch
+
+
+def main():
+    args = create_parser().parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    loader, _ = df.create_data_loaders(args.data_path, loader_type='val', data_type=args.data_type,
+                                       modality=args.data_modality, num_samples=args.num_samples,
+                                       depth_divisor=args.divider, max_depth=args.max_depth,
+                                       max_gt_depth=args.max_gt_depth, workers=args.workers, batch_size=1,
+                                       pin_memory=False)
+
+    model = export.create_inference_model(export.load_checkpoint_model(args.checkpoint), args.training_mode)
+    qmodel = quantize_inference_model(model, loader, args.calibration_batches, args.backend)
+
+    eval_loader = _Skip(loader, args.calibration_batches)
+    float_result = evaluate(model, eval_loader, args.eval_batches)
+    int8_result = evaluate(qmodel, eval_loader, args.eval_batches)
+    agreement = evaluate(qmodel, eval_loader, args.eval_batches, reference=model)
+
+    print('{:>16} {:>10} {:>10} {:>8} {:>14}'.format('', 'RMSE', 'MAE', 'Delta1', 'latency [ms]'))
+    for name, result in [('float', float_result), ('int8', int8_result), ('int8 vs float', agreement)]:
+        print('{:>16} {:>10.3f} {:>10.3f} {:>8.3f} {:>14.2f}'.format(name, result.rmse, result.mae, result.delta1,
+                                                                      result.gpu_time * 1000.0))
+
+    export.export_torchscript(qmodel, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Device, thread, precision and compilation configuration shared by main.py, the trainer and the tools."""
+import contextlib
+
+import torch
+
+device_names = ['auto', 'cpu', 'cuda']
+
+
+def select_device(name='auto'):
+    """torch.device for 'auto' (cuda when available), 'cpu', 'cuda' or 'cuda:N'."""
+    if name == 'auto':
+        name = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(name)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        raise RuntimeError('device {} requested but CUDA is not available'.format(name))
+    return device
+
+
+def configure_threads(threads=0, interop_threads=0):
+    """Sets the intra-op and inter-op CPU thread pools, 0 keeps the torch defaults.
+
+    The inter-op pool can only be sized before the first parallel operation, so call this at start up.
+    """
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            print('=> cannot set the inter-op threads: {}'.format(e))
+
+
+def setup(args):
+    """Device and threads from the --device, --threads and --interop-threads options."""
+    device = select_device(args.device)
+    configure_threads(args.threads, args.interop_threads)
+    print('=> device: {} (intra-op threads: {}, inter-op threads: {})'.format(device, torch.get_num_threads(),
+                                                                              torch.get_num_interop_threads()))
+    return device
+
+
+def model_device(model):
+    """Device of the first parameter (or buffer) of model, cpu for a model without tensors."""
+    for tensor in model.parameters():
+        return tensor.device
+    for tensor in model.buffers():
+        return tensor.device
+    return torch.device('cpu')
+
+
+def synchronize(device):
+    """Waits for the queued kernels of device, so wall clock timings are meaningful (no-op on cpu)."""
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def use_pin_memory(device):
+    # page-locked batches only speed up host to GPU copies
+    return device.type == 'cuda'
+
+
+amp_modes = ['none', 'fp16', 'bf16']
+amp_dtypes = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(device, amp='none'):
+    """Mixed-precision context for the forward passes ('none' runs in float32)."""
+    if amp == 'none':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=amp_dtypes[amp])
+
+
+def grad_scaler(device, amp='none'):
+    """Loss scaler for fp16 training, a pass-through otherwise (bf16 has the exponent range of float32)."""
+    enabled = amp == 'fp16'
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled and device.type == 'cuda')
+
+
+def compile_module(module, backend='inductor'):
+    """Compiles the forward of module in place, the parameters and the state dict keys stay the same."""
+    if hasattr(module, 'compile'):  # torch >= 2.2
+        module.compile(backend=backend)
+    else:
+        module.forward = torch.compile(module.forward, backend=backend)
+    return module
+
+
+def compile_model(cdfmodel, criterion=None, backend='inductor'):
+    """Compiles the sub-nets of a ConfidenceDepthFrameworkModel and the error functions of the masked losses.
+
+    The framework forward itself stays eager: its branches on the training mode and the None outputs are plain
+    python around the compiled sub-nets, so they cause no graph breaks or recompilations between steps.
+    """
+    if not hasattr(torch, 'compile'):
+        raise RuntimeError('--compile needs torch >= 2.0')
+    if isinstance(cdfmodel, torch.nn.DataParallel):
+        cdfmodel = cdfmodel.module
+    for net in [cdfmodel.dc_model, cdfmodel.conf_model, cdfmodel.loss_dc_model]:
+        if net is not None:
+            compile_module(net, backend)
+    if criterion is not None:
+        for loss in criterion.modules():
+            if hasattr(loss, 'error'):
+                loss.error = torch.compile(loss.error, backend=backend)
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+import torch
+
+# the modules of the repository are imported from its root, as main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model_zoo.confidence_depth_framework as mc  # noqa: E402
+
+
+def synthetic_batches(num_batches=2, batch_size=2, height=64, width=64, seed=0):
+    """(input, target, scale) batches like the loaders of create_data_loaders, rgbdc inputs with sparse depth."""
+    generator = torch.Generator().manual_seed(seed)
+    batches = []
+    for _ in range(num_batches):
+        rgb = torch.rand(batch_size, 3, height, width, generator=generator)
+        target = torch.rand(batch_size, 1, height, width, generator=generator) + 0.5
+        sparse = (torch.rand(batch_size, 1, height, width, generator=generator) < 0.1).float()
+        input = torch.cat([rgb, target * sparse, sparse], dim=1)
+        batches.append((input, target, torch.ones(batch_size)))
+    return batches
+
+
+def create_model(dc_arch='gms_depthcompnet', training_mode='dc1-cf1-ln1', conf_arch='cbr3-c1',
+                 lossdc_arch='ged_depthcompnet'):
+    torch.manual_seed(0)
+    cdf = mc.ConfidenceDepthFrameworkFactory()
+    return cdf.create_model('rgbdc', training_mode, dc_arch, '', conf_arch, '', lossdc_arch, '')
+
+
+@pytest.fixture
+def cpu():
+    return torch.device('cpu')
@@ -0,0 +1,70 @@
+import pytest
+import torch
+
+from model_zoo.activation_capture import ActivationCapture
+from model_zoo.confidence_depth_framework import GMSNet, NconvMS
+
+
+def _held_tensors(model):
+    """(module, attribute) of the tensors a module keeps outside its parameters and buffers."""
+    def tensors(value):
+        if torch.is_tensor(value):
+            return True
+        if isinstance(value, (tuple, list)):
+            return any(tensors(v) for v in value)
+        if isinstance(value, dict):
+            return any(tensors(v) for v in value.values())
+        return False
+
+    held = []
+    for name, module in model.named_modules():
+        for attribute, value in vars(module).items():
+            if attribute in ('_parameters', '_buffers', '_modules'):
+                continue
+            if tensors(value):
+                held.append((name, attribute))
+    return held
+
+
+@pytest.mark.parametrize('net,channels', [(GMSNet(in_channels=5), 5), (NconvMS(), 4)], ids=['GMSNet', 'NconvMS'])
+def test_no_activation_outlives_forward(net, channels):
+    x = torch.rand(2, channels, 32, 32)
+    x[:, 3:4] *= (torch.rand(2, 1, 32, 32) > 0.8).float()
+    if channels == 5:
+        x[:, 4:5] = (x[:, 3:4] > 0).float()
+    outputs = [y for y in net(x, True) if y is not None]
+    sum(y.mean() for y in outputs).backward()
+    del outputs
+
+    assert _held_tensors(net) == []
+
+
+def test_capture_records_detached_cpu_copies():
+    net = GMSNet(in_channels=5)
+    x = torch.rand(1, 5, 32, 32)
+    capture = ActivationCapture(net, ['d', 'fuse'], max_records=2)
+    outputs = []
+    handle = net.fuse.register_forward_hook(lambda module, args, output: outputs.append(output))
+    for _ in range(3):
+        net(x, False)
+    handle.remove()
+
+    records = capture.outputs('fuse')
+    assert len(records) == 2 and len(capture.outputs('d')) == 2
+    assert all(r.device.type == 'cpu' and not r.requires_grad and r.grad_fn is None for r in records)
+    assert outputs[-1].requires_grad
+    assert records[-1].untyped_storage().data_ptr() != outputs[-1].untyped_storage().data_ptr()
+    assert torch.equal(records[-1], outputs[-1].detach())
+
+    capture.remove()
+    assert capture.outputs('fuse') == [] and capture.outputs('d') == []
+    net(x, False)
+    assert capture.outputs('fuse') == []
+
+
+def test_capture_records_stay_readable_after_the_with_block():
+    net = GMSNet(in_channels=5)
+    with ActivationCapture(net, ['fuse']) as capture:
+        net(torch.rand(1, 5, 32, 32), False)
+    net(torch.rand(1, 5, 32, 32), False)
+    assert len(capture.outputs('fuse')) == 1
@@ -0,0 +1,40 @@
+import torch
+
+from conftest import create_model, synthetic_batches
+from dataloaders.feature_cache import FeatureCacheLoader
+from dataloaders.tensor_cache import TensorCacheLoader
+
+
+class _Loader(object):
+    """The parts of a DataLoader the caches use, over fixed batches."""
+
+    def __init__(self, batches, batch_size=2):
+        self.batches = batches
+        self.batch_size = batch_size
+        self.dataset = range(sum(len(batch[0]) for batch in batches))
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+def test_feature_cache_over_a_tensor_cache(tmp_path):
+    batches = synthetic_batches()
+    val_loader = TensorCacheLoader(_Loader(batches), mode='ram')
+    assert len(val_loader.dataset) == 4
+
+    model = create_model(training_mode='dc0-cf1-ln1').eval()
+    cache = FeatureCacheLoader(val_loader, str(tmp_path))
+    cache.build(model.dc_model, model.input_size, True, torch.device('cpu'), source={'data_path': 'synthetic'})
+    cached = list(cache)
+    assert len(cached) == len(cache) == len(batches)
+    for (input, target, scale, (depth1, features)), (expected_input, expected_target, _) in zip(cached, batches):
+        assert torch.equal(input, expected_input)
+        assert torch.equal(target, expected_target)
+        assert depth1.shape[0] == features.shape[0] == input.shape[0]
+    # depth1 as computed by the uncached run, the metrics of the validation are computed on it
+    with torch.no_grad():
+        expected_depth1, _ = model.dc_model(batches[0][0][:, :model.input_size, :, :], True)
+    assert torch.equal(cached[0][3][0], expected_depth1)
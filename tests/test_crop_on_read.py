@@ -0,0 +1,91 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from dataloaders.dataloader import h5_loader
+from dataloaders.dataloader_factory import create_data_loaders
+from dataloaders.kitti_dataloader import KITTIDataset
+from dataloaders.nyu_dataloader import NYUDataset
+
+# raw image sizes of the sparse-to-dense h5 files
+raw_sizes = {NYUDataset: (480, 640), KITTIDataset: (375, 1242)}
+
+
+def _write_h5(folder, size, num_files=2, seed=0):
+    rng = np.random.RandomState(seed)
+    for split in ['train', 'val']:
+        scene = os.path.join(folder, split, 'scene')
+        os.makedirs(scene, exist_ok=True)
+        for k in range(num_files):
+            with h5py.File(os.path.join(scene, '{:05d}.h5'.format(k)), 'w') as f:
+                f.create_dataset('rgb', data=rng.randint(0, 256, (3,) + size).astype(np.uint8), chunks=(3, 32, 32))
+                f.create_dataset('depth', data=rng.uniform(1.0, 10.0, size).astype(np.float32), chunks=(32, 32))
+
+
+def _item(dataset, index, seed):
+    np.random.seed(seed)
+    return dataset[index]
+
+
+@pytest.mark.parametrize('dataset_class,split,arch', [
+    (NYUDataset, 'val', 'resnet18'),
+    (NYUDataset, 'train', 'resnet18'),
+    (KITTIDataset, 'val', 'depthcompnet'),
+    (KITTIDataset, 'train', 'depthcompnet'),
+], ids=['nyu-val', 'nyu-train', 'kitti-val', 'kitti-train'])
+def test_crop_on_read_matches_the_full_read(tmp_path, dataset_class, split, arch):
+    _write_h5(str(tmp_path), raw_sizes[dataset_class])
+    root = os.path.join(str(tmp_path), split)
+    full = dataset_class(root, split, modality='rgb', arch=arch)
+    cropped = dataset_class(root, split, modality='rgb', arch=arch, crop_on_read=True)
+
+    for index in range(len(full)):
+        expected_input, expected_depth, _ = _item(full, index, seed=index)
+        input, depth, _ = _item(cropped, index, seed=index)
+        assert input.shape == expected_input.shape and depth.shape == expected_depth.shape
+        assert torch.allclose(input, expected_input, atol=1e-6)
+        assert torch.allclose(depth, expected_depth, atol=1e-5)
+
+
+@pytest.mark.parametrize('dataset_class,split,arch', [
+    (NYUDataset, 'val', 'resnet18'),
+    (KITTIDataset, 'val', 'depthcompnet'),
+], ids=['nyu-val', 'kitti-val'])
+def test_read_window_is_the_hyperslab(tmp_path, dataset_class, split, arch):
+    _write_h5(str(tmp_path), raw_sizes[dataset_class], num_files=1)
+    root = os.path.join(str(tmp_path), split)
+    dataset = dataset_class(root, split, modality='rgb', arch=arch, crop_on_read=True)
+    path = dataset.imgs[0][0]
+
+    height, width = raw_sizes[dataset_class]
+    i, j, h, w = dataset.read_window(height, width)
+    assert 0 <= i and i + h <= height and 0 <= j and j + w <= width
+    assert h * w < height * width
+    rgb, depth = h5_loader(path)
+    rgb_window, depth_window = h5_loader(path, dataset.read_window)
+    assert np.array_equal(rgb_window, rgb[i:i + h, j:j + w])
+    assert np.array_equal(depth_window, depth[i:i + h, j:j + w])
+
+
+@pytest.mark.parametrize('dataset_class', [NYUDataset, KITTIDataset], ids=['nyu', 'kitti'])
+def test_train_split_reads_the_full_image(tmp_path, dataset_class):
+    # the train transforms resize after the crop, a window would change the sampling grid
+    _write_h5(str(tmp_path), raw_sizes[dataset_class], num_files=1)
+    dataset = dataset_class(os.path.join(str(tmp_path), 'train'), 'train', modality='rgb', arch='resnet18',
+                            crop_on_read=True)
+    assert dataset.read_window(*raw_sizes[dataset_class]) is None
+
+
+def test_create_data_loaders_crop_on_read(tmp_path):
+    _write_h5(str(tmp_path), raw_sizes[KITTIDataset])
+    loader, dataset = create_data_loaders(str(tmp_path), data_type='kitti_h5', loader_type='val', num_samples=100,
+                                          workers=0, batch_size=2, pin_memory=False, crop_on_read=True)
+    assert isinstance(dataset, KITTIDataset) and dataset.crop_on_read
+    input, target, _ = next(iter(loader))
+    assert input.shape == (2, 4, 240, 960) and target.shape == (2, 1, 240, 960)
+
+    with pytest.raises(RuntimeError):
+        create_data_loaders(str(tmp_path), data_type='visim', crop_on_read=True)
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+import torch
+import torch.nn as nn
+
+import export
+import inference
+from conftest import create_model
+
+
+class _ShapeSpecialized(nn.Module):
+    # the python int of the width becomes a constant of the trace
+    training_mode = 'dc1_only'
+    output_names = ['depth1']
+
+    def forward(self, input):
+        return (input[:, 3:4, :, :] * int(input.shape[3]),)
+
+
+def test_torchscript_export_matches_the_eager_model(tmp_path):
+    model = export.create_inference_model(create_model('gms_depthcompnet', 'dc1-cf1-ln1'))
+    filename = str(tmp_path / 'model.pt')
+    export.export_torchscript(model, filename, 64, 96)
+
+    loaded = inference.load_model(filename)
+    input = export.example_input(2, 48, 80)
+    with torch.no_grad():
+        reference = model(input)
+    outputs = loaded(input)
+    assert list(outputs) == model.output_names
+    for name, expected in zip(model.output_names, reference):
+        assert torch.allclose(torch.as_tensor(outputs[name]), expected, atol=1e-4)
+
+
+def test_torchscript_export_refuses_a_specialized_trace(tmp_path):
+    filename = tmp_path / 'model.pt'
+    with pytest.raises(RuntimeError, match='differs from the eager model'):
+        export.export_torchscript(_ShapeSpecialized().eval(), str(filename), 64, 96)
+    assert not filename.exists()
+
+
+dcnet_archs = ['resnet18', 'udepthcompnet18', 'gudepthcompnet18', 'gms_depthcompnet', 'ged_depthcompnet']
+conf_heads = ['cbr3-c1', 'cbr3-cbr1-c1', 'cbr3-cbr1-c1res']
+# every output layout of InferenceModel: depth only, confidence of the dc net (with the loss net), each confidence
+# head, and a confidence head with the loss net
+onnx_cases = [(dc, mode, 'cbr3-c1') for dc in dcnet_archs for mode in ['dc1_only', 'dc1-ln1']] + \
+             [(dc, 'dc1-cf1-ln0', head) for dc in dcnet_archs for head in conf_heads] + \
+             [(dc, 'dc1-cf1-ln1', 'cbr3-c1') for dc in dcnet_archs]
+
+
+def _latency(fn, input, iterations=5):
+    fn(input)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(input)
+    return (time.perf_counter() - start) / iterations
+
+
+@pytest.mark.parametrize('dc_arch,training_mode,conf_arch', onnx_cases)
+def test_onnx_export_parity_and_latency(tmp_path, dc_arch, training_mode, conf_arch):
+    pytest.importorskip('onnxruntime')
+    model = export.create_inference_model(create_model(dc_arch, training_mode, conf_arch))
+    filename = str(tmp_path / 'model.onnx')
+    export.export_onnx(model, filename, 64, 96)
+
+    session = inference.OnnxDepthCompletion(filename, threads=1)
+    assert session.output_names == model.output_names
+    input = export.example_input(3, 96, 128)
+    with torch.no_grad():
+        reference = model(input)
+        outputs = session(input)
+        for name, expected in zip(model.output_names, reference):
+            assert outputs[name].shape == expected.shape
+        assert export.max_difference([outputs[name] for name in model.output_names], reference) < 1e-3
+
+        torch.set_num_threads(1)
+        torch_time = _latency(model, input)
+        ort_time = _latency(session, input)
+    # onnxruntime serves these models on cpu, it must not be a regression against eager torch
+    assert ort_time < 2.0 * torch_time, 'onnxruntime {:.1f} ms, torch {:.1f} ms'.format(ort_time * 1e3,
+                                                                                       torch_time * 1e3)
+
+
+def test_onnx_export_refuses_a_specialized_graph(tmp_path):
+    pytest.importorskip('onnxruntime')
+    filename = tmp_path / 'model.onnx'
+    with pytest.raises(RuntimeError, match='differs from the eager model'):
+        export.export_onnx(_ShapeSpecialized().eval(), str(filename), 64, 96)
+    assert not filename.exists()
@@ -0,0 +1,60 @@
+import os
+import time
+
+import numpy as np
+
+import dataloaders.kitti_loader as kitti_loader
+from dataloaders.kitti_loader import load_path_index, path_index_dirs, save_path_index
+
+
+def _touch(filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    open(filename, 'w').close()
+
+
+def _mtimes(dirs):
+    return [os.stat(d).st_mtime_ns for d in dirs]
+
+
+def test_path_index_dirs_cover_every_glob_level(tmp_path):
+    root = str(tmp_path)
+    glob_gt = os.path.join(root, 'train/*_sync/proj_depth/groundtruth/image_0[2,3]/*.png')
+    _touch(os.path.join(root, 'train/a_sync/proj_depth/groundtruth/image_02/0.png'))
+    _touch(os.path.join(root, 'train/b_sync/proj_depth/velodyne_raw/image_02/0.png'))
+
+    dirs = path_index_dirs(glob_gt)
+    assert dirs == sorted(os.path.join(root, d) for d in [
+        'train', 'train/a_sync', 'train/b_sync', 'train/a_sync/proj_depth', 'train/b_sync/proj_depth',
+        'train/a_sync/proj_depth/groundtruth', 'train/a_sync/proj_depth/groundtruth/image_02'])
+
+    # a new ground truth folder in an existing sequence changes the mtime of one of the listed dirs
+    before = _mtimes(dirs)
+    time.sleep(0.01)
+    _touch(os.path.join(root, 'train/b_sync/proj_depth/groundtruth/image_03/0.png'))
+    assert _mtimes(dirs) != before
+
+
+def test_path_index_dirs_without_wildcard_dirs(tmp_path):
+    root = str(tmp_path)
+    _touch(os.path.join(root, 'val_selection_cropped/groundtruth_depth/0.png'))
+    glob_gt = os.path.join(root, 'val_selection_cropped/groundtruth_depth/*.png')
+    assert path_index_dirs(glob_gt) == [os.path.join(root, 'val_selection_cropped/groundtruth_depth')]
+
+
+def test_path_index_goes_to_a_created_cache_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(kitti_loader, 'path_index_cache_dir', str(tmp_path / 'cache'))
+    root_d = str(tmp_path / 'data' / 'kitti_depth')
+    _touch(os.path.join(root_d, 'val_selection_cropped/groundtruth_depth/0.png'))
+    glob_gt = os.path.join(root_d, 'val_selection_cropped/groundtruth_depth/*.png')
+    dirs = path_index_dirs(glob_gt)
+    paths = {key: kitti_loader.encode_paths([os.path.join(root_d, '0.png')], root_d) for key in ['rgb', 'd', 'gt']}
+
+    index_dir = kitti_loader.default_index_dir(root_d)
+    assert not os.path.exists(index_dir)
+    index_file = os.path.join(index_dir, 'path_index_val_select.npz')
+    save_path_index(index_file, glob_gt, dirs, paths)
+
+    assert index_dir.startswith(str(tmp_path / 'cache'))
+    assert os.listdir(os.path.dirname(glob_gt)) == ['0.png']  # nothing written in the data folder
+    loaded = load_path_index(index_file, glob_gt, dirs)
+    assert all(np.array_equal(loaded[key], paths[key]) for key in paths)
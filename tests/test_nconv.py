@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from model_zoo.nconv import NConv2d
+
+
+def _sparse_input(channels, seed=0, batch_size=2, height=24, width=32):
+    generator = torch.Generator().manual_seed(seed)
+    conf = (torch.rand(batch_size, channels, height, width, generator=generator) < 0.2).float()
+    data = torch.rand(batch_size, channels, height, width, generator=generator) * 80.0 * conf
+    return data, conf
+
+
+def _outputs_and_gradients(layer, data, conf, fused, autocast):
+    layer.fused = fused
+    layer.zero_grad(set_to_none=True)
+    x = data.clone().requires_grad_()
+    c = conf.clone().requires_grad_()
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=autocast):
+        nconv, cout = layer(x, c)
+    (nconv.sum() + cout.sum()).backward()
+    results = [nconv.detach(), cout.detach(), x.grad, c.grad, layer.weight.grad]
+    if layer.bias is not None:
+        results.append(layer.bias.grad)
+    return results
+
+
+@pytest.mark.parametrize('autocast', [False, True], ids=['fp32', 'autocast'])
+@pytest.mark.parametrize('groups', [1, 2])
+@pytest.mark.parametrize('bias', [True, False], ids=['bias', 'no-bias'])
+@pytest.mark.parametrize('in_channels,out_channels,kernel_size,padding', [(2, 2, 5, 2), (4, 2, 3, 1), (2, 4, 1, 0)])
+def test_fused_matches_reference(in_channels, out_channels, kernel_size, padding, bias, groups, autocast):
+    torch.manual_seed(0)
+    layer = NConv2d(in_channels, out_channels, kernel_size, 'softplus', 'k', padding=padding, groups=groups,
+                    bias=bias)
+    data, conf = _sparse_input(in_channels)
+    fused = _outputs_and_gradients(layer, data, conf, True, autocast)
+    reference = _outputs_and_gradients(layer, data, conf, False, autocast)
+    for a, b in zip(fused, reference):
+        assert a.dtype == torch.float32
+        # relative to the largest value, the gradients sum many terms of a few hundreds in another order
+        assert float((a - b).abs().max()) <= 1e-4 * max(1.0, float(b.abs().max()))
@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+import export
+import model_zoo.confidence_depth_framework as mc
+import quantize
+import trainer
+from conftest import create_model, synthetic_batches
+
+qat_cases = [(dc_arch, training_mode)
+             for dc_arch in ['resnet18', 'udepthcompnet18', 'gudepthcompnet18', 'gms_depthcompnet', 'ged_depthcompnet']
+             for training_mode in ['dc1_only', 'dc1-ln1', 'dc1-cf1-ln0', 'dc0-cf1-ln1']]
+
+
+@pytest.mark.parametrize('dc_arch,training_mode', qat_cases, ids=['-'.join(case) for case in qat_cases])
+def test_qat_train_convert_and_export(tmp_path, cpu, dc_arch, training_mode):
+    cdf = mc.ConfidenceDepthFrameworkFactory()
+    cdfmodel = create_model(dc_arch, training_mode)
+    batches = synthetic_batches(num_batches=1)
+    names = quantize.prepare_qat_model(cdfmodel, batches[0][0])
+    cdfmodel, opt_parameters = cdf.to_device(cdfmodel, cpu)
+    optimizer = torch.optim.Adam(opt_parameters, lr=1e-4)
+    criterion, _ = cdf.create_loss('l2', cdfmodel.use_loss_dc, 0.5 if cdfmodel.train_dc else 1.0)
+
+    trainer.train(batches, cdfmodel, criterion, optimizer, str(tmp_path), 0)
+    model = quantize.convert_qat_model(cdfmodel, names)
+    export.export_torchscript(model, str(tmp_path / 'model_int8.pt'), height=64, width=64)
+
+    assert (tmp_path / 'model_int8.pt').exists()
+    with torch.no_grad():
+        outputs = model(export.example_input(1, 64, 64))
+    assert len(outputs) == len(model.output_names)
+    assert all(torch.isfinite(output).all() for output in outputs)
+
+
+@pytest.mark.parametrize('dc_arch', ['resnet18', 'udepthcompnet18', 'gudepthcompnet18', 'gms_depthcompnet',
+                                     'ged_depthcompnet'])
+def test_ptq_parity_and_export(tmp_path, dc_arch):
+    model = export.create_inference_model(create_model(dc_arch, 'dc1-cf1-ln0').eval())
+    batches = synthetic_batches(num_batches=3)
+    qmodel = quantize.quantize_inference_model(model, batches[:2], 2)
+    export.export_torchscript(qmodel, str(tmp_path / 'model_int8.pt'), height=64, width=64)
+    assert (tmp_path / 'model_int8.pt').exists()
+
+    # held-out batch, the int8 depth against the float one
+    result = quantize.evaluate(qmodel, batches[2:], 1, reference=model)
+    with torch.no_grad():
+        reference = model(batches[2][0])[0]
+    assert result.rmse <= 0.1 * float(reference.abs().max())
@@ -0,0 +1,85 @@
+import math
+
+import pytest
+import torch
+
+import model_zoo.confidence_depth_framework as mc
+import runtime
+import trainer
+from conftest import create_model, synthetic_batches
+
+
+@pytest.mark.parametrize('dc_arch,training_mode', [('gms_depthcompnet', 'dc1-cf1-ln1'),
+                                                   ('resnet18', 'dc1-ln0'),
+                                                   ('udepthcompnet18', 'dc0-cf1-ln0')])
+def test_train_and_validate_on_cpu(tmp_path, cpu, dc_arch, training_mode):
+    cdf = mc.ConfidenceDepthFrameworkFactory()
+    cdfmodel, opt_parameters = cdf.to_device(create_model(dc_arch, training_mode), cpu)
+    assert runtime.model_device(cdfmodel) == cpu
+    optimizer = torch.optim.Adam(opt_parameters, lr=1e-4)
+    criterion, _ = cdf.create_loss('l2', cdfmodel.use_loss_dc, 0.5 if cdfmodel.train_dc else 1.0)
+    before = [p.detach().clone() for p in opt_parameters]
+
+    trainer.train(synthetic_batches(), cdfmodel, criterion, optimizer, str(tmp_path), 0, print_frequency=1)
+    result = trainer.validate(synthetic_batches(seed=1), cdfmodel, criterion, 0, num_image_samples=1,
+                              output_folder=str(tmp_path), conf_recall='cf' in training_mode)
+
+    assert any(not torch.equal(b, p) for b, p in zip(before, opt_parameters))
+    assert all(torch.isfinite(p).all() for p in opt_parameters)
+    for name in ['rmse', 'mae', 'absrel', 'delta1', 'loss0']:
+        assert math.isfinite(getattr(result, name)), name
+    assert (tmp_path / 'train.csv').exists() and (tmp_path / 'val.csv').exists()
+    if 'cf' in training_mode:
+        assert (tmp_path / 'pr.csv').exists()
+
+
+@pytest.mark.parametrize('training_mode,trainable', [('dc1_only', ['dc_model']),
+                                                    ('dc1-ln0', ['dc_model']),
+                                                    ('dc0-cf1-ln1', ['conf_model', 'loss_dc_model']),
+                                                    ('dc1-cf1-ln0', ['dc_model', 'conf_model'])])
+def test_training_mode_flags_survive_the_checkpoint_state(training_mode, trainable):
+    cdf = mc.ConfidenceDepthFrameworkFactory()
+    cdfmodel = cdf.create_model_from_state(cdf.get_state(create_model(training_mode=training_mode)))
+    assert cdfmodel.trainable_subnets() == trainable
+    assert cdfmodel.use_conf == (cdfmodel.conf_model is not None)
+    assert cdfmodel.use_loss_dc == (cdfmodel.loss_dc_model is not None)
+
+    opt_parameters = set(cdfmodel.opt_params())
+    for name in ['dc_model', 'conf_model', 'loss_dc_model']:
+        net = getattr(cdfmodel, name)
+        if net is not None:
+            assert all((p in opt_parameters) == (name in trainable) == p.requires_grad for p in net.parameters())
+
+
+def _optimizer_state(optimizer):
+    return [(key, value.clone() if torch.is_tensor(value) else value)
+            for state in optimizer.state.values() for key, value in sorted(state.items())]
+
+
+@pytest.mark.parametrize('scaled', [False, True], ids=['fp32', 'grad-scaler'])
+@pytest.mark.parametrize('batch', ['inf-loss', 'no-valid-pixel'])
+def test_skipped_batch_leaves_weights_and_optimizer_state(tmp_path, cpu, scaled, batch):
+    cdf = mc.ConfidenceDepthFrameworkFactory()
+    cdfmodel, opt_parameters = cdf.to_device(create_model('gms_depthcompnet', 'dc1_only'), cpu)
+    optimizer = torch.optim.Adam(opt_parameters, lr=1e-3)
+    criterion, _ = cdf.create_loss('il1')
+    scaler = torch.amp.GradScaler('cpu', enabled=scaled)
+    # one regular step first, so that Adam has moments and a step count to keep
+    trainer.train(synthetic_batches(num_batches=1), cdfmodel, criterion, optimizer, str(tmp_path), 0, scaler=scaler)
+    before = [p.detach().clone() for p in opt_parameters]
+    state = _optimizer_state(optimizer)
+    assert state
+
+    input, target, scale = synthetic_batches(num_batches=1, seed=1)[0]
+    if batch == 'inf-loss':
+        # a depth of 0 on the valid pixels makes the inverted l1 loss inf
+        cdfmodel.dc_model.register_forward_hook(lambda module, args, output: (output[0] * 0.0, output[1]))
+    else:
+        target = torch.zeros_like(target)
+    trainer.train([(input, target, scale)], cdfmodel, criterion, optimizer, str(tmp_path), 1, scaler=scaler)
+
+    assert all(torch.equal(b, p) for b, p in zip(before, opt_parameters))
+    after = _optimizer_state(optimizer)
+    assert [key for key, _ in after] == [key for key, _ in state]
+    for (_, a), (_, b) in zip(after, state):
+        assert torch.equal(a, b) if torch.is_tensor(a) else a == b
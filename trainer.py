@@ -12,7 +12,9 @@ from pathlib import Path
 cudnn.benchmark = True
 import GPUtilext
 import torch.optim
-from metrics import AverageMeter, Result, ConfidencePixelwiseThrAverageMeter
+import runtime
+from metrics import DeviceAverageMeter, Result, ConfidencePixelwiseAverageMeter, ConfidencePixelwiseThrAverageMeter, \
+    result_statistics
 
 cudnn.benchmark = True
 
@@ -28,7 +30,7 @@ def create_command_parser():
     data_modality_types = ['rgb-fd-bin', 'rgb-kfd-bin', 'rgb-kgt-bin', 'rgb-kor-bin', 'rgb-kor-kw']
 
     loss_names = ['l1', 'l2', 'il1', 'absrel']
-    data_types = ['visim', 'visim_seq', 'kitti', 'dji']
+    from dataloaders.dataloader_factory import data_types
 
     opt_names = ['sgd', 'adam']
     from dataloaders.dense_to_sparse import UniformSampling, SimulatedStereo
@@ -71,9 +73,42 @@ def create_command_parser():
                         help='path to data folder')
     parser.add_argument('--data-modality', metavar='MODALITY', default='rgb-fd-bin', choices=data_modality_types,
                         type=str, help='modality: ' + ' | '.join(data_modality_types) + ' (default: rgb-fd-bin)')  #####
+    parser.add_argument('--data-cache', default=None, type=str, metavar='PATH',
+                        help='folder of the decoded sparse depth cache and of the path index, kitti only '
+                             '(default: none, the path index goes to the user cache folder)')
+    parser.add_argument('--crop-on-read', action='store_true',
+                        help='read only the window of the h5 images used by the crop of the transform, nyu and '
+                             'kitti_h5 only (default: off)')
 
     parser.add_argument('-j', '--workers', default=6, type=int, metavar='N',
                         help='number of data loading workers (default: 10)')
+    # runtime
+    parser.add_argument('--device', default='auto', type=str, metavar='DEVICE',
+                        help='device: ' + ' | '.join(runtime.device_names) + ' | cuda:N (default: auto)')
+    parser.add_argument('--threads', default=0, type=int, metavar='N',
+                        help='intra-op CPU threads, 0 keeps the torch default (default: 0)')
+    parser.add_argument('--interop-threads', default=0, type=int, metavar='N',
+                        help='inter-op CPU threads, 0 keeps the torch default (default: 0)')
+    parser.add_argument('--amp', default='none', choices=runtime.amp_modes,
+                        help='mixed precision of the forward passes: ' + ' | '.join(runtime.amp_modes) +
+                             ', NConv2d, the losses and the metrics stay in float32 (default: none)')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the sub-nets and the losses with torch.compile (default: false)')
+    parser.add_argument('--compile-backend', default='inductor', type=str, metavar='BACKEND',
+                        help='torch.compile backend (default: inductor)')
+    val_cache_modes = ['none', 'ram', 'disk', 'auto']
+    parser.add_argument('--val-cache', metavar='MODE', default='none', choices=val_cache_modes,
+                        help='keep the preprocessed validation split after the first epoch: ' +
+                             ' | '.join(val_cache_modes) + ' (default: none)')
+    parser.add_argument('--val-cache-dir', default=None, type=str, metavar='PATH',
+                        help='folder of the validation cache file when it does not fit in RAM (default: temp folder)')
+    parser.add_argument('--feature-cache', default=None, type=str, metavar='PATH',
+                        help='folder where the outputs of a frozen dc net on the validation split are stored once '
+                             'and reused by every epoch (dc0 training modes, default: none)')
+    parser.add_argument('--checkpoint-stages', default=[], type=str, nargs='+', metavar='STAGE',
+                        help='stages of the dc and loss nets recomputed in the backward instead of storing their '
+                             'activations: all, gms_depthcompnet: d rgb fuse, udepthcompnet18/gudepthcompnet18: '
+                             'conv2-conv6 convt5-convt1 (default: none)')
     parser.add_argument('--epochs', default=50, type=int, metavar='N',
                         help='number of total epochs to run (default: 15)')
 
@@ -117,17 +152,28 @@ def create_command_parser():
     parser.add_argument('--val-images', default=10, type=int, metavar='N',
                         help='number of images in the validation image (default: 10)')
     parser.add_argument('--print-freq', '-p', default=10, type=int,
-                        metavar='N', help='print frequency (default: 10)')
+                        metavar='N',
+                        help='print frequency, also of the tensorboard logs and of the device syncs (default: 10)')
 
     # alternative modes
     parser.add_argument('--resume', default='', type=str, metavar='PATH',
                         help="path to latest checkpoint (default: empty)")
+    parser.add_argument('--qat', default='', type=str, metavar='PATH',
+                        help='quantization-aware fine-tuning of the float checkpoint PATH, the best epoch is saved '
+                             'as an int8 TorchScript model (default: empty)')
+    parser.add_argument('--qat-backend', default='fbgemm', choices=['fbgemm', 'qnnpack'],
+                        help='quantized engine of the int8 model: fbgemm (x86) | qnnpack (arm) (default: fbgemm)')
     parser.add_argument('-e', '--evaluate', dest='evaluate', type=str, default='', metavar='PATH',
                         help='evaluate model on validation set (default: empty)')
     # 这个参数影响evaluation模式下的
     parser.add_argument('-pr', '--precision-recall', dest='pr', default=True, action='store_true',
-                        help='calculate the precision recall table, might be necessary to ajust the '
-                             'bin and top size in the ConfidencePixelwiseThrAverageMeter class (default: false)')
+                        help='calculate the precision recall table, might be necessary to ajust '
+                             '--pr-bins and --pr-top (default: false)')
+    parser.add_argument('--pr-bins', default=500, type=int, metavar='N',
+                        help='confidence thresholds of the precision recall table (default: 500)')
+    parser.add_argument('--pr-top', default=1.0, type=float, metavar='VALUE',
+                        help='largest confidence threshold of the precision recall table, the thresholds are '
+                             'evenly spaced in [0, VALUE] (default: 1.0)')
 
     parser.add_argument('-thrs', '--confidence-threshold', dest='thrs', default=0, type=float,
                         help='confidence threshold (default: 0)')
@@ -164,11 +210,11 @@ def create_optimizer_fromstate(parameters, state):
     return optimizer, scheduler
 
 
-def resume(filename, factory, only_evaluation):
-    checkpoint = torch.load(filename)
+def resume(filename, factory, only_evaluation, device=None):
+    checkpoint = torch.load(filename, map_location='cpu')
     loss, loss_def = factory.create_loss_fromstate(checkpoint['loss_definition'])
     cdfmodel = factory.create_model_from_state(checkpoint['model_state'])
-    cdfmodel, opt_parameters = factory.to_device(cdfmodel)
+    cdfmodel, opt_parameters = factory.to_device(cdfmodel, device)
     epoch = checkpoint['epoch']
     if not only_evaluation:
         best_result_error = checkpoint['best_result_error']
@@ -315,72 +361,152 @@ class ResultSampleImage():
         :param target:
         :return:
         """
-        if (i % self.sample_step) == 0:
+        if self.is_sample(i):
             self.save(input, prediction, target, ((i % 2 * self.sample_step) == 0))
 
+    def is_sample(self, i):
+        return (i % self.sample_step) == 0
 
-def train(train_loader, model, criterion, optimizer, output_folder, epoch, writer=None):
-    average_meter = [AverageMeter(), AverageMeter()]
+
+def cached_dc_output(batch, device):
+    # batches of dataloaders.feature_cache.FeatureCacheLoader carry the outputs of the frozen dc net
+    if len(batch) < 4:
+        return None
+    return tuple(x.to(device, non_blocking=True) for x in batch[3])
+
+
+def to_metric(prediction, target_depth, scale):
+    """(pred_metric, target_metric): depth1 and depth2 of prediction and target_depth in metric units, multiplied by
+    the per-sample scale in one broadcast. New detached tensors, the outputs and the graph of the loss stay as they are.
+    """
+    scale = scale.view(-1, 1, 1, 1).to(target_depth.dtype)
+    depth1, conf1, depth2 = prediction
+    pred_metric = [depth1.detach() * scale, None if conf1 is None else conf1.detach(),
+                   None if depth2 is None else depth2.detach() * scale]
+    return pred_metric, target_depth * scale
+
+
+def evaluate_depth(result, criterion, index, depth, target_metric, scale, confidence=None):
+    """Statistics of result (metrics.result_fields) for depth, the depth index of the criterion (0: depth1, 1: depth2).
+
+    Without confidence the valid pixels are the ones of the loss: the per-sample sums of the loss pass are reused and
+    only converted to metric units. With confidence, or when the criterion did not compute them (depth2 of a DualLoss
+    without weight), the metrics make their own pass over the metric depths.
+    """
+    statistics = getattr(criterion, 'statistics', [None, None])[index]
+    if confidence is None and statistics is not None:
+        return result_statistics(statistics, scale)
+    return result.evaluate_tensor(depth, target_metric, confidence)
+
+
+def metric_input(input, scale):
+    # copy of input with the sparse depth channel in metric units
+    scale = scale.view(-1, 1, 1, 1).to(input.dtype)
+    return torch.cat((input[:, :3, :, :], input[:, 3:4, :, :] * scale, input[:, 4:, :, :]), 1)
+
+
+def float_prediction(prediction):
+    # the losses, metrics and images use float32 outputs, also under autocast
+    return [None if x is None else x.float() for x in prediction]
+
+
+def invalidate_gradients(optimizer, finite):
+    # a GradScaler skips the step (and the optimizer state update) when a gradient is not finite: the gradients of a
+    # skipped batch are set to nan on the device, no value is read back
+    for group in optimizer.param_groups:
+        for param in group['params']:
+            if param.grad is not None:
+                param.grad.masked_fill_(~finite, math.nan)
+
+
+def report_step_times(name, epoch, step_times):
+    # with --compile the first steps in train and in eval mode include the compilation
+    if len(step_times) > 1:
+        steady = sum(step_times[1:]) / (len(step_times) - 1)
+        print('=> {} epoch {}: first step {:.2f}s, then {:.3f}s per step'.format(name, epoch, step_times[0], steady))
+
+
+def report_skipped(name, epoch, average_meter):
+    skipped = average_meter.skipped()
+    if skipped > 0:
+        print('=> {} epoch {}: ignored {} images without valid pixel'.format(name, epoch, skipped))
+
+
+def train(train_loader, model, criterion, optimizer, output_folder, epoch, writer=None, amp='none', scaler=None,
+          print_frequency=10):
+    # the metrics and losses are accumulated on the device, the loop only waits for it every print_frequency steps
+    # (tqdm, tensorboard) and at the end of the epoch, so the step times are host times between these syncs
+    average_meter = [DeviceAverageMeter(), DeviceAverageMeter()]
+    step_times = []
     start = time.time()
     num_total_samples = len(train_loader)
 
     n_iter = 0
     model.train()
+    device = runtime.model_device(model)
+    if scaler is None:
+        scaler = runtime.grad_scaler(device, amp)
     end = time.time()
     loop = tqdm(train_loader)
-    for input, target, scale in loop:
+    loop.set_description(f'Epoch [{epoch}]')
+    for batch in loop:
+        input, target, scale = batch[:3]
         n_iter += 1
-        torch.cuda.synchronize()
         data_time = time.time() - end
 
         # compute pred
         end = time.time()
 
-        input, target, scale = input.cuda(), target.cuda(), scale.cuda()
+        input = input.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        scale = scale.to(device, non_blocking=True)
         # expand_size = input.shape[0] / scale.shape[0]
         # scale = scale.expand([int(expand_size), 1])
         target_depth = target[:, 0:1, :, :]
-        prediction = model(input)
+        with runtime.autocast(device, amp):
+            prediction = model(input, cached_dc_output(batch, device))
+        prediction = float_prediction(prediction)
         if prediction[2] is not None:
             loss = criterion(input, prediction[0][:, 0:1, :, :], prediction[2][:, 0:1, :, :], target_depth, epoch)
         else:
             loss = criterion(input, prediction[0][:, 0:1, :, :], target_depth, epoch)
 
-        if loss is None or torch.isnan(loss) or torch.isinf(loss):
-            print('ignoring image, no valid pixel')
-            continue
-
-        loss.backward()  # compute gradient and do SGD step
-        optimizer.step()
+        # a non-finite loss (nan for a batch without enough valid pixels) skips the step, the weights and the
+        # optimizer state do not change (the meters leave it out of the loss average)
+        finite = torch.isfinite(loss)
+        if scaler.is_enabled():
+            scaler.scale(loss).backward()  # compute gradient and do SGD step
+            invalidate_gradients(optimizer, finite)
+            scaler.step(optimizer)
+            scaler.update()
+        elif finite.item():
+            loss.backward()
+            optimizer.step()
         optimizer.zero_grad()
 
-        torch.cuda.synchronize()
         gpu_time = time.time() - end
+        step_times.append(gpu_time)
 
-        # show
-        loop.set_description(f'Epoch [{epoch}]')
-        loop.set_postfix(loss=loss.item())
-        if writer is not None:
-            writer.add_scalar("time", gpu_time, n_iter + num_total_samples * epoch - 1)
-            writer.add_scalar("loss", loss, n_iter + num_total_samples * epoch - 1)
-            writer.add_images('debug{0}', prediction[0], n_iter + num_total_samples * epoch - 1)
-
-        for cb in range(prediction[0].size(0)):
-            prediction[0][cb, :, :, :] *= scale[cb]
-            if prediction[2] is not None:
-                prediction[2][cb, :, :, :] *= scale[cb]
-            target_depth[cb, :, :, :] *= scale[cb]
+        pred_metric, target_metric = to_metric(prediction, target_depth, scale)
 
         # # measure accuracy and record loss
         result = [Result(), Result()]
-        if prediction[1] is not None:
-            result[0].evaluate(prediction[0][:, 0:1, :, :].data, target_depth.data, prediction[1][:, 0:1, :, :].data)
-        else:
-            result[0].evaluate(prediction[0][:, 0:1, :, :].data, target_depth.data)
-        average_meter[0].update(result[0], gpu_time, data_time, criterion.loss, input.size(0))
-        if prediction[2] is not None:
-            result[1].evaluate(prediction[2][:, 0:1, :, :].data, target_depth.data)
-            average_meter[1].update(result[1], gpu_time, data_time, criterion.loss, input.size(0))
+        confidence = pred_metric[1][:, 0:1, :, :] if pred_metric[1] is not None else None
+        statistics = evaluate_depth(result[0], criterion, 0, pred_metric[0][:, 0:1, :, :], target_metric, scale,
+                                    confidence)
+        average_meter[0].update(statistics, gpu_time, data_time, criterion.loss, input.size(0))
+        if pred_metric[2] is not None:
+            statistics = evaluate_depth(result[1], criterion, 1, pred_metric[2][:, 0:1, :, :], target_metric, scale)
+            average_meter[1].update(statistics, gpu_time, data_time, criterion.loss, input.size(0))
+
+        # show
+        if n_iter % print_frequency == 0:
+            loss_value = loss.item()
+            loop.set_postfix(loss=loss_value)
+            if writer is not None:
+                writer.add_scalar("time", gpu_time, n_iter + num_total_samples * epoch - 1)
+                writer.add_scalar("loss", loss_value, n_iter + num_total_samples * epoch - 1)
+                writer.add_images('debug{0}', pred_metric[0], n_iter + num_total_samples * epoch - 1)
 
         end = time.time()
 
@@ -389,69 +515,68 @@ def train(train_loader, model, criterion, optimizer, output_folder, epoch, write
         #     if prediction[2] is not None:
         #         print_error('Train',num_total_samples, average_meter[1].average(), result[1], criterion.loss, data_time, gpu_time, i, epoch)
 
+    report_step_times('train', epoch, step_times)
+    report_skipped('train', epoch, average_meter[0])
     report_epoch_error(os.path.join(output_folder, 'train.csv'), epoch, average_meter[0].average())
     if prediction[2] is not None:
         report_epoch_error(os.path.join(output_folder, 'train.csv'), epoch, average_meter[1].average())
 
 
 def validate(val_loader, model, criterion, epoch, num_image_samples=4, print_frequency=10, output_folder=None,
-             conf_recall=False, conf_threshold=0, writer=None):
-    average_meter = [AverageMeter(), AverageMeter()]
+             conf_recall=False, conf_threshold=0, writer=None, amp='none', pr_bins=500, pr_top=1.0):
+    average_meter = [DeviceAverageMeter(), DeviceAverageMeter()]
 
     if conf_recall:
-        conf_avg_meter = ConfidencePixelwiseThrAverageMeter()
+        conf_avg_meter = ConfidencePixelwiseThrAverageMeter(pr_bins, pr_top)
+        calibration_meter = ConfidencePixelwiseAverageMeter()
 
     model.eval()  # switch to train mode
+    device = runtime.model_device(model)
     end = time.time()
     num_total_samples = len(val_loader)
     rsi = ResultSampleImage(output_folder, epoch, num_image_samples, num_total_samples)
-    for i, (input, target, scale) in enumerate(tqdm(val_loader)):
+    step_times = []
+    for i, batch in enumerate(tqdm(val_loader)):
+        input, target, scale = batch[:3]
 
-        torch.cuda.synchronize()
         data_time = time.time() - end
 
         # compute pred
         end = time.time()
 
-        input, target, scale = input.cuda(), target.cuda(), scale.cuda()
+        input = input.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        scale = scale.to(device, non_blocking=True)
         target_depth = target[:, 0:1, :, :]
-        prediction = model(input)
+        with runtime.autocast(device, amp):
+            prediction = model(input, cached_dc_output(batch, device))
+        prediction = float_prediction(prediction)
         if prediction[2] is not None:  # d1,c1,d2
             loss = criterion(input, prediction[0][:, 0:1, :, :], prediction[2][:, 0:1, :, :], target_depth, epoch)
         else:
             loss = criterion(input, prediction[0][:, 0:1, :, :], target_depth, epoch)
 
-        if loss is None or torch.isnan(loss) or torch.isinf(loss):
-            print('ignoring image, no valid pixel')
-            continue
-
-        torch.cuda.synchronize()
         gpu_time = time.time() - end
-
-        if writer is not None:
-            writer.add_scalar("val_loss", loss, i + num_total_samples * epoch - 1)
-            writer.add_images('debug{0}', prediction[0], i + num_total_samples * epoch - 1)
+        step_times.append(gpu_time)
 
         # 尺度恢复
-        for cb in range(prediction[0].size(0)):
-            prediction[0][cb, :, :, :] *= scale[cb]
-            if prediction[2] is not None:
-                prediction[2][cb, :, :, :] *= scale[cb]
-            target_depth[cb, :, :, :] *= scale[cb]
-            input[cb, 3:4, :, :] *= scale[cb]
+        pred_metric, target_metric = to_metric(prediction, target_depth, scale)
+
+        if writer is not None and (i + 1) % print_frequency == 0:
+            writer.add_scalar("val_loss", loss.item(), i + num_total_samples * epoch - 1)
+            writer.add_images('debug{0}', pred_metric[0], i + num_total_samples * epoch - 1)
 
         # measure accuracy and record loss
         result = [Result(conf_threshold), Result(conf_threshold)]
         # depth1
-        if prediction[1] is not None:
-            result[0].evaluate(prediction[0][:, 0:1, :, :].data, target_depth.data, prediction[1][:, 0:1, :, :].data)
-        else:
-            result[0].evaluate(prediction[0][:, 0:1, :, :].data, target_depth.data)
-        average_meter[0].update(result[0], gpu_time, data_time, criterion.loss, input.size(0))
+        confidence = pred_metric[1][:, 0:1, :, :] if pred_metric[1] is not None else None
+        statistics = evaluate_depth(result[0], criterion, 0, pred_metric[0][:, 0:1, :, :], target_metric, scale,
+                                    confidence)
+        average_meter[0].update(statistics, gpu_time, data_time, criterion.loss, input.size(0))
         # depth2
-        if prediction[2] is not None:
-            result[1].evaluate(prediction[2][:, 0:1, :, :].data, target_depth.data)
-            average_meter[1].update(result[1], gpu_time, data_time, criterion.loss, input.size(0))
+        if pred_metric[2] is not None:
+            statistics = evaluate_depth(result[1], criterion, 1, pred_metric[2][:, 0:1, :, :], target_metric, scale)
+            average_meter[1].update(statistics, gpu_time, data_time, criterion.loss, input.size(0))
 
         end = time.time()
 
@@ -463,17 +588,21 @@ def validate(val_loader, model, criterion, epoch, num_image_samples=4, print_fre
         #                     criterion.loss, data_time, gpu_time, i, epoch)
 
         if conf_recall and (i % 1 == 0):
-            conf_avg_meter.evaluate(prediction[0][:, 0:1, :, :].data, prediction[1][:, 0:1, :, :].data,
-                                    target_depth.data)
+            conf_avg_meter.evaluate(pred_metric[0][:, 0:1, :, :], pred_metric[1][:, 0:1, :, :], target_metric)
+            calibration_meter.evaluate(pred_metric[0][:, 0:1, :, :], pred_metric[1][:, 0:1, :, :], target_metric)
 
-        rsi.update(i, input, prediction, target_depth)  # 图片输出
+        if rsi.is_sample(i):
+            rsi.update(i, metric_input(input, scale), pred_metric, target_metric)  # 图片输出
         # rsi.save_sample(i, input, prediction, target_depth)
 
+    report_step_times('val', epoch, step_times)
+    report_skipped('val', epoch, average_meter[0])
     final_result = average_meter[0].average()
     report_epoch_error(os.path.join(output_folder, 'val.csv'), epoch, average_meter[0].average())
     if prediction[2] is not None:
         report_epoch_error(os.path.join(output_folder, 'val.csv'), epoch, average_meter[1].average())
     if conf_recall:
         conf_avg_meter.print(os.path.join(output_folder, 'pr.csv'))
+        calibration_meter.print(os.path.join(output_folder, 'calibration.csv'))
 
     return final_result